@@ -4,12 +4,13 @@ FastAPI сервер с OpenAI Function Calling
 """
 
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
 import httpx
-from email import message_from_string
+from email import policy as email_policy
+from email.parser import BytesParser
 from html import unescape
 import re
 import os
@@ -19,7 +20,14 @@ import struct
 import re
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from contextlib import asynccontextmanager
 import asyncio
+import hashlib
+import math
+import random
+import time
+import zlib
+from collections import OrderedDict
 
 import sys
 sys.path.insert(0, "/aida-gpt")
@@ -34,12 +42,6 @@ load_dotenv(".env")
 
 app = FastAPI(title="AIDA GPT API")
 
-# ==================== IVR DTMF CACHE ====================
-# Store DTMF key presses temporarily to route calls
-dtmf_cache = {}  # {entry_id: digit}
-voicemail_cache = {}  # {entry_id: {from_number, recording_url, call_duration, pressed_key}}
-last_voicemail_data = None  # Данные последнего звонка для email endpoint
-
 
 # CORS
 app.add_middleware(
@@ -84,21 +86,1183 @@ AMO_CF_LEAD_UTM_CAMPAIGN = int(os.getenv("AMO_CF_LEAD_UTM_CAMPAIGN", "2563563"))
 AMO_CF_LEAD_UTM_SOURCE = int(os.getenv("AMO_CF_LEAD_UTM_SOURCE", "2563561"))              # utm_source
 AMO_CF_LEAD_UTM_TERM = int(os.getenv("AMO_CF_LEAD_UTM_TERM", "2563569"))                  # utm_term
 
+# ============================================================================
+# HTTP CLIENTS - Общие пулы соединений к внешним сервисам
+# ============================================================================
+# Один httpx.AsyncClient на каждый upstream: keep-alive соединения переиспользуются
+# между запросами, поэтому TCP+TLS рукопожатие не повторяется на каждом вызове.
+
+def _http2_supported() -> bool:
+    """HTTP/2 в httpx требует пакет h2 (httpx[http2])"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1") == "1" and _http2_supported()
+
+# Для plain HTTP (биллинг) HTTP/2 не согласуется, для HTTPS httpx сам откатится на HTTP/1.1
+HTTP_UPSTREAMS: Dict[str, Dict[str, Any]] = {
+    "openai": {"timeout": 60.0, "connect": 10.0, "max_connections": 50, "max_keepalive": 20, "http2": True, "follow_redirects": True},
+    "amocrm": {"timeout": 30.0, "connect": 5.0, "max_connections": 10, "max_keepalive": 5, "http2": True, "follow_redirects": False},
+    "freescout": {"timeout": 30.0, "connect": 5.0, "max_connections": 10, "max_keepalive": 5, "http2": True, "follow_redirects": True},
+    "billing": {"timeout": 30.0, "connect": 5.0, "max_connections": 10, "max_keepalive": 5, "http2": False, "follow_redirects": True},
+    "gas": {"timeout": 30.0, "connect": 10.0, "max_connections": 20, "max_keepalive": 10, "http2": True, "follow_redirects": True},
+}
+
+http_clients: Dict[str, httpx.AsyncClient] = {}
+
+
+def _create_http_client(upstream: str) -> httpx.AsyncClient:
+    """Создаёт клиент с пулом соединений по настройкам upstream'а"""
+    cfg = HTTP_UPSTREAMS[upstream]
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(cfg["timeout"], connect=cfg["connect"]),
+        limits=httpx.Limits(
+            max_connections=cfg["max_connections"],
+            max_keepalive_connections=cfg["max_keepalive"],
+            keepalive_expiry=60.0
+        ),
+        http2=HTTP2_ENABLED and cfg["http2"],
+        follow_redirects=cfg["follow_redirects"]
+    )
+
+
+def get_http_client(upstream: str) -> httpx.AsyncClient:
+    """Возвращает общий клиент upstream'а (создаёт при первом обращении)"""
+    client = http_clients.get(upstream)
+    if client is None or client.is_closed:
+        client = _create_http_client(upstream)
+        http_clients[upstream] = client
+    return client
+
+
+@asynccontextmanager
+async def upstream_client(upstream: str):
+    """
+    Выдаёт общий клиент upstream'а для `async with`.
+
+    В отличие от `async with httpx.AsyncClient()` не закрывает клиент на выходе -
+    соединения остаются в пуле до shutdown.
+    """
+    yield get_http_client(upstream)
+
+
+def init_http_clients():
+    """Создаёт пулы для всех upstream'ов при старте"""
+    for upstream in HTTP_UPSTREAMS:
+        get_http_client(upstream)
+    print(f"✅ HTTP клиенты инициализированы: {', '.join(HTTP_UPSTREAMS)} (HTTP/2: {'да' if HTTP2_ENABLED else 'нет'})")
+
+
+async def close_http_clients():
+    """Закрывает все пулы соединений при остановке"""
+    for upstream, client in list(http_clients.items()):
+        try:
+            await client.aclose()
+        except Exception as e:
+            print(f"⚠️  Ошибка закрытия HTTP клиента {upstream}: {e}")
+    http_clients.clear()
+
+# ============================================================================
+# STATE BACKEND - Общее состояние между воркерами (сессии, звонки, IVR кэши)
+# ============================================================================
+# STATE_BACKEND=memory  - в памяти процесса (по умолчанию, один воркер)
+# STATE_BACKEND=sqlite  - SQLite в режиме WAL, несколько воркеров на одном сервере
+# STATE_BACKEND=redis   - Redis (или совместимый сервер), несколько серверов
+
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+STATE_SQLITE_PATH = os.getenv("STATE_SQLITE_PATH", os.path.join(os.path.dirname(__file__), "aida_state.db"))
+STATE_REDIS_URL = os.getenv("STATE_REDIS_URL", "redis://localhost:6379/0")
+STATE_REDIS_PREFIX = os.getenv("STATE_REDIS_PREFIX", "aida")
+
+
+class MemoryStateBackend:
+    """Состояние в памяти процесса. Значения хранятся в JSON, чтобы поведение совпадало с остальными бэкендами"""
+
+    name = "memory"
+    shared = False
+
+    def __init__(self):
+        self._data: Dict[tuple, tuple] = {}  # {(namespace, key): (json, expires_at)}
+
+    def get(self, namespace: str, key: str, default=None):
+        item = self._data.get((namespace, key))
+        if item is None:
+            return default
+        value, expires_at = item
+        if expires_at and expires_at < time.time():
+            del self._data[(namespace, key)]
+            return default
+        return json.loads(value)
+
+    def set(self, namespace: str, key: str, value, ttl: Optional[int] = None):
+        expires_at = time.time() + ttl if ttl else None
+        self._data[(namespace, key)] = (json.dumps(value, ensure_ascii=False), expires_at)
+
+    def add(self, namespace: str, key: str, value, ttl: Optional[int] = None) -> bool:
+        """Записывает значение, только если ключа ещё нет. True - записали"""
+        if self.get(namespace, key) is not None:
+            return False
+        self.set(namespace, key, value, ttl)
+        return True
+
+    def delete(self, namespace: str, key: str):
+        self._data.pop((namespace, key), None)
+
+    def delete_if(self, namespace: str, key: str, value) -> bool:
+        """Удаляет ключ, только если в нём value (чужую блокировку не трогаем). True - удалили"""
+        if self.get(namespace, key) != value:
+            return False
+        self.delete(namespace, key)
+        return True
+
+    def renew_if(self, namespace: str, key: str, value, ttl: int) -> bool:
+        """Продлевает ключ на ttl, только если в нём value. True - продлили"""
+        if self.get(namespace, key) != value:
+            return False
+        self.set(namespace, key, value, ttl)
+        return True
+
+    def purge_expired(self) -> int:
+        now = time.time()
+        expired = [k for k, (_, expires_at) in self._data.items() if expires_at and expires_at < now]
+        for k in expired:
+            del self._data[k]
+        return len(expired)
+
+
+class SQLiteStateBackend:
+    """Состояние в SQLite (WAL) - общее для всех воркеров uvicorn на одном сервере"""
+
+    name = "sqlite"
+    shared = True
+
+    def __init__(self, path: str):
+        import sqlite3
+        import threading
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS state (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                expires_at REAL,
+                PRIMARY KEY (namespace, key)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_state_expires ON state(expires_at)")
+
+    def get(self, namespace: str, key: str, default=None):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM state WHERE namespace = ? AND key = ?",
+                (namespace, key)
+            ).fetchone()
+        if row is None or (row[1] and row[1] < time.time()):
+            return default
+        return json.loads(row[0])
+
+    def set(self, namespace: str, key: str, value, ttl: Optional[int] = None):
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (namespace, key, json.dumps(value, ensure_ascii=False), expires_at)
+            )
+
+    def add(self, namespace: str, key: str, value, ttl: Optional[int] = None) -> bool:
+        """Записывает значение, только если ключа ещё нет (или он истёк). True - записали"""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at "
+                "WHERE state.expires_at IS NOT NULL AND state.expires_at < ?",
+                (namespace, key, json.dumps(value, ensure_ascii=False), now + ttl if ttl else None, now)
+            )
+        return cursor.rowcount == 1
+
+    def delete(self, namespace: str, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def delete_if(self, namespace: str, key: str, value) -> bool:
+        """Удаляет ключ, только если в нём value - одним запросом. True - удалили"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM state WHERE namespace = ? AND key = ? AND value = ?",
+                (namespace, key, json.dumps(value, ensure_ascii=False))
+            )
+        return cursor.rowcount == 1
+
+    def renew_if(self, namespace: str, key: str, value, ttl: int) -> bool:
+        """Продлевает ключ на ttl, только если в нём value и он не истёк - одним запросом. True - продлили"""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE state SET expires_at = ? WHERE namespace = ? AND key = ? AND value = ? "
+                "AND (expires_at IS NULL OR expires_at >= ?)",
+                (now + ttl, namespace, key, json.dumps(value, ensure_ascii=False), now)
+            )
+        return cursor.rowcount == 1
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM state WHERE expires_at IS NOT NULL AND expires_at < ?",
+                (time.time(),)
+            )
+        return cursor.rowcount
+
+
+class RedisStateBackend:
+    """Состояние в Redis - общее для нескольких серверов. TTL выставляет сам Redis"""
+
+    name = "redis"
+    shared = True
+
+    def __init__(self, url: str, prefix: str):
+        import redis
+
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url, socket_timeout=2, socket_connect_timeout=2)
+        self._redis.ping()
+        # Сравнение и удаление/продление - одна атомарная операция на сервере
+        self._delete_if = self._redis.register_script(
+            "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+        )
+        self._renew_if = self._redis.register_script(
+            "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('expire', KEYS[1], ARGV[2]) else return 0 end"
+        )
+
+    def _key(self, namespace: str, key: str) -> str:
+        return f"{self.prefix}:{namespace}:{key}"
+
+    def get(self, namespace: str, key: str, default=None):
+        value = self._redis.get(self._key(namespace, key))
+        return json.loads(value) if value is not None else default
+
+    def set(self, namespace: str, key: str, value, ttl: Optional[int] = None):
+        self._redis.set(self._key(namespace, key), json.dumps(value, ensure_ascii=False), ex=ttl)
+
+    def add(self, namespace: str, key: str, value, ttl: Optional[int] = None) -> bool:
+        """Записывает значение, только если ключа ещё нет (SET NX). True - записали"""
+        return bool(self._redis.set(self._key(namespace, key), json.dumps(value, ensure_ascii=False), ex=ttl, nx=True))
+
+    def delete(self, namespace: str, key: str):
+        self._redis.delete(self._key(namespace, key))
+
+    def delete_if(self, namespace: str, key: str, value) -> bool:
+        """Удаляет ключ, только если в нём value (Lua-скрипт). True - удалили"""
+        return bool(self._delete_if(keys=[self._key(namespace, key)], args=[json.dumps(value, ensure_ascii=False)]))
+
+    def renew_if(self, namespace: str, key: str, value, ttl: int) -> bool:
+        """Продлевает ключ на ttl, только если в нём value (Lua-скрипт). True - продлили"""
+        return bool(self._renew_if(keys=[self._key(namespace, key)], args=[json.dumps(value, ensure_ascii=False), ttl]))
+
+    def purge_expired(self) -> int:
+        return 0
+
+
+def create_state_backend():
+    """Создаёт бэкенд по STATE_BACKEND, при ошибке откатывается на память"""
+    try:
+        if STATE_BACKEND == "sqlite":
+            backend = SQLiteStateBackend(STATE_SQLITE_PATH)
+            print(f"✅ State backend: SQLite ({STATE_SQLITE_PATH})")
+            return backend
+        if STATE_BACKEND == "redis":
+            backend = RedisStateBackend(STATE_REDIS_URL, STATE_REDIS_PREFIX)
+            print(f"✅ State backend: Redis ({STATE_REDIS_URL})")
+            return backend
+    except Exception as e:
+        print(f"⚠️  Не удалось инициализировать state backend '{STATE_BACKEND}': {e}")
+        print("⚠️  Используется хранение в памяти процесса")
+
+    return MemoryStateBackend()
+
+
+class StateStore:
+    """
+    Асинхронный доступ к state backend.
+
+    У SQLite/Redis каждый вызов - дисковый или сетевой I/O (у Redis таймаут сокета 2с),
+    поэтому он выполняется в потоке (asyncio.to_thread) и не останавливает event loop.
+    Бэкенд в памяти вызывается напрямую
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.name = backend.name
+        self.shared = backend.shared
+
+    async def _run(self, method: str, *args, **kwargs):
+        func = getattr(self.backend, method)
+        if not self.shared:
+            return func(*args, **kwargs)
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def get(self, namespace: str, key: str, default=None):
+        return await self._run("get", namespace, key, default)
+
+    async def set(self, namespace: str, key: str, value, ttl: Optional[int] = None):
+        await self._run("set", namespace, key, value, ttl)
+
+    async def add(self, namespace: str, key: str, value, ttl: Optional[int] = None) -> bool:
+        return await self._run("add", namespace, key, value, ttl)
+
+    async def delete(self, namespace: str, key: str):
+        await self._run("delete", namespace, key)
+
+    async def delete_if(self, namespace: str, key: str, value) -> bool:
+        return await self._run("delete_if", namespace, key, value)
+
+    async def renew_if(self, namespace: str, key: str, value, ttl: int) -> bool:
+        return await self._run("renew_if", namespace, key, value, ttl)
+
+    async def purge_expired(self) -> int:
+        return await self._run("purge_expired")
+
+
+state = StateStore(create_state_backend())
+
+
+@asynccontextmanager
+async def state_lock(name: str, ttl: int = 10, timeout: float = 5):
+    """
+    Блокировка через state.add (общая для воркеров при STATE_BACKEND=sqlite/redis).
+    ttl - страховка от зависшего владельца; timeout - сколько ждать свободной блокировки
+    """
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + timeout
+    while not await state.add("lock", name, token, ttl=ttl):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Блокировка {name} занята дольше {timeout}с")
+        await asyncio.sleep(0.05)
+    try:
+        yield
+    finally:
+        # Блокировка могла истечь и достаться другому - удаляем только свою
+        await state.delete_if("lock", name, token)
+
+
+# Фоновые задачи с общим эффектом (очистка backend, outbox AmoCRM с лимитом на аккаунт, запросы к GAS)
+# при UVICORN_WORKERS > 1 выполняет один воркер - владелец аренды в state
+WORKER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+async def hold_leadership(name: str, lease: int) -> bool:
+    """True - этот воркер владеет арендой name (берёт свободную или продлевает свою на lease сек)"""
+    if await state.add("leader", name, WORKER_ID, ttl=lease):
+        return True
+    return await state.renew_if("leader", name, WORKER_ID, ttl=lease)
+
+
+async def run_as_leader(name: str, factory, lease: int = 60):
+    """
+    Держит factory() запущенной только в воркере-владельце аренды name.
+    Аренда продлевается каждые lease/3 сек; упавший воркер её не продлит - задачу подхватит другой
+    """
+    task: Optional[asyncio.Task] = None
+    while True:
+        leader = await hold_leadership(name, lease)
+        if leader and (task is None or task.done()):
+            print(f"👑 [{name}] Фоновая задача выполняется в этом воркере ({WORKER_ID})")
+            task = asyncio.create_task(factory())
+        elif not leader and task is not None and not task.done():
+            print(f"👑 [{name}] Аренда у другого воркера - останавливаемся")
+            task.cancel()
+        await asyncio.sleep(lease / 3)
+
+# ==================== АКТИВНЫЕ ЗВОНКИ И IVR КЭШИ ====================
+ACTIVE_CALL_TTL = 2 * 3600  # звонок дольше 2 часов считаем зависшим
+VOICEMAIL_RECORD_TTL = 24 * 3600
+# Письмо сопоставляется только со звонками не старше окна (сек)
+VOICEMAIL_MATCH_WINDOW = int(os.getenv("VOICEMAIL_MATCH_WINDOW", "3600"))
+# Сколько письмо ждёт summary своего звонка, прежде чем обработаться без него (сек)
+VOICEMAIL_EMAIL_WAIT = int(os.getenv("VOICEMAIL_EMAIL_WAIT", "180"))
+
+
+async def get_active_call(call_id: str) -> Optional[Dict]:
+    """Данные активного звонка (None если звонок не зарегистрирован)"""
+    return await state.get("calls", call_id)
+
+
+async def save_active_call(call_info: Dict):
+    """Сохраняет данные звонка (после любых изменений call_info)"""
+    await state.set("calls", call_info["id"], call_info, ttl=ACTIVE_CALL_TTL)
+
+
+async def update_active_call(call_id: str, message: Optional[Dict] = None, **fields) -> Optional[Dict]:
+    """
+    Меняет свежую копию звонка из state под блокировкой: поля fields и сообщение в историю.
+    Не затирает то, что записал другой обработчик (или воркер), пока этот ждал STT/биллинг
+    """
+    async with state_lock(f"call:{call_id}"):
+        call_info = await get_active_call(call_id)
+        if call_info is None:
+            return None
+        call_info.update(fields)
+        if message is not None:
+            call_info.setdefault("messages", []).append(message)
+        await save_active_call(call_info)
+    return call_info
+
+
+async def pop_active_call(call_id: str) -> Optional[Dict]:
+    """Удаляет звонок из активных и возвращает его данные"""
+    call_info = await state.get("calls", call_id)
+    if call_info is not None:
+        await state.delete("calls", call_id)
+    return call_info
+
+
+class VoicemailCorrelationStore:
+    """
+    Сводит события одного голосового сообщения: DTMF, summary, запись и письмо с транскрипцией.
+
+    Каждое событие пишется в свой ключ по entry_id, поэтому DTMF, summary и запись не затирают
+    друг друга. Письмо находит свой звонок по entry_id в тексте или по номеру звонящего
+    (окно VOICEMAIL_MATCH_WINDOW); письмо без номера не угадывает звонок, а ждёт и обрабатывается
+    без него. Общие списки меняются под state_lock, звонок забирается через state.add -
+    при нескольких воркерах (STATE_BACKEND=sqlite/redis) одно письмо - один звонок.
+    Письмо, пришедшее раньше summary, встаёт в ожидание: add_summary возвращает id
+    ожидающих задач, чтобы их разбудить.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.stats = {"summaries": 0, "matched_entry": 0, "matched_phone": 0, "waiting": 0}
+
+    async def get(self, entry_id: str) -> Optional[Dict]:
+        summary = await state.get("voicemail_entry", entry_id)
+        if summary is None:
+            return None
+        record = {"pressed_key": "1", "recording_url": "", **summary}
+        for field, namespace in (("pressed_key", "voicemail_dtmf"), ("recording_url", "voicemail_recording")):
+            value = await state.get(namespace, entry_id)
+            if value is not None:
+                record[field] = value
+        return record
+
+    async def _pending(self) -> List[list]:
+        """[[entry_id, summary_at], ...] - звонки без письма, от старых к новым"""
+        now = time.time()
+        return [item for item in await state.get("voicemail_pending", "entries", []) if now - item[1] < VOICEMAIL_MATCH_WINDOW]
+
+    async def add_dtmf(self, entry_id: str, digit: str):
+        """Нажатая в IVR клавиша (приходит до summary)"""
+        await state.set("voicemail_dtmf", entry_id, digit, ttl=self.ttl)
+
+    async def add_summary(self, entry_id: str, from_number: str, call_duration: int) -> tuple:
+        """Завершённый звонок на голосовую почту → (данные звонка, id ожидающих писем)"""
+        summary = {"entry_id": entry_id, "from_number": normalize_phone(from_number) if from_number else "",
+                   "call_duration": call_duration, "summary_at": time.time()}
+        await state.set("voicemail_entry", entry_id, summary, ttl=self.ttl)
+        self.stats["summaries"] += 1
+
+        waiting = []
+        async with state_lock("voicemail"):
+            pending = [item for item in await self._pending() if item[0] != entry_id]
+            pending.append([entry_id, summary["summary_at"]])
+            await state.set("voicemail_pending", "entries", pending, ttl=self.ttl)
+
+            for key in ([f"phone:{summary['from_number']}"] if summary["from_number"] else []) + ["any"]:
+                waiting += await state.get("voicemail_waiting", key, [])
+                await state.delete("voicemail_waiting", key)
+        return await self.get(entry_id), waiting
+
+    async def set_recording(self, entry_id: str, recording_url: str):
+        await state.set("voicemail_recording", entry_id, recording_url, ttl=self.ttl)
+
+    async def claim(self, text: str, phones: List[str]) -> Optional[Dict]:
+        """
+        Забирает звонок для письма: entry_id в тексте → номер звонящего (последний звонок с него).
+        None - подходящего звонка пока нет
+        """
+        phones = [normalize_phone(phone) for phone in phones]
+        async with state_lock("voicemail"):
+            pending = await self._pending()
+            candidates = [(entry_id, "matched_entry") for entry_id, _ in pending if entry_id and entry_id in text]
+            if phones:
+                for entry_id, _ in reversed(pending):
+                    record = await state.get("voicemail_entry", entry_id)
+                    if record and record.get("from_number") in phones:
+                        candidates.append((entry_id, "matched_phone"))
+
+            for entry_id, how in candidates:
+                # Звонок уже забрало другое письмо (в т.ч. в другом воркере) - берём следующий
+                if not await state.add("voicemail_claimed", entry_id, int(time.time()), ttl=self.ttl):
+                    continue
+                await state.set("voicemail_pending", "entries", [item for item in pending if item[0] != entry_id],
+                          ttl=self.ttl)
+                self.stats[how] += 1
+                return await self.get(entry_id)
+        return None
+
+    async def wait_for_summary(self, job_id: int, phones: List[str]):
+        """Письмо ждёт summary: по номеру звонящего, а без номера - любой звонок (вдруг в тексте есть entry_id)"""
+        keys = [f"phone:{normalize_phone(phone)}" for phone in phones] or ["any"]
+        async with state_lock("voicemail"):
+            for key in keys:
+                waiting = await state.get("voicemail_waiting", key, [])
+                if job_id not in waiting:
+                    await state.set("voicemail_waiting", key, waiting + [job_id], ttl=VOICEMAIL_EMAIL_WAIT * 2)
+        self.stats["waiting"] += 1
+
+
+voicemail_store = VoicemailCorrelationStore(VOICEMAIL_RECORD_TTL)
+
+# ============================================================================
+# SESSION STORE - Хранилище диалогов с ограничением по размеру и времени жизни
+# ============================================================================
+
+SESSION_MAX_COUNT = int(os.getenv("SESSION_MAX_COUNT", "5000"))
+SESSION_IDLE_TTL = int(os.getenv("SESSION_IDLE_TTL", str(6 * 3600)))  # секунд без активности
+SESSION_MEMORY_BUDGET_MB = int(os.getenv("SESSION_MEMORY_BUDGET_MB", "256"))
+
+
+def estimate_message_size(message: Dict) -> int:
+    """Примерный размер сообщения в байтах"""
+    return len(json.dumps(message, ensure_ascii=False).encode("utf-8"))
+
+
+class ChatSession:
+    """
+    Состояние одного диалога.
+
+    Системный промпт в сессии не хранится - только имена подключённых модулей,
+    сам текст собирается из общих PROMPT_CORE/PROMPT_MODULES при отправке.
+    """
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.messages: List[Dict] = []
+        self.utm: Dict[str, str] = {}
+        self.prompt_modules: set = set()
+        self.prompt_context: str = ""  # Дополнительный контекст (например, данные звонящего)
+        self.created_at = time.time()
+        self.last_access = self.created_at
+        self.size = 0
+        self.synced_count = 0  # сколько сообщений уже было в backend при загрузке/сохранении
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "messages": self.messages,
+            "utm": self.utm,
+            "prompt_modules": sorted(self.prompt_modules),
+            "prompt_context": self.prompt_context,
+            "created_at": self.created_at
+        }
+
+    @classmethod
+    def from_dict(cls, session_id: str, data: Dict[str, Any]) -> "ChatSession":
+        session = cls(session_id)
+        session.messages = data.get("messages", [])
+        session.utm = data.get("utm", {})
+        session.prompt_modules = set(data.get("prompt_modules", []))
+        session.prompt_context = data.get("prompt_context", "")
+        session.created_at = data.get("created_at", session.created_at)
+        session.size = sum(estimate_message_size(m) for m in session.messages)
+        session.synced_count = len(session.messages)
+        return session
+
+
+class SessionStore:
+    """
+    LRU хранилище сессий чата
+
+    - max_sessions: лимит количества сессий (вытесняются давно неактивные)
+    - idle_ttl: сессия удаляется после idle_ttl секунд без обращений
+    - memory_budget: лимит суммарного размера сообщений в байтах
+
+    При общем state backend (SQLite/Redis) источник истины - backend: сессия
+    перечитывается на каждом get() и сохраняется после каждого изменения,
+    поэтому запросы одного диалога могут попадать в разные воркеры.
+    Локальный LRU тогда только ограничивает память процесса.
+    Методы, которые обращаются к backend, асинхронные (I/O - через StateStore).
+    """
+
+    def __init__(self, max_sessions: int, idle_ttl: int, memory_budget: int, backend=None):
+        self.backend = backend
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.memory_budget = memory_budget
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self.total_size = 0
+        self.evictions = {"lru": 0, "ttl": 0, "memory": 0}
+
+    @property
+    def shared(self) -> bool:
+        return self.backend is not None and self.backend.shared
+
+    async def exists(self, session_id: str) -> bool:
+        if self.shared:
+            return await self.backend.get("sessions", session_id) is not None
+        session = self._sessions.get(session_id)
+        return session is not None and not self._is_expired(session)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _is_expired(self, session: ChatSession) -> bool:
+        return time.time() - session.last_access > self.idle_ttl
+
+    def _remove(self, session_id: str, reason: str):
+        session = self._sessions.pop(session_id, None)
+        if session:
+            self.total_size -= session.size
+            self.evictions[reason] += 1
+
+    async def get(self, session_id: str) -> ChatSession:
+        """Возвращает сессию (создаёт новую, если её нет или она истекла)"""
+        if self.shared:
+            return await self._load_shared(session_id)
+
+        session = self._sessions.get(session_id)
+        if session is not None and self._is_expired(session):
+            self._remove(session_id, "ttl")
+            session = None
+
+        if session is None:
+            session = ChatSession(session_id)
+            self._sessions[session_id] = session
+            self._enforce_limits()
+        else:
+            self._sessions.move_to_end(session_id)
+
+        session.last_access = time.time()
+        return session
+
+    async def _load_shared(self, session_id: str) -> ChatSession:
+        """Читает актуальную версию сессии из backend и кладёт её в локальный LRU"""
+        data = await self.backend.get("sessions", session_id)
+        session = ChatSession.from_dict(session_id, data) if data else ChatSession(session_id)
+
+        old = self._sessions.pop(session_id, None)
+        if old:
+            self.total_size -= old.size
+        self._sessions[session_id] = session
+        self.total_size += session.size
+        self._enforce_limits()
+
+        if data is None:
+            await self.save(session)
+        return session
+
+    async def save(self, session: ChatSession):
+        """
+        Сохраняет сессию в backend (TTL продлевается при каждом изменении).
+        Перед записью сливается с версией в backend - изменения другого воркера не теряются
+        """
+        session.last_access = time.time()
+        if self.shared:
+            stored = await self.backend.get("sessions", session.session_id)
+            if stored:
+                self._merge_stored(session, stored)
+            await self.backend.set("sessions", session.session_id, session.to_dict(), ttl=self.idle_ttl)
+            session.synced_count = len(session.messages)
+
+    def _merge_stored(self, session: ChatSession, stored: Dict[str, Any]):
+        """Сообщения, дописанные в backend после нашей загрузки, идут перед нашими новыми"""
+        stored_messages = stored.get("messages", [])
+        if len(stored_messages) > session.synced_count:
+            old_size = session.size
+            session.messages = stored_messages + session.messages[session.synced_count:]
+            session.size = sum(estimate_message_size(m) for m in session.messages)
+            if self._sessions.get(session.session_id) is session:
+                self.total_size += session.size - old_size
+        session.prompt_modules |= set(stored.get("prompt_modules", []))
+        session.utm = session.utm or stored.get("utm", {})
+        session.prompt_context = session.prompt_context or stored.get("prompt_context", "")
+
+    async def append_message(self, session_id: str, message: Dict):
+        """Добавляет сообщение в историю сессии с учётом бюджета памяти"""
+        await self.append_messages(session_id, [message])
+
+    async def append_messages(self, session_id: str, messages: List[Dict]):
+        """Добавляет несколько сообщений одним сохранением (в истории они либо все, либо ни одного)"""
+        session = await self.get(session_id)
+        size = sum(estimate_message_size(message) for message in messages)
+        session.messages.extend(messages)
+        session.size += size
+        self.total_size += size
+        await self.save(session)
+        self._enforce_limits()
+
+    async def delete(self, session_id: str):
+        session = self._sessions.pop(session_id, None)
+        if session:
+            self.total_size -= session.size
+        if self.shared:
+            await self.backend.delete("sessions", session_id)
+
+    def evict_expired(self) -> int:
+        """Удаляет все сессии, неактивные дольше idle_ttl"""
+        expired = [sid for sid, session in self._sessions.items() if self._is_expired(session)]
+        for session_id in expired:
+            self._remove(session_id, "ttl")
+        return len(expired)
+
+    def _enforce_limits(self):
+        # Самые давние сессии - в начале OrderedDict. Текущую (последнюю) не трогаем.
+        while len(self._sessions) > self.max_sessions:
+            session_id = next(iter(self._sessions))
+            self._remove(session_id, "lru")
+
+        while self.total_size > self.memory_budget and len(self._sessions) > 1:
+            session_id = next(iter(self._sessions))
+            self._remove(session_id, "memory")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend.name if self.backend else "memory",
+            "sessions": len(self._sessions),
+            "max_sessions": self.max_sessions,
+            "idle_ttl": self.idle_ttl,
+            "memory_bytes": self.total_size,
+            "memory_budget_bytes": self.memory_budget,
+            "evictions": dict(self.evictions)
+        }
+
+
 # Storage for conversations
-conversations: Dict[str, List[Dict]] = {}
-# Хранилище UTM меток для каждой сессии
-session_utm: Dict[str, Dict[str, str]] = {}
+sessions = SessionStore(
+    max_sessions=SESSION_MAX_COUNT,
+    idle_ttl=SESSION_IDLE_TTL,
+    memory_budget=SESSION_MEMORY_BUDGET_MB * 1024 * 1024,
+    backend=state
+)
+
+
+async def session_cleanup_loop():
+    """Фоновая очистка истёкших сессий (чтобы неактивные не ждали вытеснения по LRU)"""
+    while True:
+        await asyncio.sleep(600)
+        try:
+            removed = sessions.evict_expired()
+            # Локальный LRU чистит каждый воркер, общий backend - один
+            if await hold_leadership("state_purge", 1800):
+                await state.purge_expired()
+            if removed:
+                print(f"🧹 [SESSIONS] Удалено истёкших сессий: {removed}, осталось: {len(sessions)}")
+        except Exception as e:
+            print(f"⚠️  [SESSIONS] Ошибка очистки сессий: {e}")
+
+# ============================================================================
+# KNOWLEDGE BASE - Поиск по smit_qna.json (BM25)
+# ============================================================================
+
+KB_FILE = os.path.join(os.path.dirname(__file__), "smit_qna.json")
+KB_MIN_CONFIDENCE = float(os.getenv("KB_MIN_CONFIDENCE", "0.2"))
+KB_RELOAD_CHECK_INTERVAL = 5  # секунд между проверками mtime файла
+
+# Служебные слова, которые не несут смысла для поиска.
+# "нет" сюда не входит: в "нет интернета", "нет связи" это и есть суть обращения
+RU_STOPWORDS = {
+    "и", "в", "во", "не", "на", "с", "со", "что", "как", "а", "то", "все", "всё", "она", "он", "они", "мы", "вы",
+    "я", "у", "к", "ко", "по", "за", "из", "от", "до", "о", "об", "же", "ли", "бы", "но", "да", "или",
+    "это", "мне", "меня", "мой", "моя", "мои", "вас", "вам", "ваш", "есть", "если", "для", "так", "уже", "ну",
+    "можно", "ещё", "еще", "там", "тут", "при", "без", "чтобы", "какой", "какая", "какие", "почему", "когда",
+    "где", "здравствуйте", "пожалуйста", "подскажите", "скажите", "хочу", "хотел", "хотела"
+}
+
+# Окончания и словообразовательные суффиксы для лёгкого стемминга (длинные проверяются первыми)
+RU_ENDINGS = sorted([
+    "ениями", "ениях", "ением", "ение", "ения", "ению", "ении", "ений",
+    "аниями", "аниях", "анием", "ание", "ания", "анию", "ании", "аний",
+    "остями", "остью", "ость", "ости", "остей",
+    "ировать", "ировал", "ирует", "ируют",
+    "иться", "аться", "яться", "еться", "ится", "ается", "яется", "ется",
+    "ться", "тся", "ить", "ать", "ять", "еть", "уть", "ти",
+    "или", "ила", "ило", "ал", "ял", "ил", "ел", "ла", "ло", "ли",
+    "ешь", "ете", "ите", "ишь", "ает", "яет", "ует", "ют", "ут", "ат", "ят", "ит", "ет",
+    "иями", "ями", "ами", "иях", "иям", "ием", "ией",
+    "ого", "его", "ому", "ему", "ыми", "ими", "ее", "ие", "ые", "ое", "ей", "ий", "ый", "ой",
+    "ем", "им", "ым", "ом", "их", "ых", "ую", "юю", "ая", "яя", "ою", "ею",
+    "ах", "ях", "ам", "ям", "ов", "ев", "ию", "ью", "ия", "ья",
+    "а", "я", "о", "е", "и", "ы", "у", "ю", "ь", "й"
+], key=len, reverse=True)
+
+
+# Разговорные формы → слова, которые используются в базе знаний
+KB_SYNONYMS = {
+    "инет": "интернет", "инета": "интернет", "инету": "интернет", "интернета": "интернет",
+    "вайфай": "wifi", "вай": "wifi", "wi": "wifi", "вафля": "wifi",
+    "тормозит": "медленно", "тупит": "медленно", "лагает": "медленно", "виснет": "медленно",
+    "заплатить": "оплатить", "положить": "оплатить", "пополнить": "оплатить", "закинуть": "оплатить",
+    "деньги": "баланс", "денег": "баланс", "счету": "баланс", "счете": "баланс",
+    "роутер": "оборудование", "роутера": "оборудование", "маршрутизатор": "оборудование",
+    "саппорт": "техподдержка", "поддержка": "техподдержка", "поддержкой": "техподдержка",
+}
+
+
+def normalize_kb_text(text: str) -> str:
+    """Нижний регистр, ё → е, без пунктуации, разговорные формы приведены к словам базы"""
+    text = (text or "").lower().replace("ё", "е")
+    return " ".join(KB_SYNONYMS.get(word, word) for word in re.findall(r"[a-zа-я0-9]+", text))
+
+
+def stem_ru(word: str) -> str:
+    """
+    Лёгкий стеммер: до двух раз отрезает окончание, оставляя основу не короче 3 букв.
+
+    Второй проход выравнивает формы вроде "интернет"/"интернету" и "оборудование"/"оборудования".
+    """
+    if not re.match(r"[а-я]", word):
+        return word
+    for _ in range(2):
+        for ending in RU_ENDINGS:
+            if word.endswith(ending) and len(word) - len(ending) >= 3:
+                word = word[:-len(ending)]
+                break
+        else:
+            break
+    return word
+
+
+def tokenize_kb(text: str) -> List[str]:
+    """Нормализует текст и возвращает основы слов без стоп-слов"""
+    return [stem_ru(word) for word in normalize_kb_text(text).split() if word not in RU_STOPWORDS]
+
+
+class KnowledgeBaseIndex:
+    """
+    Инвертированный индекс по базе знаний с ранжированием BM25.
+
+    Индексируются вопрос и ответ, вопрос учитывается с весом QUESTION_WEIGHT.
+    При изменении файла (mtime) индекс перестраивается, токены неизменившихся
+    записей берутся из кэша, поэтому перестройка дешёвая даже на тысячах статей.
+    """
+
+    K1 = 1.5
+    B = 0.75
+    QUESTION_WEIGHT = 3
+
+    def __init__(self, path: str):
+        self.path = path
+        self.items: List[Dict] = []
+        self.mtime = 0.0
+        self._last_check = 0.0
+        self._doc_cache: Dict[tuple, Dict[str, int]] = {}  # {(question, answer): {term: tf}}
+        self._postings: Dict[str, Dict[int, int]] = {}      # {term: {doc: tf}}
+        self._doc_len: List[int] = []
+        self._avg_len = 0.0
+        self._idf: Dict[str, float] = {}
+        self._questions_norm: List[str] = []
+        self._questions_terms: List[set] = []
+        self.fingerprint = ""
+
+    def _doc_terms(self, item: Dict) -> Dict[str, int]:
+        key = (item.get("question", ""), item.get("answer", ""))
+        terms = self._doc_cache.get(key)
+        if terms is None:
+            terms = {}
+            for term in tokenize_kb(key[0]):
+                terms[term] = terms.get(term, 0) + self.QUESTION_WEIGHT
+            for term in tokenize_kb(key[1]):
+                terms[term] = terms.get(term, 0) + 1
+            self._doc_cache[key] = terms
+        return terms
+
+    def build(self, items: List[Dict]):
+        """Строит индекс по списку записей {id, question, answer}"""
+        postings: Dict[str, Dict[int, int]] = {}
+        doc_len = []
+        used_keys = set()
+
+        for doc_id, item in enumerate(items):
+            terms = self._doc_terms(item)
+            used_keys.add((item.get("question", ""), item.get("answer", "")))
+            doc_len.append(sum(terms.values()))
+            for term, tf in terms.items():
+                postings.setdefault(term, {})[doc_id] = tf
+
+        # Удалённые из базы записи не держим в кэше
+        self._doc_cache = {key: terms for key, terms in self._doc_cache.items() if key in used_keys}
+
+        n = len(items)
+        self.items = items
+        self._postings = postings
+        self._doc_len = doc_len
+        self._avg_len = (sum(doc_len) / n) if n else 0.0
+        self._idf = {
+            term: math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            for term, docs in postings.items()
+        }
+        self._questions_norm = [normalize_kb_text(item.get("question", "")) for item in items]
+        self._questions_terms = [set(tokenize_kb(item.get("question", ""))) for item in items]
+        self.fingerprint = hashlib.sha1(json.dumps(items, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def load(self) -> bool:
+        """Загружает файл базы знаний и перестраивает индекс"""
+        try:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, "r", encoding="utf-8") as f:
+                items = json.load(f).get("qna", [])
+            self.build(items)
+            self.mtime = mtime
+            print(f"✅ Загружено {len(items)} вопросов-ответов из базы знаний ({len(self._postings)} терминов в индексе)")
+            return True
+        except Exception as e:
+            print(f"⚠️  Не удалось загрузить {os.path.basename(self.path)}: {e}")
+            return False
+
+    def reload_if_changed(self):
+        """Перечитывает файл, если он изменился (проверка не чаще KB_RELOAD_CHECK_INTERVAL)"""
+        now = time.time()
+        if now - self._last_check < KB_RELOAD_CHECK_INTERVAL:
+            return
+        self._last_check = now
+        try:
+            if os.path.getmtime(self.path) != self.mtime:
+                print("🔄 База знаний изменилась, обновляю индекс...")
+                self.load()
+        except OSError:
+            pass
+
+    def search(self, query: str, top_k: int = 3, min_confidence: float = KB_MIN_CONFIDENCE) -> List[Dict]:
+        """
+        Поиск по базе знаний
+
+        Returns:
+            Список до top_k результатов {item, doc_id, score, confidence} по убыванию score.
+            confidence (0..1) - доля максимально возможного BM25 для этого запроса.
+        """
+        self.reload_if_changed()
+
+        query_terms = list(dict.fromkeys(tokenize_kb(query)))
+        if not query_terms or not self.items:
+            return []
+
+        scores: Dict[int, float] = {}
+        max_score = 0.0
+        for term in query_terms:
+            idf = self._idf.get(term)
+            if idf is None:
+                continue
+            max_score += idf * (self.K1 + 1)
+            for doc_id, tf in self._postings[term].items():
+                norm = self.K1 * (1 - self.B + self.B * self._doc_len[doc_id] / self._avg_len)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.K1 + 1) / (tf + norm)
+
+        if not scores:
+            return []
+
+        # Запрос совпадает с вопросом (или содержит его) - уверенный ответ. Только если вложенный текст
+        # сам по себе содержателен (от двух терминов) и покрывает хотя бы половину терминов другого -
+        # иначе короткий запрос "тариф" получал бы 1.0 на любом вопросе со словом "тариф"
+        query_norm = normalize_kb_text(query)
+        query_term_set = set(query_terms)
+        results = []
+        for doc_id, score in scores.items():
+            confidence = min(score / max_score, 1.0)
+            question_norm = self._questions_norm[doc_id]
+            if question_norm and (question_norm in query_norm or query_norm in question_norm):
+                inner, outer = sorted((query_term_set, self._questions_terms[doc_id]), key=len)
+                if len(inner) >= 2 and len(inner & outer) * 2 >= len(outer):
+                    confidence = 1.0
+            if confidence >= min_confidence:
+                results.append({
+                    "item": self.items[doc_id],
+                    "doc_id": doc_id,
+                    "score": round(score, 3),
+                    "confidence": round(confidence, 3)
+                })
+
+        results.sort(key=lambda r: (r["confidence"], r["score"]), reverse=True)
+        return results[:top_k]
+
+
+kb_index = KnowledgeBaseIndex(KB_FILE)
+kb_index.load()
+
+
+# ==================== ВЕКТОРНЫЙ ПОИСК ПО БАЗЕ ЗНАНИЙ ====================
+# Хэшированные символьные n-граммы: ловят перефразировки и сокращения
+# ("нет инета" ~ "не работает интернет"), не требуя модели эмбеддингов.
+# Матрица строится заранее (python server.py build-kb-index) и при старте читается через mmap;
+# если файла нет или он устарел, воркер строит матрицу в памяти, ничего не записывая.
 
-# Load knowledge base from smit_qna.json
-KB_DATA = []
 try:
-    kb_path = os.path.join(os.path.dirname(__file__), "smit_qna.json")
-    with open(kb_path, "r", encoding="utf-8") as f:
-        kb_json = json.load(f)
-        KB_DATA = kb_json.get("qna", [])
-    print(f"✅ Загружено {len(KB_DATA)} вопросов-ответов из базы знаний")
-except Exception as e:
-    print(f"⚠️  Не удалось загрузить smit_qna.json: {e}")
+    import numpy as np
+except ImportError:
+    np = None
+    print("⚠️  numpy не установлен - векторный поиск по базе знаний отключен")
+
+KB_VECTORS_FILE = os.path.join(os.path.dirname(__file__), "smit_qna.vectors.npy")
+KB_VECTORS_META_FILE = os.path.join(os.path.dirname(__file__), "smit_qna.vectors.json")
+KB_VECTOR_DIM = int(os.getenv("KB_VECTOR_DIM", "4096"))
+KB_HYBRID_ALPHA = float(os.getenv("KB_HYBRID_ALPHA", "0.5"))  # вес векторного скора в гибридном
+KB_NGRAM_RANGE = (3, 5)
+
+
+def kb_text_features(text: str) -> Dict[int, float]:
+    """Разреженный вектор {индекс: вес} из символьных n-грамм и основ слов"""
+    features: Dict[int, float] = {}
+    words = normalize_kb_text(text).split()
+
+    for word in words:
+        if word in RU_STOPWORDS:
+            continue
+        padded = f" {word} "
+        for n in range(KB_NGRAM_RANGE[0], KB_NGRAM_RANGE[1] + 1):
+            for i in range(len(padded) - n + 1):
+                index = zlib.crc32(padded[i:i + n].encode("utf-8")) % KB_VECTOR_DIM
+                features[index] = features.get(index, 0.0) + 1.0
+        # Основа слова целиком - более сильный признак, чем отдельная n-грамма
+        index = zlib.crc32(("w:" + stem_ru(word)).encode("utf-8")) % KB_VECTOR_DIM
+        features[index] = features.get(index, 0.0) + 2.0
+
+    # Сублинейный tf, чтобы длинные ответы не перевешивали
+    return {index: 1.0 + math.log(tf) for index, tf in features.items()}
+
+
+def kb_vectorize(texts: List[str], weights: List[float] = None):
+    """Матрица L2-нормированных векторов (len(texts) x KB_VECTOR_DIM, float32)"""
+    matrix = np.zeros((len(texts), KB_VECTOR_DIM), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for index, value in kb_text_features(text).items():
+            matrix[row, index] += value * (weights[row] if weights else 1.0)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class KnowledgeBaseVectors:
+    """
+    Плотный индекс базы знаний: матрица документов в .npy (mmap) + метаданные.
+
+    Вектор документа = нормированная сумма вектора вопроса (с весом QUESTION_WEIGHT) и ответа.
+    Если не совпадает отпечаток базы знаний или размерность, сервер строит индекс в памяти;
+    на диск его пишет только build-kb-index.
+    """
+
+    QUESTION_WEIGHT = 2.0
+
+    def __init__(self, vectors_path: str, meta_path: str):
+        self.vectors_path = vectors_path
+        self.meta_path = meta_path
+        self.matrix = None
+        self.fingerprint = None
+
+    def build(self, items: List[Dict], fingerprint: str, save: bool = False):
+        """Строит матрицу по записям базы знаний и (опционально) сохраняет на диск"""
+        questions = kb_vectorize([item.get("question", "") for item in items])
+        answers = kb_vectorize([item.get("answer", "") for item in items])
+        matrix = questions * self.QUESTION_WEIGHT + answers
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        matrix = (matrix / norms).astype(np.float32)
+
+        if save:
+            try:
+                # Временные файлы - свои у каждого процесса, замена атомарная
+                tmp_path = f"{self.vectors_path}.{os.getpid()}.tmp.npy"
+                np.save(tmp_path, matrix)
+                os.replace(tmp_path, self.vectors_path)
+                tmp_meta = f"{self.meta_path}.{os.getpid()}.tmp"
+                with open(tmp_meta, "w", encoding="utf-8") as f:
+                    json.dump({
+                        "fingerprint": fingerprint,
+                        "dim": KB_VECTOR_DIM,
+                        "count": len(items),
+                        "built_at": datetime.now().isoformat()
+                    }, f, ensure_ascii=False, indent=2)
+                os.replace(tmp_meta, self.meta_path)
+                matrix = np.load(self.vectors_path, mmap_mode="r")
+            except Exception as e:
+                print(f"⚠️  Не удалось сохранить векторный индекс: {e}")
+
+        self.matrix = matrix
+        self.fingerprint = fingerprint
+        print(f"✅ Векторный индекс базы знаний построен: {len(items)} x {KB_VECTOR_DIM}")
+
+    def load(self, items: List[Dict], fingerprint: str):
+        """Открывает готовый индекс через mmap или строит в памяти, если он устарел"""
+        if np is None:
+            return
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("fingerprint") == fingerprint and meta.get("dim") == KB_VECTOR_DIM:
+                self.matrix = np.load(self.vectors_path, mmap_mode="r")
+                self.fingerprint = fingerprint
+                print(f"✅ Векторный индекс базы знаний загружен ({meta.get('count')} x {KB_VECTOR_DIM}, mmap)")
+                return
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"⚠️  Ошибка чтения векторного индекса: {e}")
+
+        print("ℹ️  Векторный индекс на диске отсутствует или устарел (python server.py build-kb-index)")
+        self.build(items, fingerprint)
+
+    def search_batch(self, queries: List[str], top_k: int = 3) -> List[List[tuple]]:
+        """Косинусный top-k для пачки запросов одним матричным умножением: [[(doc_id, cosine), ...], ...]"""
+        if np is None or self.matrix is None or not len(self.matrix) or not queries:
+            return [[] for _ in queries]
+
+        scores = kb_vectorize(queries) @ np.asarray(self.matrix).T  # (queries x docs)
+        k = min(top_k, scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+
+        results = []
+        for row, doc_ids in enumerate(top):
+            ranked = sorted(doc_ids, key=lambda d: -scores[row, d])
+            results.append([(int(d), float(scores[row, d])) for d in ranked if scores[row, d] > 0])
+        return results
+
+
+kb_vectors = KnowledgeBaseVectors(KB_VECTORS_FILE, KB_VECTORS_META_FILE)  # загружается в startup_event
+
+
+def search_kb_hybrid(query: str, top_k: int = 3, min_confidence: float = KB_MIN_CONFIDENCE) -> List[Dict]:
+    """
+    Гибридный поиск: BM25 confidence и косинус векторов смешиваются с весом KB_HYBRID_ALPHA.
+
+    Без numpy возвращает результаты чистого BM25.
+    """
+    lexical = kb_index.search(query, top_k=top_k * 3, min_confidence=0.0)
+    if np is None or kb_vectors.matrix is None:
+        return [r for r in lexical if r["confidence"] >= min_confidence][:top_k]
+
+    # Индекс мог устареть после перезагрузки базы знаний
+    if kb_vectors.fingerprint != kb_index.fingerprint:
+        kb_vectors.build(kb_index.items, kb_index.fingerprint)
+
+    dense = kb_vectors.search_batch([query], top_k=top_k * 3)[0]
+
+    combined: Dict[int, Dict[str, float]] = {}
+    for r in lexical:
+        combined.setdefault(r["doc_id"], {"lexical": 0.0, "vector": 0.0})["lexical"] = r["confidence"]
+    for doc_id, cosine in dense:
+        combined.setdefault(doc_id, {"lexical": 0.0, "vector": 0.0})["vector"] = cosine
+
+    results = []
+    for doc_id, parts in combined.items():
+        confidence = KB_HYBRID_ALPHA * parts["vector"] + (1 - KB_HYBRID_ALPHA) * parts["lexical"]
+        # Точное совпадение с вопросом (lexical = 1.0) не должно теряться из-за смешивания
+        if parts["lexical"] >= 1.0:
+            confidence = 1.0
+        if confidence >= min_confidence:
+            results.append({
+                "item": kb_index.items[doc_id],
+                "doc_id": doc_id,
+                "confidence": round(confidence, 3),
+                "lexical": parts["lexical"],
+                "vector": round(parts["vector"], 3)
+            })
+
+    results.sort(key=lambda r: r["confidence"], reverse=True)
+    return results[:top_k]
 
 # ============================================================================
 # TARIFFS CACHE - Кэширование тарифов
@@ -149,8 +1313,11 @@ def save_tariffs_cache(tariffs: List[Dict]):
             "is_valid": True
         }
 
-        with open(TARIFFS_CACHE_FILE, "w", encoding="utf-8") as f:
+        # Пишем во временный файл и подменяем - читатель не увидит недописанный JSON
+        tmp_path = f"{TARIFFS_CACHE_FILE}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
             json.dump(tariffs_cache, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, TARIFFS_CACHE_FILE)
 
         print(f"✅ Сохранено {len(tariffs)} тарифов в кэш")
         return True
@@ -209,8 +1376,11 @@ def save_addons_cache(addons: List[Dict]):
             "is_valid": True
         }
 
-        with open(ADDONS_CACHE_FILE, "w", encoding="utf-8") as f:
+        # Пишем во временный файл и подменяем - читатель не увидит недописанный JSON
+        tmp_path = f"{ADDONS_CACHE_FILE}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
             json.dump(addons_cache, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, ADDONS_CACHE_FILE)
 
         print(f"✅ Сохранено {len(addons)} доп. услуг в кэш")
         return True
@@ -218,22 +1388,6 @@ def save_addons_cache(addons: List[Dict]):
         print(f"⚠️  Ошибка сохранения кэша доп. услуг: {e}")
         return False
 
-def is_addons_cache_valid() -> bool:
-    """Проверяет валидность кэша дополнительных услуг"""
-    if not addons_cache.get("is_valid") or not addons_cache.get("addons"):
-        return False
-
-    updated_at = addons_cache.get("updated_at")
-    if not updated_at:
-        return False
-
-    try:
-        updated = datetime.fromisoformat(updated_at)
-        age = datetime.now() - updated
-        return age.days < ADDONS_CACHE_VALIDITY_DAYS
-    except:
-        return False
-
 # Загружаем кэш при старте
 load_addons_cache()
 
@@ -257,8 +1411,6 @@ except Exception as e:
     yandex_tts = None
     mango_client = None
 
-# Хранилище активных звонков
-active_calls: Dict[str, Dict] = {}
 
 
 
@@ -300,19 +1452,23 @@ def normalize_phone(phone: str) -> str:
 
     return s
 
-async def fetch_billing_by_phone(phone: str) -> Dict[str, Any]:
-    """Получает информацию из биллинга по номеру телефона"""
-    phone = normalize_phone(phone)
+async def _request_billing_by_phone(phone: str) -> tuple:
+    """
+    Запрос phone.php без кэша.
+
+    Returns:
+        (result, cacheable) - cacheable=False для ошибок сети/биллинга
+    """
     url = f"{BILLING_BASE}/phone.php?phone={phone}"
 
-    async with httpx.AsyncClient(timeout=30.0, follow_redirects=True) as client:
+    async with upstream_client("billing") as client:
         try:
             resp = await client.get(url)
             resp.raise_for_status()
             data = resp.json()
 
             if not data or "error" in data or "client" not in data:
-                return {"success": False, "message": f"Клиент с телефоном {phone} не найден в биллинге"}
+                return {"success": False, "message": f"Клиент с телефоном {phone} не найден в биллинге"}, True
 
             client = data.get("client", {})
             fullname = client.get("fullname", "")
@@ -333,47 +1489,119 @@ async def fetch_billing_by_phone(phone: str) -> Dict[str, Any]:
                 "tariff": tariff,
                 "address": "",  # Hidden for privacy
                 "message": f"👤 {first_name}\n📄 Договор: {contract}\n💰 Баланс: {balance} руб.\n📦 Тариф: {tariff}"
-            }
+            }, True
 
         except Exception as e:
-            return {"success": False, "message": f"Ошибка при запросе к биллингу: {str(e)}"}
+            return {"success": False, "message": f"Ошибка при запросе к биллингу: {str(e)}"}, False
 
 
-async def get_addons_gas() -> Dict[str, Any]:
-    """Получает список дополнительных услуг (из кэша или API)"""
+# ==================== КЭШ БИЛЛИНГА ====================
+# Один и тот же номер часто запрашивают почти одновременно (чат, приветствие звонка,
+# FreeScout webhook). Параллельные запросы по номеру объединяются в один,
+# результат кэшируется ненадолго - баланс должен оставаться актуальным.
 
-    # Если кэш валидный - возвращаем из кэша
-    if is_addons_cache_valid():
-        return {
-            "success": True,
-            "addons": addons_cache["addons"],
-            "from_cache": True
-        }
+BILLING_CACHE_TTL = int(os.getenv("BILLING_CACHE_TTL", "120"))                   # клиент найден
+BILLING_NEGATIVE_CACHE_TTL = int(os.getenv("BILLING_NEGATIVE_CACHE_TTL", "60"))  # клиент не найден
 
-    # Иначе обновляем кэш
-    result = await update_addons_from_api()
+billing_inflight: Dict[str, asyncio.Future] = {}
+billing_stats = {"lookups": 0, "cache_hits": 0, "coalesced": 0, "upstream_requests": 0}
 
-    if result["success"]:
-        return {
-            "success": True,
-            "addons": result["addons"],
-            "from_cache": False
-        }
 
-    # Если не удалось обновить, но есть старый кэш - используем его
-    if addons_cache.get("addons"):
-        print("⚠️  Используется устаревший кэш дополнительных услуг")
-        return {
-            "success": True,
-            "addons": addons_cache["addons"],
-            "from_cache": True,
-            "warning": "Данные могли устареть"
-        }
+async def invalidate_billing_cache(phone: str = "", contract: str = ""):
+    """Сбрасывает кэш биллинга по телефону и/или договору (после изменения баланса)"""
+    phones = set()
+    if phone:
+        phones.add(normalize_phone(phone))
+    if contract:
+        phones.update(await state.get("billing_contract", str(contract), []))
+        await state.delete("billing_contract", str(contract))
 
-    return {
-        "success": False,
-        "message": "Не удалось загрузить дополнительные услуги"
-    }
+    for cached_phone in phones:
+        await state.delete("billing", cached_phone)
+    if phones:
+        print(f"🧹 [BILLING] Кэш сброшен: {', '.join(sorted(phones))}")
+
+
+async def fetch_billing_by_phone(phone: str) -> Dict[str, Any]:
+    """Получает информацию из биллинга по номеру телефона"""
+    phone = normalize_phone(phone)
+    billing_stats["lookups"] += 1
+
+    cached = await state.get("billing", phone)
+    if cached is not None:
+        billing_stats["cache_hits"] += 1
+        return cached
+
+    # Запрос по этому номеру уже выполняется - ждём его результат
+    inflight = billing_inflight.get(phone)
+    if inflight is not None:
+        billing_stats["coalesced"] += 1
+        return await asyncio.shield(inflight)
+
+    future = asyncio.get_running_loop().create_future()
+    billing_inflight[phone] = future
+    try:
+        billing_stats["upstream_requests"] += 1
+        result, cacheable = await _request_billing_by_phone(phone)
+
+        if cacheable:
+            ttl = BILLING_CACHE_TTL if result.get("success") else BILLING_NEGATIVE_CACHE_TTL
+            await state.set("billing", phone, result, ttl=ttl)
+            if result.get("contract"):
+                contract = str(result["contract"])
+                phones = await state.get("billing_contract", contract, [])
+                if phone not in phones:
+                    await state.set("billing_contract", contract, phones + [phone], ttl=BILLING_CACHE_TTL)
+
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        # Ожидающие получают ту же ошибку (или отмену), а не зависают
+        if isinstance(e, asyncio.CancelledError):
+            future.cancel()
+        else:
+            future.set_exception(e)
+            future.exception()  # помечаем как полученное, иначе asyncio пишет предупреждение
+        raise
+    finally:
+        billing_inflight.pop(phone, None)
+
+
+async def get_addons_gas() -> Dict[str, Any]:
+    """Получает список дополнительных услуг (из кэша, обновление - в фоне)"""
+
+    # Есть кэш (даже устаревший) - отвечаем сразу, устаревший обновится в фоне
+    if addons_cache.get("addons"):
+        if addons_refresher.is_stale():
+            addons_refresher.request_refresh()
+            return {
+                "success": True,
+                "addons": addons_cache["addons"],
+                "from_cache": True,
+                "warning": "Данные могли устареть"
+            }
+        return {
+            "success": True,
+            "addons": addons_cache["addons"],
+            "from_cache": True
+        }
+
+    # Кэша нет совсем - ждём обновление (общее для всех параллельных запросов), но не во время backoff
+    if addons_refresher.in_backoff():
+        return {"success": False, "message": "Не удалось загрузить дополнительные услуги"}
+    result = await addons_refresher.refresh_now()
+
+    if result["success"]:
+        return {
+            "success": True,
+            "addons": result["addons"],
+            "from_cache": False
+        }
+
+    return {
+        "success": False,
+        "message": "Не удалось загрузить дополнительные услуги"
+    }
 
 
 async def update_addons_from_api() -> Dict[str, Any]:
@@ -381,23 +1609,15 @@ async def update_addons_from_api() -> Dict[str, Any]:
     url = f"{GAS_BASE}?action=get_addons"
 
     try:
-        async with httpx.AsyncClient(timeout=15.0, follow_redirects=True) as client:
-            response = await client.get(url)
+        async with upstream_client("gas") as client:
+            response = await client.get(url, timeout=15.0)
 
             if response.status_code == 200:
                 data = response.json()
 
                 if data.get("ok") and data.get("addons"):
-                    # Обновляем кэш
-                    from datetime import datetime
-                    addons_cache["addons"] = data["addons"]
-                    addons_cache["updated_at"] = datetime.now().isoformat()
-                    addons_cache["is_valid"] = True
-
-                    # Сохраняем в файл
-                    import json
-                    with open("addons_cache.json", "w", encoding="utf-8") as f:
-                        json.dump(addons_cache, f, ensure_ascii=False, indent=2)
+                    # Новый кэш подменяется целиком (атомарно для читателей)
+                    save_addons_cache(data["addons"])
 
                     print(f"✅ Кэш дополнительных услуг обновлен: {len(data['addons'])} шт.")
 
@@ -588,154 +1808,464 @@ async def offer_cctv() -> Dict[str, Any]:
 
 
 
-async def check_address_gas(address: str) -> Dict[str, Any]:
-    """Проверяет возможность подключения по адресу через Google Sheets"""
-    url = GAS_BASE
+# ============================================================================
+# ADDRESS CHECK - Проверка покрытия с кэшем и локальным индексом
+# ============================================================================
 
-    # Очищаем адрес от номера дома
+ADDRESS_CACHE_TTL = int(os.getenv("ADDRESS_CACHE_TTL", str(24 * 3600)))          # адрес найден
+ADDRESS_NEGATIVE_CACHE_TTL = int(os.getenv("ADDRESS_NEGATIVE_CACHE_TTL", "3600"))  # адрес не найден
+# Действие GAS, отдающее весь лист покрытия ({"ok": true, "addresses": [...]}). Пусто = локальный индекс выключен
+ADDRESS_COVERAGE_ACTION = os.getenv("ADDRESS_COVERAGE_ACTION", "")
+ADDRESS_COVERAGE_SYNC_INTERVAL = int(os.getenv("ADDRESS_COVERAGE_SYNC_INTERVAL", str(6 * 3600)))
+COVERAGE_CACHE_FILE = os.path.join(os.path.dirname(__file__), "coverage_cache.json")
+
+STREET_MARKERS = ['ул.', 'ул', 'улица', 'д.', 'дом']
+
+address_stats = {"local_hits": 0, "cache_hits": 0, "negative_cache_hits": 0, "gas_requests": 0, "gas_errors": 0}
+
+
+def clean_address_street(address: str) -> str:
+    """Убирает номер дома: "Волгоград, ул. Динамовская, д. 35" -> "Волгоград, ул. Динамовская" """
     clean_addr = re.sub(r',?\s*д\.?\s*\d+.*$', '', address, flags=re.IGNORECASE)
     clean_addr = re.sub(r',?\s*дом\s*\d+.*$', '', clean_addr, flags=re.IGNORECASE)
     clean_addr = re.sub(r',\s*\d+[А-Яа-яA-Za-z]?$', '', clean_addr, flags=re.IGNORECASE)
     # Убираем номер вида Динамовская 35 (пробел + цифры/буквы в конце)
     clean_addr = re.sub(r'\s+\d+[А-Яа-яA-Za-z]?$', '', clean_addr, flags=re.IGNORECASE)
+    return clean_addr
 
-    async def try_search(search_addr: str) -> tuple[bool, dict]:
-        """Выполняет поиск адреса и возвращает (успех, данные)"""
-        async with httpx.AsyncClient(timeout=30.0, follow_redirects=True) as client:
-            try:
-                resp = await client.post(url, json={"path": "check_address", "address": search_addr})
-                resp.raise_for_status()
-                data = resp.json()
-
-                if not (data.get("ok") and data.get("found")):
-                    return False, {}
-
-                tech = data.get("technology", "FTTB")
-                full_addr = data.get("address_full", address)
-                standard_price = data.get("standard_connection_price_rub", 0)
-                promo_price = data.get("promo_price_rub", 0)
-
-                # ПРОВЕРКА СООТВЕТСТВИЯ НАСЕЛЁННОГО ПУНКТА
-                client_city = address.split(',')[0].strip().lower() if ',' in address else address.strip().lower()
-
-                # Извлекаем все части адреса API (сохраняем регистр для поиска улицы)
-                api_parts = [part.strip() for part in full_addr.split(',')]
-                api_parts_lower = [part.lower() for part in api_parts]
-
-                # Находим ПОСЛЕДНИЙ населённый пункт перед улицей (фактическое место проживания)
-                actual_city = None
-                street_index = None
-                for i, part_lower in enumerate(api_parts_lower):
-                    # Если нашли улицу - запоминаем индекс и берём предыдущую часть
-                    if any(word in part_lower for word in ['ул.', 'ул', 'улица', 'д.', 'дом']):
-                        street_index = i
-                        # Ищем последний непустой населённый пункт перед улицей
-                        if i > 0:
-                            for j in range(i-1, -1, -1):
-                                prev = api_parts_lower[j]
-                                # Пропускаем область и район
-                                if 'область' not in prev and 'район' not in prev and prev:
-                                    actual_city = prev
-                                    break
+
+def normalize_street_name(street: str) -> str:
+    """Название улицы без префикса и пунктуации: "ул. Динамовская" -> "динамовская" """
+    street = street.lower().replace("ё", "е")
+    street = re.sub(r'^\s*(ул\.?|улица)\s*', '', street)
+    return " ".join(re.findall(r"[a-zа-я0-9]+", street))
+
+
+# Типы улиц, которые различаются при проверке: "проспект Ленина" и "улица Ленина" - разные адреса
+STREET_TYPES = {
+    "улица": r"ул\.?|улица",
+    "проспект": r"пр-к?т\.?|пр\.|просп\.?|проспект",
+}
+# Как тип пишется в вариантах запроса к GAS: (шаблон варианта, префикс)
+STREET_TYPE_SPELLINGS = {
+    "улица": [("with_ulitsa", "улица"), ("with_ul", "ул.")],
+    "проспект": [("with_prospekt", "проспект")],
+}
+
+
+def strip_street_type(street: str) -> tuple:
+    """Тип улицы и улица без него: "пр-т Ленина" -> ("проспект", "Ленина"). Тип None - не указан"""
+    street = street.strip()
+    for street_type, pattern in STREET_TYPES.items():
+        match = (re.match(rf'^(?:{pattern})(?:\s+|(?<=\.))', street, flags=re.IGNORECASE)
+                 or re.search(rf'\s(?:{pattern})$', street, flags=re.IGNORECASE))
+        if match:
+            return street_type, (street[match.end():] if match.start() == 0 else street[:match.start()]).strip()
+    return None, street
+
+
+def split_street_type(street: str) -> tuple:
+    """
+    Тип и название улицы: "пр-т Ленина" -> ("проспект", "ленина"), "Ленина ул." -> ("улица", "ленина").
+    Тип None - не указан
+    """
+    street_type, bare_street = strip_street_type(street)
+    return street_type, " ".join(re.findall(r"[a-zа-я0-9]+", bare_street.lower().replace("ё", "е")))
+
+
+def street_type_matches(full_addr: str, street_type: str, name: str) -> bool:
+    """В адресе GAS есть улица name именно типа street_type (улица с тем же названием другого типа - нет)"""
+    for part in full_addr.split(','):
+        part_type, part_name = split_street_type(part)
+        if part_type is not None and part_name == name:
+            return part_type == street_type
+    return False
+
+
+def address_client_city(address: str) -> str:
+    """Населённый пункт из запроса клиента (первая часть до запятой) - как его сверяет _match_address_result"""
+    return address.split(',')[0].strip().lower() if ',' in address else address.strip().lower()
+
+
+def normalize_address_key(address: str) -> str:
+    """
+    Ключ кэша: адрес без дома, регистра, ё и пунктуации, тип улицы - в общем написании.
+    Населённый пункт и тип улицы входят в ключ в том виде, в каком их сверяет проверка, -
+    адреса, которые проверяются по-разному, не делят один результат
+    """
+    clean_addr = clean_address_street(address)
+    street_type, name = split_street_type(clean_addr.split(',', 1)[1] if ',' in clean_addr else clean_addr)
+    name = " ".join(word for word in name.split() if word not in ("г", "город"))
+    return f"{address_client_city(address)}|{street_type or ''}|{name}"
+
+
+def _match_address_result(address: str, data: Dict, street: Optional[tuple] = None) -> Optional[Dict]:
+    """
+    Проверяет, что найденный GAS адрес соответствует запросу клиента.
+    street - (тип, название) улицы, которую обязан содержать найденный адрес (None - тип не сверяется)
+
+    Returns:
+        {technology, address_full, standard_price, promo_price} или None, если адрес не подходит
+    """
+    if not (data.get("ok") and data.get("found")):
+        return None
+
+    tech = data.get("technology", "FTTB")
+    full_addr = data.get("address_full", address)
+    standard_price = data.get("standard_connection_price_rub", 0)
+    promo_price = data.get("promo_price_rub", 0)
+
+    # ПРОВЕРКА СООТВЕТСТВИЯ НАСЕЛЁННОГО ПУНКТА
+    client_city = address_client_city(address)
+
+    # Извлекаем все части адреса API (сохраняем регистр для поиска улицы)
+    api_parts = [part.strip() for part in full_addr.split(',')]
+    api_parts_lower = [part.lower() for part in api_parts]
+
+    # Находим ПОСЛЕДНИЙ населённый пункт перед улицей (фактическое место проживания)
+    actual_city = None
+    street_index = None
+    for i, part_lower in enumerate(api_parts_lower):
+        # Если нашли улицу - запоминаем индекс и берём предыдущую часть
+        if any(word in part_lower for word in STREET_MARKERS):
+            street_index = i
+            # Ищем последний непустой населённый пункт перед улицей
+            if i > 0:
+                for j in range(i-1, -1, -1):
+                    prev = api_parts_lower[j]
+                    # Пропускаем область и район
+                    if 'область' not in prev and 'район' not in prev and prev:
+                        actual_city = prev
                         break
+            break
 
-                # ПРОВЕРКА 1: Прямое совпадение фактического города с запрошенным
-                if actual_city and actual_city == client_city:
-                    pass  # Всё в порядке - город совпадает точно
-                else:
-                    # ПРОВЕРКА 2: Город не совпадает напрямую
-                    # Ищем запрошенный город в административной иерархии (позиция после области)
-                    city_in_hierarchy = False
-                    for i, part_lower in enumerate(api_parts_lower):
-                        if 'область' in part_lower:
-                            continue
-                        if street_index is not None and i >= street_index:
-                            break
-                        if part_lower == client_city:
-                            city_in_hierarchy = True
-                            break
+    # ПРОВЕРКА 1: Прямое совпадение фактического города с запрошенным
+    if actual_city and actual_city == client_city:
+        pass  # Всё в порядке - город совпадает точно
+    else:
+        # ПРОВЕРКА 2: Город не совпадает напрямую
+        # Ищем запрошенный город в административной иерархии (позиция после области)
+        city_in_hierarchy = False
+        for i, part_lower in enumerate(api_parts_lower):
+            if 'область' in part_lower:
+                continue
+            if street_index is not None and i >= street_index:
+                break
+            if part_lower == client_city:
+                city_in_hierarchy = True
+                break
 
-                    if not city_in_hierarchy:
-                        pass  # Город вообще не найден ни напрямую, ни в иерархии
-                        return False, {}
-
-                    # ПРОВЕРКА 3: Город найден в иерархии, но фактический НП другой
-                    # Проверяем, что хотя бы улица примерно совпадает с запросом клиента
-                    # Извлекаем улицу из запроса клиента (вторая часть после запятой)
-                    client_street = None
-                    if ',' in address:
-                        parts = address.split(',')
-                        if len(parts) > 1:
-                            client_street = parts[1].strip().lower()
-                            # Убираем номер дома из улицы клиента
-                            client_street = re.sub(r',?\s*д\.?\s*\d+.*$', '', client_street, flags=re.IGNORECASE)
-                            client_street = re.sub(r',?\s*дом\s*\d+.*$', '', client_street, flags=re.IGNORECASE)
-                            # Убираем префикс "ул."
-                            client_street = re.sub(r'^\s*ул\.?\s*', '', client_street, flags=re.IGNORECASE)
-                            client_street = re.sub(r'^\s*улица\s+', '', client_street, flags=re.IGNORECASE)
-
-                    if client_street and street_index is not None:
-                        # Берём название улицы из API
-                        api_street = api_parts_lower[street_index]
-                        # Убираем "ул." из API строки
-                        api_street_clean = re.sub(r'^\s*ул\.?\s*', '', api_street, flags=re.IGNORECASE)
-
-                        # Проверяем вхождение: либо клиентская улица содержится в API, либо наоборот
-                        if client_street not in api_street_clean and api_street_clean not in client_street:
-                            # Улицы совершенно разные - адрес неправильный
-                            return False, {}
-
-                # Город совпадает - возвращаем успешный результат
-                price_info = ""
-                if promo_price > 0:
-                    price_info = f"\n💰 Стоимость подключения: {promo_price} руб (акция)"
-                elif standard_price > 0:
-                    price_info = f"\n💰 Стоимость подключения: {standard_price} руб"
-
-                return True, {
-                    "success": True,
-                    "available": True,
-                    "technology": tech,
-                    "address_full": full_addr,
-                    "message": f"✅ Отлично! По адресу {address} доступно подключение!\n📍 Полный адрес: {full_addr}\n🌐 Технология: {tech}{price_info}"
-                }
+        if not city_in_hierarchy:
+            return None  # Город вообще не найден ни напрямую, ни в иерархии
+
+        # ПРОВЕРКА 3: Город найден в иерархии, но фактический НП другой
+        # Проверяем, что хотя бы улица примерно совпадает с запросом клиента
+        # Извлекаем улицу из запроса клиента (вторая часть после запятой)
+        client_street = None
+        if ',' in address:
+            parts = address.split(',')
+            if len(parts) > 1:
+                client_street = parts[1].strip().lower()
+                # Убираем номер дома из улицы клиента
+                client_street = re.sub(r',?\s*д\.?\s*\d+.*$', '', client_street, flags=re.IGNORECASE)
+                client_street = re.sub(r',?\s*дом\s*\d+.*$', '', client_street, flags=re.IGNORECASE)
+                # Убираем префикс "ул."
+                client_street = re.sub(r'^\s*ул\.?\s*', '', client_street, flags=re.IGNORECASE)
+                client_street = re.sub(r'^\s*улица\s+', '', client_street, flags=re.IGNORECASE)
+
+        if client_street and street_index is not None:
+            # Берём название улицы из API
+            api_street = api_parts_lower[street_index]
+            # Убираем "ул." из API строки
+            api_street_clean = re.sub(r'^\s*ул\.?\s*', '', api_street, flags=re.IGNORECASE)
+
+            # Проверяем вхождение: либо клиентская улица содержится в API, либо наоборот
+            if client_street not in api_street_clean and api_street_clean not in client_street:
+                # Улицы совершенно разные - адрес неправильный
+                return None
 
-            except Exception as e:
-                return False, {}
+    if street and not street_type_matches(full_addr, *street):
+        return None
 
-    # ПЕРВЫЙ ЗАПРОС: пробуем найти адрес как есть
-    success, result = await try_search(clean_addr)
-    if success:
-        return result
+    return {
+        "technology": tech,
+        "address_full": full_addr,
+        "standard_price": standard_price,
+        "promo_price": promo_price
+    }
 
-    # ВТОРОЙ ЗАПРОС: если не нашли или город не совпал, пробуем добавить "улица"
-    # Проверяем, есть ли уже "улица" или "ул." в адресе
-    if 'улица' not in clean_addr.lower() and 'ул.' not in clean_addr.lower():
-        # Разбираем адрес: "Волгоград, 50 лет Октября" -> "Волгоград, улица 50 лет Октября"
-        parts = clean_addr.split(',', 1)
-        if len(parts) == 2:
-            city = parts[0].strip()
-            street = parts[1].strip()
-            clean_addr_with_ul = f"{city}, улица {street}"
-
-            pass  # Повторный поиск
-            success, result = await try_search(clean_addr_with_ul)
-            if success:
-                return result
 
-    # Если ничего не нашли - возвращаем отрицательный результат
+def format_address_result(address: str, match: Optional[Dict]) -> Dict[str, Any]:
+    """Ответ инструмента check_address_gas по результату проверки"""
+    if not match:
+        return {
+            "success": True,
+            "available": False,
+            "message": f"❌ К сожалению, по адресу {address} пока нет возможности подключения.\nМы можем оставить заявку и связаться с вами, когда сеть появится."
+        }
+
+    price_info = ""
+    if match["promo_price"] > 0:
+        price_info = f"\n💰 Стоимость подключения: {match['promo_price']} руб (акция)"
+    elif match["standard_price"] > 0:
+        price_info = f"\n💰 Стоимость подключения: {match['standard_price']} руб"
+
     return {
         "success": True,
-        "available": False,
-        "message": f"❌ К сожалению, по адресу {address} пока нет возможности подключения.\nМы можем оставить заявку и связаться с вами, когда сеть появится."
+        "available": True,
+        "technology": match["technology"],
+        "address_full": match["address_full"],
+        "matched_variant": match.get("matched_variant", "local_index"),
+        "message": f"✅ Отлично! По адресу {address} доступно подключение!\n📍 Полный адрес: {match['address_full']}\n🌐 Технология: {match['technology']}{price_info}"
     }
 
 
+# ==================== ЛОКАЛЬНЫЙ ИНДЕКС ПОКРЫТИЯ ====================
+
+coverage_index: Dict[str, List[Dict]] = {}  # {нормализованная улица: [записи листа покрытия]}
+coverage_meta = {"count": 0, "updated_at": None}
+
+
+def build_coverage_index(addresses: List[Dict]):
+    """Индексирует лист покрытия по названию улицы"""
+    global coverage_index
+    index: Dict[str, List[Dict]] = {}
+    for entry in addresses:
+        full_addr = entry.get("address_full", "")
+        for part in full_addr.split(','):
+            if any(word in part.lower() for word in STREET_MARKERS[:3]):
+                street = normalize_street_name(part)
+                if street:
+                    index.setdefault(street, []).append(entry)
+                break
+    coverage_index = index
+    coverage_meta["count"] = len(addresses)
+
+
+def load_coverage_cache():
+    """Загружает локальную копию листа покрытия из файла"""
+    try:
+        if os.path.exists(COVERAGE_CACHE_FILE):
+            with open(COVERAGE_CACHE_FILE, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            build_coverage_index(data.get("addresses", []))
+            coverage_meta["updated_at"] = data.get("updated_at")
+            print(f"✅ Загружен локальный индекс покрытия: {coverage_meta['count']} адресов, {len(coverage_index)} улиц")
+    except Exception as e:
+        print(f"⚠️  Ошибка загрузки кэша покрытия: {e}")
+
+
+async def sync_address_coverage() -> Dict[str, Any]:
+    """Загружает лист покрытия из GAS и перестраивает локальный индекс"""
+    if not ADDRESS_COVERAGE_ACTION:
+        return {"success": False, "message": "ADDRESS_COVERAGE_ACTION не задан"}
+
+    async with upstream_client("gas") as client:
+        try:
+            resp = await client.get(f"{GAS_BASE}?action={ADDRESS_COVERAGE_ACTION}")
+            resp.raise_for_status()
+            data = resp.json()
+
+            addresses = data.get("addresses") if data.get("ok") else None
+            if not addresses:
+                return {"success": False, "message": "API не вернул адреса покрытия"}
+
+            build_coverage_index(addresses)
+            coverage_meta["updated_at"] = datetime.now().isoformat()
+            # Остальные воркеры перечитывают этот файл - подменяем целиком
+            tmp_path = f"{COVERAGE_CACHE_FILE}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"addresses": addresses, "updated_at": coverage_meta["updated_at"]}, f, ensure_ascii=False)
+            os.replace(tmp_path, COVERAGE_CACHE_FILE)
+
+            print(f"✅ Индекс покрытия обновлён: {len(addresses)} адресов, {len(coverage_index)} улиц")
+            return {"success": True, "count": len(addresses)}
+
+        except Exception as e:
+            return {"success": False, "message": f"Ошибка API: {str(e)}"}
+
+
+async def coverage_sync_loop():
+    """Периодическая синхронизация листа покрытия: GAS запрашивает один воркер, остальные читают его файл"""
+    while True:
+        if await hold_leadership("coverage_sync", ADDRESS_COVERAGE_SYNC_INTERVAL * 2):
+            result = await sync_address_coverage()
+            if not result["success"]:
+                print(f"⚠️  Не удалось синхронизировать покрытие: {result.get('message')}")
+        else:
+            load_coverage_cache()
+        await asyncio.sleep(ADDRESS_COVERAGE_SYNC_INTERVAL)
+
+
+def lookup_coverage_local(address: str) -> Optional[Dict]:
+    """
+    Ищет адрес в локальном индексе покрытия.
+
+    Возвращает только положительный результат: промах в индексе не значит, что покрытия нет
+    (GAS сопоставляет адреса нечётко), такой адрес проверяется через GAS.
+    """
+    if not coverage_index or ',' not in address:
+        return None
+
+    street = normalize_street_name(clean_address_street(address).split(',', 1)[1])
+    for entry in coverage_index.get(street, []):
+        match = _match_address_result(address, {"ok": True, "found": True, **entry})
+        if match:
+            return match
+    return None
+
+
+load_coverage_cache()
+
+
+async def _gas_check_address(search_addr: str) -> Optional[Dict]:
+    """Запрос check_address в GAS. None - ошибка запроса (в отличие от ответа "не найдено")"""
+    address_stats["gas_requests"] += 1
+    async with upstream_client("gas") as client:
+        try:
+            resp = await client.post(GAS_BASE, json={"path": "check_address", "address": search_addr})
+            resp.raise_for_status()
+            return resp.json()
+        except Exception as e:
+            address_stats["gas_errors"] += 1
+            print(f"⚠️  [ADDRESS] Ошибка запроса к GAS: {e}")
+            return None
+
+
+ADDRESS_VARIANT_CONCURRENCY = int(os.getenv("ADDRESS_VARIANT_CONCURRENCY", "3"))
+
+# Статистика по шаблонам вариантов: какой шаблон чаще находит адрес, тот пробуется первым
+address_variant_stats: Dict[str, Dict[str, int]] = {}
+
+
+def generate_address_variants(address: str, clean_addr: str) -> List[tuple]:
+    """
+    Варианты написания адреса для GAS: [(шаблон, строка поиска, улица для сверки), ...]
+
+    Тип улицы указан ("Волгоград, пр-т Ленина") - варианты только этого типа, найденный адрес
+    обязан быть этого типа. Не указан ("Волгоград, 50 лет Октября") - как есть, "улица ...", "ул. ...",
+    "проспект ...", и каждое попадание сверяется с типом своего варианта
+    """
+    variants = [("as_is", clean_addr, None)]
+
+    parts = clean_addr.split(',', 1)
+    if len(parts) == 2:
+        city = parts[0].strip()
+        street = parts[1].strip()
+        street_type, bare_street = strip_street_type(street)
+        _, name = split_street_type(street)
+
+        if street_type:
+            variants = [("as_is", clean_addr, (street_type, name)),
+                        ("without_prefix", f"{city}, {bare_street}", (street_type, name))]
+        if bare_street:
+            for guessed_type in ([street_type] if street_type else STREET_TYPE_SPELLINGS):
+                for pattern, prefix in STREET_TYPE_SPELLINGS[guessed_type]:
+                    variants.append((pattern, f"{city}, {prefix} {bare_street}", (guessed_type, name)))
+
+    if address.strip() != clean_addr.strip():
+        variants.append(("with_house", address.strip(), variants[0][2]))
+
+    # Убираем дубли, сохраняя порядок
+    seen = set()
+    unique = []
+    for variant in variants:
+        key = variant[1].lower()
+        if key not in seen:
+            seen.add(key)
+            unique.append(variant)
+
+    # Шаблоны с лучшей долей попаданий - вперёд (при ограничении параллелизма стартуют первыми)
+    def hit_rate(variant):
+        stats = address_variant_stats.get(variant[0])
+        return stats["hits"] / stats["tried"] if stats and stats["tried"] else 0.0
+
+    return sorted(unique, key=hit_rate, reverse=True)
+
+
+def record_address_variant(pattern: str, hit: bool):
+    stats = address_variant_stats.setdefault(pattern, {"tried": 0, "hits": 0})
+    stats["tried"] += 1
+    if hit:
+        stats["hits"] += 1
+
+
+async def search_address_variants(address: str, variants: List[tuple]) -> tuple:
+    """
+    Параллельно проверяет варианты адреса в GAS (не более ADDRESS_VARIANT_CONCURRENCY одновременно).
+
+    Returns:
+        (match, had_error) - первый подтверждённый результат (остальные запросы отменяются)
+        и признак того, что хотя бы один запрос завершился ошибкой
+    """
+    semaphore = asyncio.Semaphore(ADDRESS_VARIANT_CONCURRENCY)
+
+    async def check_variant(pattern: str, search_addr: str, street: Optional[tuple]):
+        async with semaphore:
+            data = await _gas_check_address(search_addr)
+        if data is None:
+            return pattern, search_addr, None, True
+        return pattern, search_addr, _match_address_result(address, data, street), False
+
+    tasks = [asyncio.create_task(check_variant(*variant)) for variant in variants]
+    had_error = False
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            pattern, search_addr, match, error = await next_done
+            had_error = had_error or error
+            if error:
+                continue
+            record_address_variant(pattern, match is not None)
+            if match:
+                print(f"📍 [ADDRESS] Адрес найден по варианту {pattern}: {search_addr}")
+                return {**match, "matched_variant": pattern}, had_error
+        return None, had_error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+async def check_address_gas(address: str) -> Dict[str, Any]:
+    """Проверяет возможность подключения по адресу через Google Sheets"""
+    # Очищаем адрес от номера дома
+    clean_addr = clean_address_street(address)
+
+    # Локальный индекс листа покрытия
+    match = lookup_coverage_local(address)
+    if match:
+        address_stats["local_hits"] += 1
+        return format_address_result(address, match)
+
+    # Кэш результатов (в т.ч. отрицательных)
+    cache_key = normalize_address_key(address)
+    cached = await state.get("address", cache_key)
+    if cached is not None:
+        if cached.get("available"):
+            address_stats["cache_hits"] += 1
+            return format_address_result(address, cached["match"])
+        address_stats["negative_cache_hits"] += 1
+        return format_address_result(address, None)
+
+    # Все варианты написания проверяются параллельно, побеждает первый подтверждённый
+    match, had_error = await search_address_variants(address, generate_address_variants(address, clean_addr))
+    if match:
+        await state.set("address", cache_key, {"available": True, "match": match}, ttl=ADDRESS_CACHE_TTL)
+        return format_address_result(address, match)
+
+    # Отрицательный результат кэшируем только если GAS ответил на все запросы
+    if not had_error:
+        await state.set("address", cache_key, {"available": False}, ttl=ADDRESS_NEGATIVE_CACHE_TTL)
+
+    # Если ничего не нашли - возвращаем отрицательный результат
+    return format_address_result(address, None)
+
+
 async def update_tariffs_from_api() -> Dict[str, Any]:
     """Обновляет тарифы из Google Sheets API"""
     url = f"{GAS_BASE}?action=get_tariffs"
 
-    async with httpx.AsyncClient(timeout=30.0, follow_redirects=True) as client:
+    async with upstream_client("gas") as client:
         try:
             resp = await client.get(url)
             resp.raise_for_status()
@@ -756,24 +2286,40 @@ async def update_tariffs_from_api() -> Dict[str, Any]:
             return {"success": False, "message": f"Ошибка API: {str(e)}"}
 
 async def get_tariffs_gas(active: bool = True, force_update: bool = False, top_expensive: int = 0) -> Dict[str, Any]:
-    """Получает список тарифов (из кэша или API)"""
+    """
+    Получает список тарифов (из кэша или API).
+    force_update - ждём обновление из GAS не дольше CATALOG_FORCE_REFRESH_TIMEOUT (во время backoff - кэш)
+    """
 
-    # Если кэш валидный и не требуется принудительное обновление - используем кэш
-    if tariffs_cache.get("is_valid") and not force_update and tariffs_cache.get("tariffs"):
+    fresh = None
+    if force_update and tariffs_cache.get("tariffs") and not tariffs_refresher.in_backoff():
+        try:
+            result = await asyncio.wait_for(tariffs_refresher.refresh_now(), CATALOG_FORCE_REFRESH_TIMEOUT)
+            if result["success"]:
+                fresh = result["tariffs"]
+        except asyncio.TimeoutError:
+            # Обновление продолжается в фоне (refresh_now защищён shield), отвечаем из кэша
+            print(f"⏱️  [CATALOG] Тарифы не обновились за {CATALOG_FORCE_REFRESH_TIMEOUT:.0f}с - отвечаем из кэша")
+
+    if fresh is not None:
+        tariffs = fresh
+        source = "api"
+    # Есть кэш (даже устаревший) - отвечаем сразу, обновление идёт в фоне
+    elif tariffs_cache.get("tariffs"):
         tariffs = tariffs_cache["tariffs"]
         source = "cache"
+        if tariffs_refresher.is_stale():
+            tariffs_refresher.request_refresh()
+            source = "cache_stale"
     else:
-        # Пытаемся обновить из API
-        result = await update_tariffs_from_api()
+        # Кэша нет совсем - ждём обновление (общее для всех параллельных запросов), но не во время backoff
+        if tariffs_refresher.in_backoff():
+            return {"success": False, "message": "Не удалось загрузить тарифы"}
+        result = await tariffs_refresher.refresh_now()
 
         if result["success"]:
             tariffs = result["tariffs"]
             source = "api"
-        elif tariffs_cache.get("tariffs"):
-            # Если API недоступен, но есть старый кэш - используем его
-            tariffs = tariffs_cache["tariffs"]
-            source = "cache_fallback"
-            print(f"⚠️  Используем устаревший кэш тарифов (API недоступен)")
         else:
             # Совсем нет данных
             return {"success": False, "message": "Не удалось загрузить тарифы"}
@@ -828,11 +2374,159 @@ async def get_tariffs_gas(active: bool = True, force_update: bool = False, top_e
         "source": source
     }
 
+# ============================================================================
+# CATALOG REFRESHER - Фоновое обновление тарифов и доп. услуг
+# ============================================================================
+# Запросы чата всегда отвечают из кэша (даже устаревшего), обновление идёт в фоне.
+# Синхронно GAS вызывается только если кэша нет совсем (первый запуск без файла).
+
+CATALOG_REFRESH_INTERVAL = int(os.getenv("CATALOG_REFRESH_INTERVAL", str(6 * 3600)))
+CATALOG_REFRESH_JITTER = float(os.getenv("CATALOG_REFRESH_JITTER", "0.1"))   # ±10% к интервалу
+CATALOG_REFRESH_MAX_BACKOFF = int(os.getenv("CATALOG_REFRESH_MAX_BACKOFF", "3600"))
+# Сколько get_tariffs_gas(force_update=True) ждёт свежие тарифы, прежде чем ответить из кэша (сек)
+CATALOG_FORCE_REFRESH_TIMEOUT = float(os.getenv("CATALOG_FORCE_REFRESH_TIMEOUT", "10"))
+
+
+class CatalogRefresher:
+    """
+    Периодически обновляет каталог из GAS.
+
+    - interval ± jitter между обновлениями (чтобы воркеры не били в GAS одновременно)
+    - при ошибке повтор с экспоненциальной задержкой от 30 секунд до max_backoff;
+      запросы из чата (request_refresh) эту задержку не сокращают
+    - одновременно выполняется только одно обновление, остальные ждут его результат
+    """
+
+    def __init__(self, name: str, refresh_func, get_updated_at, interval: int, jitter: float, max_backoff: int,
+                 reload_func=None):
+        self.name = name
+        self.refresh_func = refresh_func
+        self.reload_func = reload_func  # перечитать файл кэша, который обновил воркер-лидер
+        self.get_updated_at = get_updated_at
+        self.interval = interval
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        self._failed_at = 0.0  # time.monotonic() последней ошибки
+        self.metrics = {
+            "refreshes": 0,
+            "failures": 0,
+            "consecutive_failures": 0,
+            "last_success": None,
+            "last_error": None,
+            "last_duration_ms": None,
+            "next_refresh_at": None
+        }
+
+    def age_seconds(self) -> Optional[float]:
+        updated_at = self.get_updated_at()
+        if not updated_at:
+            return None
+        try:
+            return (datetime.now() - datetime.fromisoformat(updated_at)).total_seconds()
+        except ValueError:
+            return None
+
+    def is_stale(self) -> bool:
+        age = self.age_seconds()
+        return age is None or age >= self.interval
+
+    async def _refresh(self) -> Dict[str, Any]:
+        started = time.time()
+        try:
+            result = await self.refresh_func()
+        except Exception as e:
+            result = {"success": False, "message": str(e)}
+
+        self.metrics["last_duration_ms"] = int((time.time() - started) * 1000)
+        if result.get("success"):
+            self.metrics["refreshes"] += 1
+            self.metrics["consecutive_failures"] = 0
+            self.metrics["last_success"] = datetime.now().isoformat()
+        else:
+            self.metrics["failures"] += 1
+            self.metrics["consecutive_failures"] += 1
+            self.metrics["last_error"] = result.get("message")
+            self._failed_at = time.monotonic()
+            print(f"⚠️  [CATALOG] Не удалось обновить {self.name}: {result.get('message')}")
+        return result
+
+    async def refresh_now(self) -> Dict[str, Any]:
+        """Обновляет каталог (или ждёт уже идущее обновление)"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._refresh())
+        return await asyncio.shield(self._task)
+
+    def in_backoff(self) -> bool:
+        """После ошибки ещё не прошла задержка backoff - GAS не трогаем"""
+        return (self.metrics["consecutive_failures"] > 0
+                and time.monotonic() - self._failed_at < self._next_delay())
+
+    def request_refresh(self):
+        """Просит фоновый цикл обновить каталог, не дожидаясь результата (во время backoff - ничего)"""
+        if not self.in_backoff():
+            self._wakeup.set()
+
+    def _next_delay(self) -> float:
+        failures = self.metrics["consecutive_failures"]
+        if failures:
+            return min(30 * 2 ** (failures - 1), self.max_backoff)
+
+        delay = self.interval - (self.age_seconds() or 0)
+        if delay <= 0:
+            delay = self.interval
+        return delay + delay * random.uniform(-self.jitter, self.jitter)
+
+    async def _scheduled_refresh(self):
+        """Плановое обновление: из GAS в воркере-лидере, в остальных - из файла кэша лидера"""
+        if self.reload_func is None or await hold_leadership(f"catalog:{self.name}", self.interval + self.max_backoff):
+            await self.refresh_now()
+        else:
+            self.reload_func()
+
+    async def run(self):
+        """Фоновый цикл обновления"""
+        if self.is_stale():
+            await self._scheduled_refresh()
+
+        while True:
+            delay = self._next_delay()
+            self.metrics["next_refresh_at"] = (datetime.now() + timedelta(seconds=delay)).isoformat()
+
+            # Ждём истечения интервала или явного запроса request_refresh()
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+            await self._scheduled_refresh()
+
+    def stats(self) -> Dict[str, Any]:
+        age = self.age_seconds()
+        return {
+            **self.metrics,
+            "updated_at": self.get_updated_at(),
+            "age_seconds": int(age) if age is not None else None,
+            "stale": self.is_stale()
+        }
+
+
+tariffs_refresher = CatalogRefresher(
+    "tariffs", update_tariffs_from_api, lambda: tariffs_cache.get("updated_at"),
+    CATALOG_REFRESH_INTERVAL, CATALOG_REFRESH_JITTER, CATALOG_REFRESH_MAX_BACKOFF, reload_func=load_tariffs_cache
+)
+addons_refresher = CatalogRefresher(
+    "addons", update_addons_from_api, lambda: addons_cache.get("updated_at"),
+    CATALOG_REFRESH_INTERVAL, CATALOG_REFRESH_JITTER, CATALOG_REFRESH_MAX_BACKOFF, reload_func=load_addons_cache
+)
+
 async def ping_router(contract: str) -> Dict[str, Any]:
     """Пингует роутер клиента по номеру договора"""
     url = f"{BILLING_BASE}/ping.php?contract={contract}"
 
-    async with httpx.AsyncClient(timeout=30.0, follow_redirects=True) as client:
+    async with upstream_client("billing") as client:
         try:
             resp = await client.get(url)
             resp.raise_for_status()
@@ -856,41 +2550,20 @@ async def ping_router(contract: str) -> Dict[str, Any]:
 
 async def find_answer_in_kb(question: str) -> Dict[str, Any]:
     """Поиск ответа в локальной базе знаний smit_qna.json"""
-    if not KB_DATA:
+    if not kb_index.items:
         return {"success": False, "message": "База знаний не загружена"}
 
-    question_lower = question.lower()
-
-    # Поиск по ключевым словам в вопросах и ответах
-    best_match = None
-    best_score = 0
-
-    for item in KB_DATA:
-        q = item.get("question", "").lower()
-        a = item.get("answer", "").lower()
-
-        # Подсчитываем совпадения слов
-        q_words = set(q.split())
-        question_words = set(question_lower.split())
-        common_words = q_words & question_words
-
-        score = len(common_words)
-
-        # Дополнительные баллы за точное вхождение фраз
-        if question_lower in q or q in question_lower:
-            score += 10
+    results = search_kb_hybrid(question, top_k=3)
 
-        if score > best_score:
-            best_score = score
-            best_match = item
-
-    # Если нашли хоть какое-то совпадение
-    if best_match and best_score > 0:
+    if results:
+        best = results[0]["item"]
         return {
             "success": True,
-            "answer": best_match["answer"],
-            "question_matched": best_match["question"],
-            "message": best_match["answer"]
+            "answer": best["answer"],
+            "question_matched": best["question"],
+            "confidence": results[0]["confidence"],
+            "related_questions": [r["item"]["question"] for r in results[1:]],
+            "message": best["answer"]
         }
     else:
         return {
@@ -902,7 +2575,7 @@ async def promise_payment(contract: str, amount: float, date: str, phone: str =
     """Оформляет обещанный платеж для клиента"""
     url = f"{BILLING_BASE}/promise.php"
 
-    async with httpx.AsyncClient(timeout=30.0, follow_redirects=True) as client:
+    async with upstream_client("billing") as client:
         try:
             resp = await client.post(url, json={
                 "contract": contract,
@@ -913,6 +2586,9 @@ async def promise_payment(contract: str, amount: float, date: str, phone: str =
             data = resp.json()
 
             if data.get("success"):
+                # Баланс изменился - закэшированные данные биллинга больше не актуальны
+                await invalidate_billing_cache(phone=phone, contract=contract)
+
                 # Создаём тикет в FreeScout (почтовый ящик 3 - Биллинг)
                 if FREESCOUT_API_KEY and contract:
                     customer_email = f"{contract}@smit34.ru"
@@ -1046,336 +2722,1064 @@ def parse_relative_date(text: str) -> tuple:
 
 
 
-async def create_amocrm_lead(
-    name: str,
-    phone: str,
-    address: str,
-    tariff: str = "",
-    comment: str = "",
-    email: str = "",
-    router_option: str = "",
-    static_ip: str = "",
-    cctv_option: str = "",
-    preferred_date: str = "",
-    preferred_time: str = "",
-    utm_source: str = "",
-    utm_medium: str = "",
-    utm_campaign: str = "",
-    utm_content: str = "",
-    utm_term: str = ""
-) -> Dict[str, Any]:
-    """Создает контакт и лид в AmoCRM. Кастомные поля подключения добавляются в ЛИД."""
-    if not AMO_ACCESS_TOKEN:
-        return {"success": False, "lead_id": None, "error": "AmoCRM не настроен"}
-
-    headers = {
-        "Authorization": f"Bearer {AMO_ACCESS_TOKEN}",
-        "Content-Type": "application/json"
-    }
+# ==================== ПЕРСИСТЕНТНЫЕ ОЧЕРЕДИ ЗАДАЧ (SQLite) ====================
+# Общая основа для outbox AmoCRM и очереди входящих вебхуков
 
-    try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            # Шаг 1: Создаем КОНТАКТ только с базовыми полями
-            contact_custom_fields = [
-                {
-                    "field_code": "PHONE",
-                    "values": [{"value": phone, "enum_code": "WORK"}]
-                }
-            ]
+JOB_QUEUE_POLL_INTERVAL = float(os.getenv("JOB_QUEUE_POLL_INTERVAL", "5"))
+JOB_QUEUE_LEASE = 300  # сек - задача "running" дольше считается брошенной (воркер упал)
 
-            # Добавляем email если указан
-            if email:
-                contact_custom_fields.append({
-                    "field_code": "EMAIL",
-                    "values": [{"value": email, "enum_code": "WORK"}]
-                })
 
-            contact_data = [{
-                "name": name,
-                "custom_fields_values": contact_custom_fields
-            }]
+class JobQueue:
+    """
+    Персистентная очередь задач в SQLite (WAL), по таблице на очередь.
+
+    Задача сначала сохраняется в БД, потом выполняется фоновым воркером
+    (run_job_queue) - незавершённые задачи переигрываются после перезапуска.
+    Многошаговые задачи сохраняют checkpoint, чтобы повтор не делал шаги дважды.
+    depends_on - задача ждёт выполнения другой задачи той же очереди.
+    order_key - задачи с одним ключом выполняются строго по очереди
+    (например, события одного тикета), с разными - параллельно.
+    БД открывается при первом обращении - импорт server.py файлов не создаёт.
+    """
 
-            response = await client.post(
-                f"{AMO_BASE_URL}/api/v4/contacts",
-                json=contact_data,
-                headers=headers
+    def __init__(self, path: str, table: str, keep_done: int = 604800):
+        import threading
+
+        self.path = path
+        self.table = table
+        self.keep_done = keep_done
+        self._lock = threading.Lock()
+        self._connection = None
+        self.waiters: Dict[int, asyncio.Future] = {}
+        self.wakeup: Optional[asyncio.Event] = None
+        self.on_failed = None  # callback(job) после окончательной ошибки - освободить ресурсы задачи
+
+    @property
+    def _conn(self):
+        """Соединение с БД очереди (открывается и создаёт таблицу при первом обращении)"""
+        if self._connection is None:
+            self._connection = self._connect()
+        return self._connection
+
+    def _connect(self):
+        import sqlite3
+
+        table = self.table
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                checkpoint TEXT NOT NULL DEFAULT '{{}}',
+                depends_on INTEGER,
+                order_key TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                lease_until REAL,
+                result TEXT,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if "order_key" not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN order_key TEXT")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_due ON {table}(status, next_attempt_at)")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_order ON {table}(order_key, status)")
+        return conn
+
+    def _row_to_job(self, row) -> Dict[str, Any]:
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["checkpoint"] = json.loads(job["checkpoint"] or "{}")
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def enqueue(self, kind: str, payload: Dict[str, Any], depends_on: Optional[int] = None,
+                order_key: Optional[str] = None, delay: float = 0) -> int:
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                f"INSERT INTO {self.table} (kind, payload, depends_on, order_key, next_attempt_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (kind, json.dumps(payload, ensure_ascii=False), depends_on, order_key, now + delay, now, now)
+            )
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return cursor.lastrowid
+
+    def get(self, job_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(f"SELECT * FROM {self.table} WHERE id = ?", (job_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def claim_due(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """
+        Забирает готовые к выполнению задачи (lease защищает от двойного выполнения воркерами).
+        Задача с order_key берётся, только если перед ней нет незавершённых задач с тем же ключом
+        """
+        now = time.time()
+        claimed = []
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE {self.table} SET status = 'pending', lease_until = NULL "
+                "WHERE status = 'running' AND lease_until < ?",
+                (now,)
+            )
+            rows = self._conn.execute(
+                f"SELECT * FROM {self.table} t WHERE status = 'pending' AND next_attempt_at <= ? "
+                f"AND (order_key IS NULL OR NOT EXISTS (SELECT 1 FROM {self.table} p WHERE p.order_key = t.order_key "
+                "AND p.id < t.id AND p.status IN ('pending', 'running'))) ORDER BY id LIMIT ?",
+                (now, limit)
+            ).fetchall()
+            for row in rows:
+                cursor = self._conn.execute(
+                    f"UPDATE {self.table} SET status = 'running', lease_until = ?, updated_at = ? "
+                    "WHERE id = ? AND status = 'pending'",
+                    (now + JOB_QUEUE_LEASE, now, row["id"])
+                )
+                if cursor.rowcount == 1:
+                    claimed.append(self._row_to_job(row))
+        return claimed
+
+    def complete(self, job: Dict[str, Any], result: Dict[str, Any]):
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE {self.table} SET status = 'done', result = ?, checkpoint = ?, attempts = attempts + 1, "
+                "lease_until = NULL, last_error = NULL, updated_at = ? WHERE id = ?",
+                (json.dumps(result, ensure_ascii=False, default=str), json.dumps(job["checkpoint"], ensure_ascii=False),
+                 time.time(), job["id"])
+            )
+        self._resolve(job["id"], result)
+
+    def save_checkpoint(self, job: Dict[str, Any]):
+        """Сохраняет checkpoint сразу после внешнего шага - после падения процесса шаг не повторится"""
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE {self.table} SET checkpoint = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(job["checkpoint"], ensure_ascii=False), time.time(), job["id"])
             )
 
-            contact_id = None
-            if response.status_code in [200, 201]:
-                data = response.json()
-                if data.get("_embedded") and data["_embedded"].get("contacts"):
-                    contact_id = data["_embedded"]["contacts"][0]["id"]
-                    print(f"✅ AmoCRM контакт создан: ID {contact_id}")
-            else:
-                print(f"⚠️  Не удалось создать контакт: {response.status_code} - {response.text}")
-
-            # Шаг 2: Создаем ЛИД с кастомными полями
-            lead_custom_fields = []
-
-            # Адрес подключения (новое поле лида)
-            if address:
-                lead_custom_fields.append({
-                    "field_id": AMO_CF_LEAD_ADDRESS,  # 2578887
-                    "values": [{"value": address}]
-                })
+    def retry(self, job: Dict[str, Any], error: str, delay: float, count_attempt: bool = True):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE {self.table} SET status = 'pending', checkpoint = ?, attempts = attempts + ?, "
+                "next_attempt_at = ?, lease_until = NULL, last_error = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(job["checkpoint"], ensure_ascii=False), 1 if count_attempt else 0,
+                 now + delay, error, now, job["id"])
+            )
 
-            # Тариф (новое поле лида - textarea)
-            if tariff:
-                lead_custom_fields.append({
-                    "field_id": AMO_CF_LEAD_TARIFF,  # 2578883
-                    "values": [{"value": tariff}]
-                })
+    def fail(self, job: Dict[str, Any], error: str):
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE {self.table} SET status = 'failed', checkpoint = ?, attempts = attempts + 1, "
+                "lease_until = NULL, last_error = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(job["checkpoint"], ensure_ascii=False), error, time.time(), job["id"])
+            )
+        self._resolve(job["id"], {"success": False, "error": error})
+        if self.on_failed is not None:
+            try:
+                self.on_failed(job)
+            except Exception as e:
+                print(f"⚠️  [QUEUE] Ошибка очистки задачи #{job['id']}: {e}")
+
+    def wake(self, job_ids: List[int]):
+        """Ожидающие задачи выполняются сразу, не дожидаясь своего времени"""
+        if not job_ids:
+            return
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE {self.table} SET next_attempt_at = ? WHERE status = 'pending' "
+                f"AND id IN ({', '.join('?' * len(job_ids))})",
+                (time.time(), *job_ids)
+            )
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def wait_result(self, job_id: int, timeout: float) -> Optional[Dict[str, Any]]:
+        """
+        Результат задачи, выполненной этим или другим воркером (None - не готова за timeout).
+        Свой воркер отдаёт результат через future, чужой - видно по статусу в БД
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[job_id] = future
+        deadline = time.monotonic() + timeout
+        try:
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    return await asyncio.wait_for(asyncio.shield(future), min(remaining, 0.5))
+                except asyncio.TimeoutError:
+                    job = self.get(job_id)
+                    if job and job["status"] == "done":
+                        return job["result"]
+                    if job and job["status"] == "failed":
+                        return {"success": False, "error": job["last_error"]}
+            return None
+        finally:
+            self.waiters.pop(job_id, None)
+
+    def _resolve(self, job_id: int, result: Dict[str, Any]):
+        future = self.waiters.pop(job_id, None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    def purge_done(self) -> int:
+        with self._lock:
+            cursor = self._conn.execute(
+                f"DELETE FROM {self.table} WHERE status = 'done' AND updated_at < ?",
+                (time.time() - self.keep_done,)
+            )
+        return cursor.rowcount
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            rows = self._conn.execute(f"SELECT status, COUNT(*) FROM {self.table} GROUP BY status").fetchall()
+            oldest = self._conn.execute(
+                f"SELECT MIN(created_at) FROM {self.table} WHERE status IN ('pending', 'running')"
+            ).fetchone()[0]
+        counts = {row[0]: row[1] for row in rows}
+        return {
+            "pending": counts.get("pending", 0),
+            "running": counts.get("running", 0),
+            "failed": counts.get("failed", 0),
+            "done": counts.get("done", 0),
+            "oldest_pending_age": round(time.time() - oldest, 1) if oldest else None
+        }
 
-            # Роутер
-            if router_option:
-                lead_custom_fields.append({
-                    "field_id": AMO_CF_LEAD_ROUTER,  # 2578885
-                    "values": [{"value": router_option}]
-                })
 
-            # Видеонаблюдение
-            if cctv_option:
-                cctv_value = cctv_option if cctv_option != "нет" else "нет"
-                lead_custom_fields.append({
-                    "field_id": AMO_CF_LEAD_CCTV,  # 2578889
-                    "values": [{"value": cctv_value}]
-                })
+class JobNotReady(Exception):
+    """Задача ждёт внешнего события: повтор через delay без траты попытки (или раньше - JobQueue.wake)"""
 
-            # Постоянный IP (checkbox)
-            if static_ip:
-                flag_value = True if static_ip == "да" else False
-                lead_custom_fields.append({
-                    "field_id": AMO_CF_LEAD_STATIC_IP,  # 2578891
-                    "values": [{"value": flag_value}]
-                })
+    def __init__(self, reason: str, delay: float):
+        super().__init__(reason)
+        self.delay = delay
 
-            # Дата подключения
-            if preferred_date:
-                try:
-                    from datetime import datetime
-                    import locale
-                    import re
-                    
-                    # Словарь русских названий месяцев
-                    ru_months = {
-                        'января': '01', 'февраля': '02', 'марта': '03', 'апреля': '04',
-                        'мая': '05', 'июня': '06', 'июля': '07', 'августа': '08',
-                        'сентября': '09', 'октября': '10', 'ноября': '11', 'декабря': '12'
-                    }
-                    
-                    date_str = preferred_date.strip()
-                    dt = None
-                    
-                    # Пробуем распарсить русское название месяца (например: "25 ноября 2025")
-                    pattern = r'(\d{1,2})\s+(января|февраля|марта|апреля|мая|июня|июля|августа|сентября|октября|ноября|декабря)\s+(\d{4})'
-                    match = re.search(pattern, date_str.lower())
-                    if match:
-                        day = match.group(1).zfill(2)
-                        month = ru_months[match.group(2)]
-                        year = match.group(3)
-                        dt = datetime.strptime(f"{day}.{month}.{year}", "%d.%m.%Y")
-                    else:
-                        # Пробуем другие форматы
-                        formats = ["%d.%m.%Y", "%Y-%m-%d", "%d/%m/%Y"]
-                        for fmt in formats:
-                            try:
-                                dt = datetime.strptime(date_str, fmt)
-                                break
-                            except ValueError:
-                                continue
-                    
-                    if dt:
-                        timestamp = int(dt.timestamp())
-                        lead_custom_fields.append({
-                            "field_id": AMO_CF_LEAD_CONNECTION_DATE,  # 2578411
-                            "values": [{"value": timestamp}]
-                        })
-                        print(f"✅ Дата подключения распарсена: {dt.strftime('%d.%m.%Y')}")
-                    else:
-                        print(f"⚠️  Не удалось распарсить дату '{preferred_date}'")
-                except Exception as e:
-                    print(f"⚠️  Ошибка парсинга даты '{preferred_date}': {e}")
 
-            # Время подключения
-            if preferred_time:
-                lead_custom_fields.append({
-                    "field_id": AMO_CF_LEAD_CONNECTION_TIME,  # 2578413
-                    "values": [{"value": preferred_time}]
-                })
+def queue_backoff_delay(attempt: int, max_delay: float) -> float:
+    """Задержка перед повтором задачи: 2, 4, 8... сек с джиттером, не больше max_delay"""
+    return min(max_delay, 2 ** (attempt + 1)) * random.uniform(0.8, 1.2)
 
 
-            # UTM метки (tracking_data)
-            if utm_source:
-                lead_custom_fields.append({
-                    "field_id": AMO_CF_LEAD_UTM_SOURCE,  # 2563561
-                    "values": [{"value": utm_source}]
-                })
-            if utm_medium:
-                lead_custom_fields.append({
-                    "field_id": AMO_CF_LEAD_UTM_MEDIUM,  # 2563565
-                    "values": [{"value": utm_medium}]
-                })
-            if utm_campaign:
-                lead_custom_fields.append({
-                    "field_id": AMO_CF_LEAD_UTM_CAMPAIGN,  # 2563563
-                    "values": [{"value": utm_campaign}]
-                })
-            if utm_content:
-                lead_custom_fields.append({
-                    "field_id": AMO_CF_LEAD_UTM_CONTENT,  # 2563567
-                    "values": [{"value": utm_content}]
-                })
-            if utm_term:
-                lead_custom_fields.append({
-                    "field_id": AMO_CF_LEAD_UTM_TERM,  # 2563569
-                    "values": [{"value": utm_term}]
-                })
+async def run_queue_job(queue: JobQueue, handlers: Dict[str, Any], job: Dict[str, Any],
+                        max_attempts: int, max_delay: float, tag: str):
+    """
+    Выполняет одну задачу и сохраняет её исход.
 
-            lead_data = {
-                "name": f"Подключение: {address}",
-                "price": 0,
-                "pipeline_id": AMO_PIPELINE_B2C_ID,
-                "status_id": 79103554,  # Тариф выбран
-                "responsible_user_id": AMO_DEFAULT_RESPONSIBLE_USER_ID,
-                "custom_fields_values": lead_custom_fields
-            }
+    Исключение с retryable=False (AmoCRMError, FreeScoutError) - задача сразу failed,
+    остальные ошибки повторяются с backoff до max_attempts.
+    """
+    handler = handlers.get(job["kind"])
+    if handler is None:
+        queue.fail(job, f"Неизвестный тип задачи: {job['kind']}")
+        return
+
+    if job["depends_on"]:
+        parent = queue.get(job["depends_on"])
+        if parent is None or parent["status"] == "failed":
+            queue.fail(job, f"Родительская задача #{job['depends_on']} не выполнена")
+            print(f"❌ [{tag}] Задача #{job['id']} ({job['kind']}) отменена: нет родительской задачи")
+            return
+        if parent["status"] != "done":
+            # Ждём родителя, попытку не тратим
+            queue.retry(job, "ожидает родительскую задачу", JOB_QUEUE_POLL_INTERVAL, count_attempt=False)
+            return
+        job["parent_result"] = parent["result"]
 
-            # Привязываем контакт если создан
-            if contact_id:
-                lead_data["_embedded"] = {
-                    "contacts": [{"id": contact_id}]
-                }
+    try:
+        result = await handler(job)
+    except JobNotReady as e:
+        queue.retry(job, str(e), e.delay, count_attempt=False)
+        print(f"⏳ [{tag}] Задача #{job['id']} ({job['kind']}) ждёт: {e}")
+        return
+    except Exception as e:
+        retryable = getattr(e, "retryable", True)
+        if not hasattr(e, "retryable"):
+            import traceback
+            traceback.print_exc()
+        error = f"{type(e).__name__}: {e}"[:1000]
+        if retryable and job["attempts"] + 1 < max_attempts:
+            delay = queue_backoff_delay(job["attempts"], max_delay)
+            queue.retry(job, error, delay)
+            print(f"⚠️  [{tag}] Задача #{job['id']} ({job['kind']}): {error}. Повтор через {delay:.0f}с")
+        else:
+            queue.fail(job, error)
+            print(f"❌ [{tag}] Задача #{job['id']} ({job['kind']}) не выполнена: {error}")
+        return
 
-            response = await client.post(
-                f"{AMO_BASE_URL}/api/v4/leads",
-                json=[lead_data],
-                headers=headers
-            )
+    queue.complete(job, result if isinstance(result, dict) else {"result": result})
+    print(f"✅ [{tag}] Задача #{job['id']} ({job['kind']}) выполнена")
 
-            if response.status_code in [200, 201]:
-                data = response.json()
-                if data.get("_embedded") and data["_embedded"].get("leads"):
-                    lead_id = data["_embedded"]["leads"][0]["id"]
-                    print(f"✅ AmoCRM лид создан: ID {lead_id}")
-
-                    # Шаг 3: Добавляем примечание с деталями
-                    note_text = f"🤖 Заявка от AI Ассистента\n\n"
-                    note_text += f"📍 Адрес: {address}\n"
-                    if tariff:
-                        note_text += f"💼 Тариф: {tariff}\n"
-                    if router_option:
-                        note_text += f"📶 Роутер: {router_option}\n"
-                    if cctv_option and cctv_option != "нет":
-                        note_text += f"📹 Видеонаблюдение: {cctv_option}\n"
-                    if static_ip == "да":
-                        note_text += f"📍 Постоянный IP: да\n"
-                    if comment:
-                        note_text += f"\n💬 Комментарий клиента:\n{comment}"
-
-                    note_data = [{
-                        "entity_id": lead_id,
-                        "note_type": "common",
-                        "params": {"text": note_text}
-                    }]
-
-                    await client.post(
-                        f"{AMO_BASE_URL}/api/v4/leads/notes",
-                        json=note_data,
-                        headers=headers
-                    )
 
-                    return {"success": True, "lead_id": lead_id, "contact_id": contact_id}
+async def run_job_queue(queue: JobQueue, handlers: Dict[str, Any], concurrency: int,
+                        max_attempts: int, max_delay: float, tag: str):
+    """
+    Фоновый воркер очереди: до concurrency задач одновременно, после рестарта
+    доигрывает незавершённые. concurrency=1 - строго по порядку постановки
+    """
+    queue.wakeup = asyncio.Event()
+    running = set()
+    last_purge = 0.0
+    stats = queue.stats()
+    if stats["pending"] or stats["running"]:
+        print(f"📮 [{tag}] В очереди {stats['pending'] + stats['running']} незавершённых задач - доигрываем")
+
+    def on_done(task):
+        running.discard(task)
+        queue.wakeup.set()
+
+    while True:
+        try:
+            queue.wakeup.clear()
+            free = max(0, concurrency - len(running))
+            jobs = queue.claim_due(free) if free else []
+            for job in jobs:
+                task = asyncio.create_task(run_queue_job(queue, handlers, job, max_attempts, max_delay, tag))
+                running.add(task)
+                task.add_done_callback(on_done)
+
+            if time.time() - last_purge > 3600:
+                queue.purge_done()
+                last_purge = time.time()
+
+            if not jobs or len(running) >= concurrency:
+                try:
+                    await asyncio.wait_for(queue.wakeup.wait(), JOB_QUEUE_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ [{tag}] Ошибка воркера очереди: {e}")
+            import traceback
+            traceback.print_exc()
+            await asyncio.sleep(JOB_QUEUE_POLL_INTERVAL)
+
 
-            print(f"❌ AmoCRM ошибка создания лида: {response.status_code} - {response.text}")
-            return {"success": False, "lead_id": None, "error": response.text}
+# ==================== AMOCRM: ЛИМИТ ЗАПРОСОВ, ПОВТОРЫ, OUTBOX ====================
 
-    except Exception as e:
-        print(f"❌ AmoCRM исключение: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return {"success": False, "lead_id": None, "error": str(e)}
+AMO_RATE_LIMIT = float(os.getenv("AMO_RATE_LIMIT", "6"))  # запросов/сек (лимит AmoCRM ~7 на аккаунт)
+AMO_RATE_BURST = int(os.getenv("AMO_RATE_BURST", "7"))
+AMO_MAX_RETRIES = int(os.getenv("AMO_MAX_RETRIES", "4"))
+AMO_RETRY_BASE_DELAY = float(os.getenv("AMO_RETRY_BASE_DELAY", "0.5"))
+AMO_RETRY_MAX_DELAY = float(os.getenv("AMO_RETRY_MAX_DELAY", "30"))
+AMO_RETRY_STATUSES = {429, 500, 502, 503, 504}
 
+AMO_OUTBOX_PATH = os.getenv("AMO_OUTBOX_PATH", os.path.join(os.path.dirname(__file__), "amo_outbox.db"))
+AMO_OUTBOX_MAX_ATTEMPTS = int(os.getenv("AMO_OUTBOX_MAX_ATTEMPTS", "12"))
+AMO_OUTBOX_MAX_DELAY = float(os.getenv("AMO_OUTBOX_MAX_DELAY", "900"))
+AMO_OUTBOX_KEEP_DONE = int(os.getenv("AMO_OUTBOX_KEEP_DONE", "604800"))  # выполненные задачи храним неделю
+# Сколько голосовая почта ждёт выполнения записи, чтобы вернуть lead_id в ответе вебхука
+AMO_OUTBOX_SYNC_WAIT = float(os.getenv("AMO_OUTBOX_SYNC_WAIT", "15"))
 
+amo_stats = {"requests": 0, "retries": 0, "throttled": 0, "errors": 0,
+             "contact_index_hits": 0, "contact_index_misses": 0}
 
 
-async def update_amocrm_contact_helpdesk(contact_id: int, helpdesk_url: str) -> bool:
-    """Обновляет контакт в AmoCRM, добавляя ссылку на FreeScout"""
-    if not AMO_ACCESS_TOKEN:
-        return False
+class AmoCRMError(Exception):
+    """
+    Ошибка записи в AmoCRM. retryable=True - задачу outbox стоит повторить позже.
+    payload - JSON ответа AmoCRM (None, если ответа нет или он не JSON)
+    """
 
-    headers = {
+    def __init__(self, message: str, retryable: bool = True, payload: Optional[Dict[str, Any]] = None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.payload = payload
+
+
+class TokenBucket:
+    """Token bucket: не больше rate запросов в секунду с запасом burst. Общий на процесс"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = None
+
+    def pause(self, seconds: float):
+        """После 429 притормаживаем все запросы, а не только повторяемый"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # Под замком ждущие проходят строго по очереди
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+amo_rate_limiter = TokenBucket(AMO_RATE_LIMIT, AMO_RATE_BURST)
+
+
+def amo_headers() -> Dict[str, str]:
+    return {
         "Authorization": f"Bearer {AMO_ACCESS_TOKEN}",
         "Content-Type": "application/json"
     }
 
+
+def amo_backoff_delay(attempt: int, max_delay: float = AMO_RETRY_MAX_DELAY) -> float:
+    """Экспоненциальная задержка с джиттером: 0.5, 1, 2, 4... сек"""
+    delay = min(max_delay, AMO_RETRY_BASE_DELAY * (2 ** attempt))
+    return delay * random.uniform(0.8, 1.2)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After в секундах или HTTP-дате"""
+    if not value:
+        return None
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            contact_data = [{
-                "id": contact_id,
-                "custom_fields_values": [{
-                    "field_id": 2563559,  # HelpDesk ID
-                    "values": [{"value": helpdesk_url}]
-                }]
-            }]
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
 
-            response = await client.patch(
-                f"{AMO_BASE_URL}/api/v4/contacts",
-                json=contact_data,
-                headers=headers
-            )
 
-            if response.status_code in [200, 201]:
-                print(f"✅ AmoCRM контакт {contact_id} обновлен: HelpDesk = {helpdesk_url}")
-                return True
-            else:
-                print(f"⚠️  Не удалось обновить контакт AmoCRM: {response.status_code}")
-                print(f"Response: {response.text}")
-                return False
+async def amo_request(method: str, path: str, json: Any = None, params: Dict[str, Any] = None,
+                      timeout: Optional[float] = None, retries: int = AMO_MAX_RETRIES) -> httpx.Response:
+    """
+    Запрос к AmoCRM API через общий token bucket.
 
-    except Exception as e:
-        print(f"❌ Ошибка обновления контакта AmoCRM: {str(e)}")
-        return False
+    429, 5xx и таймауты повторяются с backoff (429 - с учётом Retry-After).
+    Возвращает последний ответ; сетевую ошибку после всех попыток пробрасывает.
+    """
+    url = path if path.startswith("http") else f"{AMO_BASE_URL}{path}"
+    extra = {"timeout": timeout} if timeout is not None else {}
 
+    for attempt in range(retries + 1):
+        await amo_rate_limiter.acquire()
+        amo_stats["requests"] += 1
+        try:
+            async with upstream_client("amocrm") as client:
+                response = await client.request(method, url, json=json, params=params,
+                                                headers=amo_headers(), **extra)
+        except httpx.TransportError as e:
+            amo_stats["errors"] += 1
+            if attempt >= retries:
+                raise
+            delay = amo_backoff_delay(attempt)
+            amo_stats["retries"] += 1
+            print(f"⚠️  [AMO] {method} {path}: {type(e).__name__}, повтор через {delay:.1f}с")
+            await asyncio.sleep(delay)
+            continue
+
+        if response.status_code not in AMO_RETRY_STATUSES or attempt >= retries:
+            return response
+
+        delay = amo_backoff_delay(attempt)
+        if response.status_code == 429:
+            amo_stats["throttled"] += 1
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is not None:
+                delay = min(AMO_RETRY_MAX_DELAY, max(delay, retry_after))
+            amo_rate_limiter.pause(delay)
+        amo_stats["retries"] += 1
+        print(f"⚠️  [AMO] {method} {path}: HTTP {response.status_code}, повтор через {delay:.1f}с")
+        await asyncio.sleep(delay)
+
+    return response
+
+
+async def amo_write(method: str, path: str, json: Any = None) -> Dict[str, Any]:
+    """
+    Запись в AmoCRM для задач outbox: возвращает JSON ответа или бросает AmoCRMError.
 
-async def update_amocrm_lead_ticket_number(lead_id: int, ticket_number: int) -> bool:
-    """Обновляет поле 'Число' (ID: 2578419) в лиде AmoCRM с номером тикета FreeScout"""
+    Временные ошибки (сеть, 429, 5xx) - retryable, остальные 4xx - нет.
+    """
     if not AMO_ACCESS_TOKEN:
-        print("⚠️  AMO_ACCESS_TOKEN не настроен")
-        return False
+        raise AmoCRMError("AmoCRM не настроен", retryable=False)
+    try:
+        response = await amo_request(method, path, json=json)
+    except httpx.TransportError as e:
+        raise AmoCRMError(f"{type(e).__name__}: {e}")
 
-    headers = {
-        "Authorization": f"Bearer {AMO_ACCESS_TOKEN}",
-        "Content-Type": "application/json"
+    if response.status_code in (200, 201, 202, 204):
+        return response.json() if response.content else {}
+
+    # 401 тоже повторяем: после замены токена и рестарта задача доиграется, а не потеряется
+    retryable = response.status_code in AMO_RETRY_STATUSES or response.status_code == 401
+    try:
+        payload = response.json()
+    except ValueError:
+        payload = None
+    raise AmoCRMError(f"HTTP {response.status_code}: {response.text[:500]}", retryable=retryable,
+                      payload=payload if isinstance(payload, dict) else None)
+
+
+def amo_embedded_id(data: Dict[str, Any], entity: str) -> Optional[int]:
+    """ID первой созданной сущности из ответа AmoCRM (_embedded.<entity>[0].id)"""
+    items = (data.get("_embedded") or {}).get(entity) or []
+    return items[0].get("id") if items else None
+
+
+# Индекс телефон → contact_id: переиспользуем существующие контакты вместо дублей.
+# Наполняется из ответов AmoCRM, поиска по телефону и вебхуков контактов
+AMO_CONTACT_INDEX_TTL = int(os.getenv("AMO_CONTACT_INDEX_TTL", str(30 * 86400)))
+AMO_WEBHOOK_CONTACT_KEY = re.compile(r"^contacts\[(add|update|delete)\]\[(\d+)\]\[(.+)$")
+AMO_WEBHOOK_FIELD_KEY = re.compile(r"^custom_fields\]\[(\d+)\]\[(code|values)\](?:\[(\d+)\]\[value\])?$")
+
+
+async def remember_amo_contact(phone: str, contact_id: int):
+    phone_key = normalize_phone(phone)
+    if not phone_key or not contact_id:
+        return
+    await state.set("amo_contact", phone_key, int(contact_id), ttl=AMO_CONTACT_INDEX_TTL)
+    phones = await state.get("amo_contact_phones", str(contact_id), [])
+    if phone_key not in phones:
+        await state.set("amo_contact_phones", str(contact_id), phones + [phone_key], ttl=AMO_CONTACT_INDEX_TTL)
+
+
+async def lookup_amo_contact(phone: str) -> Optional[int]:
+    phone_key = normalize_phone(phone)
+    contact_id = await state.get("amo_contact", phone_key) if phone_key else None
+    amo_stats["contact_index_hits" if contact_id else "contact_index_misses"] += 1
+    return contact_id
+
+
+async def forget_amo_contact(contact_id: int):
+    for phone_key in await state.get("amo_contact_phones", str(contact_id), []):
+        if await state.get("amo_contact", phone_key) == int(contact_id):
+            await state.delete("amo_contact", phone_key)
+    await state.delete("amo_contact_phones", str(contact_id))
+
+
+async def index_amocrm_webhook_contacts(form) -> int:
+    """
+    Обновляет индекс по вебхуку AmoCRM (contacts[add|update|delete][i][...]).
+
+    Возвращает количество обработанных контактов.
+    """
+    contacts = {}
+    for key, value in form.items():
+        match = AMO_WEBHOOK_CONTACT_KEY.match(key)
+        if not match:
+            continue
+        action, index, rest = match.groups()
+        contact = contacts.setdefault((action, index), {"id": None, "fields": {}})
+        if rest == "id]":
+            contact["id"] = value
+            continue
+        field_match = AMO_WEBHOOK_FIELD_KEY.match(rest)
+        if field_match:
+            field_index, part, _ = field_match.groups()
+            field = contact["fields"].setdefault(field_index, {"code": None, "values": []})
+            if part == "code":
+                field["code"] = value
+            else:
+                field["values"].append(value)
+
+    for (action, _), contact in contacts.items():
+        if not str(contact["id"] or "").isdigit():
+            continue
+        contact_id = int(contact["id"])
+        if action == "delete":
+            await forget_amo_contact(contact_id)
+            continue
+        for field in contact["fields"].values():
+            if field["code"] == "PHONE":
+                for phone in field["values"]:
+                    await remember_amo_contact(phone, contact_id)
+    return len(contacts)
+
+
+amo_outbox = JobQueue(AMO_OUTBOX_PATH, "amo_outbox", keep_done=AMO_OUTBOX_KEEP_DONE)
+
+
+async def submit_amo_write(kind: str, payload: Dict[str, Any], depends_on: Optional[int] = None,
+                           wait: float = 0) -> Dict[str, Any]:
+    """
+    Ставит запись в outbox AmoCRM.
+
+    wait=0 - возвращается сразу после сохранения задачи ({"queued": True, "job_id": ...}).
+    wait>0 - ждёт выполнения до wait секунд и возвращает результат задачи,
+    а по таймауту - тот же ответ "в очереди" (задача выполнится позже).
+    """
+    job_id = amo_outbox.enqueue(kind, payload, depends_on=depends_on)
+    print(f"📮 [AMO] Задача #{job_id} ({kind}) поставлена в очередь")
+    queued = {"success": True, "queued": True, "job_id": job_id}
+    if wait <= 0:
+        return queued
+
+    result = await amo_outbox.wait_result(job_id, wait)
+    if result is None:
+        print(f"⏳ [AMO] Задача #{job_id} ещё выполняется, ответ без ожидания")
+        return queued
+    return {**result, "job_id": job_id}
+
+
+def amo_lead_ref(result: Dict[str, Any]) -> Optional[Any]:
+    """ID лида, а пока лид в очереди - ссылка на задачу outbox вида "job:17" """
+    if result.get("lead_id"):
+        return result["lead_id"]
+    if result.get("job_id"):
+        return f"job:{result['job_id']}"
+    return None
+
+
+def parse_amo_lead_ref(lead_ref: Any) -> tuple:
+    """(lead_id, job_id) из ID лида или ссылки "job:17" (см. amo_lead_ref)"""
+    ref = str(lead_ref).strip()
+    if ref.startswith("job:"):
+        return None, int(ref[4:])
+    return int(ref), None
+
+
+def is_amo_contact_rejection(error: AmoCRMError) -> bool:
+    """
+    AmoCRM отклонил именно контакт: в ответе есть ошибка валидации с путём _embedded.contacts...
+    ({"validation-errors": [{"errors": [{"path": "_embedded.contacts.0.id", ...}]}]})
+    """
+    for item in (error.payload or {}).get("validation-errors") or []:
+        for detail in item.get("errors") or []:
+            if str(detail.get("path", "")).startswith("_embedded.contacts"):
+                return True
+    return False
+
+
+def resolve_outbox_lead_id(job: Dict[str, Any]) -> int:
+    """lead_id задачи: из payload или из результата родительской задачи на создание лида"""
+    lead_id = job["payload"].get("lead_id") or (job.get("parent_result") or {}).get("lead_id")
+    if not lead_id:
+        raise AmoCRMError("Не удалось определить lead_id", retryable=False)
+    return lead_id
+
+
+async def amo_job_create_lead(job: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Лид + контакт одним запросом (/api/v4/leads/complex), затем примечание.
+
+    Если телефон уже есть в индексе контактов - привязываем существующий контакт,
+    а не создаём дубль. Каждый шаг сохраняется в checkpoint сразу после запроса.
+    """
+    payload = job["payload"]
+    checkpoint = job["checkpoint"]
+    tag = payload.get("log_tag", "AMO")
+    phone = payload.get("phone", "")
+
+    if "lead_id" not in checkpoint:
+        lead_data = dict(payload["lead"])
+        contact_id = await lookup_amo_contact(phone) if phone else None
+        if contact_id:
+            lead_data["_embedded"] = {"contacts": [{"id": contact_id}]}
+        elif payload.get("contact"):
+            lead_data["_embedded"] = {"contacts": [payload["contact"]]}
+
+        try:
+            data = await amo_write("POST", "/api/v4/leads/complex", [lead_data])
+        except AmoCRMError as e:
+            if e.retryable or "_embedded" not in lead_data:
+                raise
+            if contact_id:
+                if not is_amo_contact_rejection(e):
+                    raise
+                # Контакт из индекса мог быть удалён/объединён - забываем и повторим с новым
+                await forget_amo_contact(contact_id)
+                raise AmoCRMError(f"Контакт {contact_id} из индекса не принят: {e}")
+            # Новый контакт не принят (например, некорректный email) - лид важнее, создаём без контакта
+            print(f"⚠️  [{tag}] Контакт не принят AmoCRM ({e}), создаём лид без контакта")
+            del lead_data["_embedded"]
+            data = await amo_write("POST", "/api/v4/leads/complex", [lead_data])
+
+        created = data[0] if isinstance(data, list) and data else {}
+        if not created.get("id"):
+            raise AmoCRMError("AmoCRM не вернул ID лида", retryable=False)
+        checkpoint["lead_id"] = created["id"]
+        checkpoint["contact_id"] = created.get("contact_id") or contact_id
+        amo_outbox.save_checkpoint(job)
+        if phone and checkpoint["contact_id"]:
+            await remember_amo_contact(phone, checkpoint["contact_id"])
+        contact_note = "существующий" if contact_id else "новый"
+        print(f"✅ [{tag}] AmoCRM лид создан: ID {created['id']}, контакт {checkpoint['contact_id']} ({contact_note})")
+
+    if payload.get("note_text") and "note_added" not in checkpoint:
+        # Примечание - не обязательный шаг: лид уже создан, поэтому отказ AmoCRM (или исчерпанные
+        # повторы) не делает задачу failed - иначе лид считался бы несозданным вместе с зависимыми задачами
+        try:
+            await amo_write("POST", "/api/v4/leads/notes", [{
+                "entity_id": checkpoint["lead_id"],
+                "note_type": "common",
+                "params": {"text": payload["note_text"]}
+            }])
+            checkpoint["note_added"] = True
+        except AmoCRMError as e:
+            if e.retryable and job["attempts"] + 1 < AMO_OUTBOX_MAX_ATTEMPTS:
+                raise
+            print(f"⚠️  [{tag}] Примечание к лиду {checkpoint['lead_id']} не добавлено: {e}")
+            checkpoint["note_added"] = False
+        amo_outbox.save_checkpoint(job)
+
+    return {
+        "success": True,
+        "lead_id": checkpoint["lead_id"],
+        "contact_id": checkpoint.get("contact_id"),
+        **payload.get("extra_result", {})
     }
 
+
+async def amo_job_lead_note(job: Dict[str, Any]) -> Dict[str, Any]:
+    lead_id = resolve_outbox_lead_id(job)
+    await amo_write("POST", "/api/v4/leads/notes", [{
+        "entity_id": lead_id,
+        "note_type": "common",
+        "params": {"text": job["payload"]["text"]}
+    }])
+    return {"success": True, "lead_id": lead_id}
+
+
+async def amo_job_contact_note(job: Dict[str, Any]) -> Dict[str, Any]:
+    payload = job["payload"]
+    await amo_write("POST", f"/api/v4/contacts/{payload['contact_id']}/notes", [{
+        "note_type": payload.get("note_type", "common"),
+        "params": {"text": payload["text"]}
+    }])
+    return {"success": True, "contact_id": payload["contact_id"]}
+
+
+async def amo_job_lead_task(job: Dict[str, Any]) -> Dict[str, Any]:
+    lead_id = resolve_outbox_lead_id(job)
+    task = dict(job["payload"]["task"], entity_id=lead_id, entity_type="leads")
+    data = await amo_write("POST", "/api/v4/tasks", [task])
+    task_id = amo_embedded_id(data, "tasks")
+    print(f"✅ [AMO] Задача создана: ID {task_id} (лид {lead_id})")
+    return {"success": True, "task_id": task_id, "lead_id": lead_id}
+
+
+async def amo_job_lead_referrer(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Поле 'Рекомендация' (ID: 2564027); если поле не принимается - примечанием"""
+    lead_id = resolve_outbox_lead_id(job)
+    referrer_value = job["payload"]["referrer"]
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            lead_data = [{
-                "id": lead_id,
-                "custom_fields_values": [{
-                    "field_id": 2578419,  # Поле 'Число' для номера тикета
-                    "values": [{"value": ticket_number}]
-                }]
+        await amo_write("PATCH", f"/api/v4/leads/{lead_id}", {
+            "custom_fields_values": [{
+                "field_id": 2564027,  # Рекомендация
+                "values": [{"value": referrer_value}]
             }]
+        })
+        return {"success": True, "lead_id": lead_id, "referrer": referrer_value}
+    except AmoCRMError as e:
+        if e.retryable:
+            raise
+        print(f"⚠️  [AMO] Поле источника не обновлено ({e}), добавляем примечание")
 
-            response = await client.patch(
-                f"{AMO_BASE_URL}/api/v4/leads",
-                json=lead_data,
-                headers=headers
-            )
+    await amo_write("POST", f"/api/v4/leads/{lead_id}/notes", [{
+        "note_type": "common",
+        "params": {"text": f"📊 Источник обращения: {referrer_value}"}
+    }])
+    return {"success": True, "lead_id": lead_id, "referrer": referrer_value, "as_note": True}
 
-            if response.status_code in [200, 201]:
-                print(f"✅ AmoCRM лид {lead_id} обновлен: Ticket Number = {ticket_number}")
-                return True
-            else:
-                print(f"⚠️  Не удалось обновить лид AmoCRM: {response.status_code}")
-                print(f"Response: {response.text}")
-                return False
+
+async def amo_job_connection_links(job: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Связывает лид на подключение с тикетом FreeScout: ссылка на FreeScout в контакте,
+    номер тикета в поле 'Число' (ID: 2578419) лида и ссылка на AmoCRM у customer FreeScout
+    """
+    payload = job["payload"]
+    checkpoint = job["checkpoint"]
+    parent = job.get("parent_result") or {}
+    lead_id = parent.get("lead_id")
+    contact_id = parent.get("contact_id")
+    customer_id = payload.get("customer_id")
+    ticket_number = payload.get("ticket_number")
+    if contact_id and not customer_id and payload.get("conversation_id"):
+        customer_id = await resolve_freescout_customer_id(payload["conversation_id"], payload.get("customer_email", ""))
+
+    if contact_id and customer_id and not checkpoint.get("helpdesk"):
+        helpdesk_url = f"{FREESCOUT_URL}/customers/{customer_id}"
+        await amo_write("PATCH", "/api/v4/contacts", [{
+            "id": contact_id,
+            "custom_fields_values": [{
+                "field_id": 2563559,  # HelpDesk ID
+                "values": [{"value": helpdesk_url}]
+            }]
+        }])
+        checkpoint["helpdesk"] = True
+        amo_outbox.save_checkpoint(job)
+        print(f"✅ AmoCRM контакт {contact_id} обновлен: HelpDesk = {helpdesk_url}")
+
+    if lead_id and ticket_number and not checkpoint.get("ticket_number"):
+        await amo_write("PATCH", "/api/v4/leads", [{
+            "id": lead_id,
+            "custom_fields_values": [{
+                "field_id": 2578419,  # Поле 'Число' для номера тикета
+                "values": [{"value": ticket_number}]
+            }]
+        }])
+        checkpoint["ticket_number"] = True
+        amo_outbox.save_checkpoint(job)
+        print(f"✅ AmoCRM лид {lead_id} обновлен: Ticket Number = {ticket_number}")
+
+    if contact_id and customer_id and not checkpoint.get("freescout_customer"):
+        await update_freescout_customer_full(
+            customer_id=customer_id,
+            amocrm_contact_url=f"{AMO_BASE_URL}/contacts/detail/{contact_id}",
+            city=payload.get("city", ""),
+            address=payload.get("address", ""),
+            tariff=payload.get("tariff", "")
+        )
+        checkpoint["freescout_customer"] = True
+        amo_outbox.save_checkpoint(job)
+
+    return {"success": True, "lead_id": lead_id, "contact_id": contact_id}
+
+
+AMO_OUTBOX_HANDLERS = {
+    "create_lead": amo_job_create_lead,
+    "lead_note": amo_job_lead_note,
+    "contact_note": amo_job_contact_note,
+    "lead_task": amo_job_lead_task,
+    "lead_referrer": amo_job_lead_referrer,
+    "connection_links": amo_job_connection_links,
+}
+
+
+async def amo_outbox_worker():
+    """
+    Воркер outbox AmoCRM: задачи строго по очереди - лимит AmoCRM всё равно общий.
+    При нескольких воркерах uvicorn работает только в одном (run_as_leader)
+    """
+    await run_as_leader("amo_outbox", lambda: run_job_queue(
+        amo_outbox, AMO_OUTBOX_HANDLERS, concurrency=1, max_attempts=AMO_OUTBOX_MAX_ATTEMPTS,
+        max_delay=AMO_OUTBOX_MAX_DELAY, tag="AMO"))
+
+
+def amo_outbox_stats() -> Dict[str, Any]:
+    return {**amo_outbox.stats(), **amo_stats}
+
+
+async def create_amocrm_lead(
+    name: str,
+    phone: str,
+    address: str,
+    tariff: str = "",
+    comment: str = "",
+    email: str = "",
+    router_option: str = "",
+    static_ip: str = "",
+    cctv_option: str = "",
+    preferred_date: str = "",
+    preferred_time: str = "",
+    utm_source: str = "",
+    utm_medium: str = "",
+    utm_campaign: str = "",
+    utm_content: str = "",
+    utm_term: str = ""
+) -> Dict[str, Any]:
+    """
+    Ставит в outbox создание контакта и лида в AmoCRM. Кастомные поля подключения добавляются в ЛИД.
+
+    Возвращается сразу после постановки в очередь: {"success": True, "queued": True, "job_id": ...}
+    """
+    if not AMO_ACCESS_TOKEN:
+        return {"success": False, "lead_id": None, "error": "AmoCRM не настроен"}
+
+    try:
+        # Шаг 1: КОНТАКТ только с базовыми полями (если телефона нет в индексе контактов)
+        contact_custom_fields = [
+            {
+                "field_code": "PHONE",
+                "values": [{"value": phone, "enum_code": "WORK"}]
+            }
+        ]
+
+        # Добавляем email если указан
+        if email:
+            contact_custom_fields.append({
+                "field_code": "EMAIL",
+                "values": [{"value": email, "enum_code": "WORK"}]
+            })
+
+        contact_data = {
+            "name": name,
+            "custom_fields_values": contact_custom_fields
+        }
+
+        # Шаг 2: Создаем ЛИД с кастомными полями
+        lead_custom_fields = []
+
+        # Адрес подключения (новое поле лида)
+        if address:
+            lead_custom_fields.append({
+                "field_id": AMO_CF_LEAD_ADDRESS,  # 2578887
+                "values": [{"value": address}]
+            })
+
+        # Тариф (новое поле лида - textarea)
+        if tariff:
+            lead_custom_fields.append({
+                "field_id": AMO_CF_LEAD_TARIFF,  # 2578883
+                "values": [{"value": tariff}]
+            })
+
+        # Роутер
+        if router_option:
+            lead_custom_fields.append({
+                "field_id": AMO_CF_LEAD_ROUTER,  # 2578885
+                "values": [{"value": router_option}]
+            })
+
+        # Видеонаблюдение
+        if cctv_option:
+            cctv_value = cctv_option if cctv_option != "нет" else "нет"
+            lead_custom_fields.append({
+                "field_id": AMO_CF_LEAD_CCTV,  # 2578889
+                "values": [{"value": cctv_value}]
+            })
+
+        # Постоянный IP (checkbox)
+        if static_ip:
+            flag_value = True if static_ip == "да" else False
+            lead_custom_fields.append({
+                "field_id": AMO_CF_LEAD_STATIC_IP,  # 2578891
+                "values": [{"value": flag_value}]
+            })
+
+        # Дата подключения
+        if preferred_date:
+            try:
+                from datetime import datetime
+                import locale
+                import re
+                
+                # Словарь русских названий месяцев
+                ru_months = {
+                    'января': '01', 'февраля': '02', 'марта': '03', 'апреля': '04',
+                    'мая': '05', 'июня': '06', 'июля': '07', 'августа': '08',
+                    'сентября': '09', 'октября': '10', 'ноября': '11', 'декабря': '12'
+                }
+                
+                date_str = preferred_date.strip()
+                dt = None
+                
+                # Пробуем распарсить русское название месяца (например: "25 ноября 2025")
+                pattern = r'(\d{1,2})\s+(января|февраля|марта|апреля|мая|июня|июля|августа|сентября|октября|ноября|декабря)\s+(\d{4})'
+                match = re.search(pattern, date_str.lower())
+                if match:
+                    day = match.group(1).zfill(2)
+                    month = ru_months[match.group(2)]
+                    year = match.group(3)
+                    dt = datetime.strptime(f"{day}.{month}.{year}", "%d.%m.%Y")
+                else:
+                    # Пробуем другие форматы
+                    formats = ["%d.%m.%Y", "%Y-%m-%d", "%d/%m/%Y"]
+                    for fmt in formats:
+                        try:
+                            dt = datetime.strptime(date_str, fmt)
+                            break
+                        except ValueError:
+                            continue
+                
+                if dt:
+                    timestamp = int(dt.timestamp())
+                    lead_custom_fields.append({
+                        "field_id": AMO_CF_LEAD_CONNECTION_DATE,  # 2578411
+                        "values": [{"value": timestamp}]
+                    })
+                    print(f"✅ Дата подключения распарсена: {dt.strftime('%d.%m.%Y')}")
+                else:
+                    print(f"⚠️  Не удалось распарсить дату '{preferred_date}'")
+            except Exception as e:
+                print(f"⚠️  Ошибка парсинга даты '{preferred_date}': {e}")
+
+        # Время подключения
+        if preferred_time:
+            lead_custom_fields.append({
+                "field_id": AMO_CF_LEAD_CONNECTION_TIME,  # 2578413
+                "values": [{"value": preferred_time}]
+            })
+
+
+        # UTM метки (tracking_data)
+        if utm_source:
+            lead_custom_fields.append({
+                "field_id": AMO_CF_LEAD_UTM_SOURCE,  # 2563561
+                "values": [{"value": utm_source}]
+            })
+        if utm_medium:
+            lead_custom_fields.append({
+                "field_id": AMO_CF_LEAD_UTM_MEDIUM,  # 2563565
+                "values": [{"value": utm_medium}]
+            })
+        if utm_campaign:
+            lead_custom_fields.append({
+                "field_id": AMO_CF_LEAD_UTM_CAMPAIGN,  # 2563563
+                "values": [{"value": utm_campaign}]
+            })
+        if utm_content:
+            lead_custom_fields.append({
+                "field_id": AMO_CF_LEAD_UTM_CONTENT,  # 2563567
+                "values": [{"value": utm_content}]
+            })
+        if utm_term:
+            lead_custom_fields.append({
+                "field_id": AMO_CF_LEAD_UTM_TERM,  # 2563569
+                "values": [{"value": utm_term}]
+            })
+
+        lead_data = {
+            "name": f"Подключение: {address}",
+            "price": 0,
+            "pipeline_id": AMO_PIPELINE_B2C_ID,
+            "status_id": 79103554,  # Тариф выбран
+            "responsible_user_id": AMO_DEFAULT_RESPONSIBLE_USER_ID,
+            "custom_fields_values": lead_custom_fields
+        }
+
+        # Шаг 3: Примечание с деталями
+        note_text = f"🤖 Заявка от AI Ассистента\n\n"
+        note_text += f"📍 Адрес: {address}\n"
+        if tariff:
+            note_text += f"💼 Тариф: {tariff}\n"
+        if router_option:
+            note_text += f"📶 Роутер: {router_option}\n"
+        if cctv_option and cctv_option != "нет":
+            note_text += f"📹 Видеонаблюдение: {cctv_option}\n"
+        if static_ip == "да":
+            note_text += f"📍 Постоянный IP: да\n"
+        if comment:
+            note_text += f"\n💬 Комментарий клиента:\n{comment}"
+
+        # Контакт привяжет к лиду воркер outbox после создания
+        return await submit_amo_write("create_lead", {
+            "phone": phone,
+            "contact": contact_data,
+            "lead": lead_data,
+            "note_text": note_text
+        })
 
     except Exception as e:
-        print(f"❌ Ошибка обновления лида AmoCRM: {str(e)}")
-        return False
+        print(f"❌ AmoCRM исключение: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return {"success": False, "lead_id": None, "error": str(e)}
+
+
+
 
 async def update_freescout_customer_full(customer_id: int, amocrm_contact_url: str, city: str = "", address: str = "", tariff: str = "") -> bool:
     """Обновляет customer в FreeScout с полными данными"""
@@ -1407,7 +3811,7 @@ async def update_freescout_customer_full(customer_id: int, amocrm_contact_url: s
             payload["address"] = {}
         payload["address"]["state"] = tariff
 
-    async with httpx.AsyncClient(timeout=30.0, follow_redirects=True) as client:
+    async with upstream_client("freescout") as client:
         try:
             resp = await client.put(url, json=payload, headers=headers)
             resp.raise_for_status()
@@ -1474,7 +3878,7 @@ async def update_freescout_customer_from_billing(customer_id: int, phone: str) -
 
     url = f"{FREESCOUT_URL}/api/customers/{customer_id}"
 
-    async with httpx.AsyncClient(timeout=30.0) as client_http:
+    async with upstream_client("freescout") as client_http:
         try:
             resp = await client_http.put(url, headers=headers, json=payload)
 
@@ -1523,68 +3927,44 @@ async def find_amocrm_contact_by_phone(phone: str) -> Optional[int]:
     """Ищет контакт AmoCRM по номеру телефона"""
     phone_normalized = normalize_phone(phone)
 
-    url = f"{AMO_BASE_URL}/api/v4/contacts"
-    headers = {
-        "Authorization": f"Bearer {AMO_ACCESS_TOKEN}",
-        "Content-Type": "application/json"
-    }
+    contact_id = await lookup_amo_contact(phone_normalized)
+    if contact_id:
+        return contact_id
 
-    # Поиск по телефону
-    params = {
-        "query": phone_normalized
-    }
+    try:
+        # Поиск по телефону
+        resp = await amo_request("GET", "/api/v4/contacts", params={"query": phone_normalized})
+        if resp.status_code == 200:
+            data = resp.json()
+            contacts = data.get("_embedded", {}).get("contacts", [])
+            if contacts:
+                print(f"✅ Найден контакт AmoCRM: {contacts[0]['id']} для телефона {phone_normalized}")
+                await remember_amo_contact(phone_normalized, contacts[0]["id"])
+                return contacts[0]["id"]
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            resp = await client.get(url, headers=headers, params=params)
-            if resp.status_code == 200:
-                data = resp.json()
-                contacts = data.get("_embedded", {}).get("contacts", [])
-                if contacts:
-                    print(f"✅ Найден контакт AmoCRM: {contacts[0]['id']} для телефона {phone_normalized}")
-                    return contacts[0]["id"]
-
-            print(f"⚠️  Контакт AmoCRM не найден для телефона {phone_normalized}")
-            return None
-        except Exception as e:
-            print(f"❌ Ошибка поиска контакта AmoCRM: {str(e)}")
-            return None
+        print(f"⚠️  Контакт AmoCRM не найден для телефона {phone_normalized}")
+        return None
+    except Exception as e:
+        print(f"❌ Ошибка поиска контакта AmoCRM: {str(e)}")
+        return None
 
 
 async def add_note_to_amocrm_contact(contact_id: int, note_text: str, note_type: str = "common") -> bool:
     """
-    Добавляет примечание к контакту в AmoCRM
+    Ставит в outbox примечание к контакту в AmoCRM
 
     note_type: common (обычное), call_in (входящий звонок), call_out (исходящий)
     """
-    url = f"{AMO_BASE_URL}/api/v4/contacts/{contact_id}/notes"
-    headers = {
-        "Authorization": f"Bearer {AMO_ACCESS_TOKEN}",
-        "Content-Type": "application/json"
-    }
-
-    payload = [
-        {
-            "note_type": note_type,
-            "params": {
-                "text": note_text
-            }
-        }
-    ]
-
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            resp = await client.post(url, headers=headers, json=payload)
-            if resp.status_code in [200, 201]:
-                print(f"✅ Примечание добавлено к контакту {contact_id}")
-                return True
-            else:
-                print(f"❌ Ошибка добавления примечания: {resp.status_code}")
-                print(resp.text)
-                return False
-        except Exception as e:
-            print(f"❌ Ошибка при добавлении примечания: {str(e)}")
-            return False
+    try:
+        await submit_amo_write("contact_note", {
+            "contact_id": contact_id,
+            "text": note_text,
+            "note_type": note_type
+        })
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка при добавлении примечания: {str(e)}")
+        return False
 
 
 async def handle_freescout_ticket_created(data: Dict[str, Any]) -> Dict[str, Any]:
@@ -1763,7 +4143,7 @@ async def create_lead(
         print(f"   Phone: {phone}")
         print(f"   Address: {address}")
         print(f"   Tariff: {tariff}")
-        # Создаем лид в AmoCRM
+        # Ставим лид в очередь AmoCRM - ответ клиенту не ждёт AmoCRM
 
     # ВАЖНО: Поле "Рекомендация" (ID: 2564027) заполняется отдельной функцией update_lead_referrer
     # После создания лида нужно вызвать update_lead_referrer(lead_id, referrer_text)
@@ -1812,14 +4192,8 @@ async def create_lead(
             if utm_term:
                 message += f"  Term: {utm_term}\n"
 
-        # Ссылки на AmoCRM
-        if amo_result.get("success"):
-            if amo_result.get("lead_id"):
-                lead_url = f"{AMO_BASE_URL}/leads/detail/{amo_result['lead_id']}"
-                message += f"\n🔗 AmoCRM Лид: {lead_url}"
-            if amo_result.get("contact_id"):
-                contact_url = f"{AMO_BASE_URL}/contacts/detail/{amo_result['contact_id']}"
-                message += f"\n👤 AmoCRM Контакт: {contact_url}"
+        # Лид в AmoCRM ещё в очереди - ссылка на контакт попадёт в customer FreeScout
+        # задачей connection_links после его создания
 
         # Кастомные поля FreeScout (правильный маппинг)
         custom_fields = {
@@ -1835,10 +4209,11 @@ async def create_lead(
         }
 
         # Создаем тикет в mailbox 5 "Подключение"
+        customer_email = email if email else f"{phone.replace('+', '').replace(' ', '')}@customer.local" if phone else "customer@customer.local"
         result = await create_freescout_ticket(
             subject=f"Новое подключение: {address}",
             message=message,
-            customer_email=email if email else f"{phone.replace('+', '').replace(' ', '')}@customer.local" if phone else "customer@customer.local",
+            customer_email=customer_email,
             customer_name=name,
             customer_phone=phone,
             mailbox_id=5,
@@ -1849,25 +4224,17 @@ async def create_lead(
             ticket_number = result.get("ticket_number")
             customer_id = result.get("customer_id")
 
-            # Обновляем контакт в AmoCRM со ссылкой на FreeScout
-            if amo_result.get("contact_id") and customer_id:
-                helpdesk_url = f"{FREESCOUT_URL}/customers/{customer_id}"
-                await update_amocrm_contact_helpdesk(amo_result["contact_id"], helpdesk_url)
-
-
-            # Обновляем поле 'Число' в лиде AmoCRM с номером тикета FreeScout
-            if amo_result.get('lead_id') and ticket_number:
-                await update_amocrm_lead_ticket_number(amo_result['lead_id'], ticket_number)
-            # Обновляем customer в FreeScout с полными данными
-            if amo_result.get("contact_id") and customer_id:
-                amocrm_contact_url = f"{AMO_BASE_URL}/contacts/detail/{amo_result['contact_id']}"
-                await update_freescout_customer_full(
-                    customer_id=customer_id,
-                    amocrm_contact_url=amocrm_contact_url,
-                    city=city,
-                    address=address,
-                    tariff=tariff
-                )
+            # Связываем лид AmoCRM с тикетом FreeScout, когда лид будет создан
+            if amo_result.get("job_id"):
+                await submit_amo_write("connection_links", {
+                    "customer_id": customer_id,
+                    "conversation_id": result.get("conversation_id"),
+                    "customer_email": customer_email,
+                    "ticket_number": ticket_number,
+                    "city": city,
+                    "address": address,
+                    "tariff": tariff
+                }, depends_on=amo_result["job_id"])
 
             # Формируем подтверждение в нужном формате
             response_msg = f"Итак, {name},\n"
@@ -1912,7 +4279,7 @@ async def create_lead(
                 "success": True,
                 "message": response_msg,
                 "ticket_number": ticket_number,
-                "amo_lead_id": amo_result.get("lead_id")
+                "amo_lead_id": amo_lead_ref(amo_result)
             }
         else:
             return {"success": False, "message": "Не удалось создать заявку. Попробуйте позже."}
@@ -1925,12 +4292,12 @@ async def create_lead(
 
 
 
-async def update_lead_referrer(lead_id: int, referrer: str) -> dict:
+async def update_lead_referrer(lead_id, referrer: str) -> dict:
     """
     Обновляет источник обращения (referrer) в лиде AmoCRM
 
     Args:
-        lead_id: ID лида в AmoCRM
+        lead_id: ID лида в AmoCRM или ссылка "job:N" на лид в очереди (amo_lead_id из create_lead)
         referrer: Источник ("Рекомендация", "Реклама", "Интернет", "Соседи", "Другое")
 
     Returns:
@@ -1975,63 +4342,20 @@ async def update_lead_referrer(lead_id: int, referrer: str) -> dict:
                 referrer_value = value
                 break
 
-        # Обновляем лид через AmoCRM API
-        url = f"{AMO_BASE_URL}/api/v4/leads/{lead_id}"
-        headers = {
-            "Authorization": f"Bearer {AMO_ACCESS_TOKEN}",
-            "Content-Type": "application/json"
-        }
+        # Поле "Рекомендация" (ID: 2564027) обновит воркер outbox,
+        # если лид ещё в очереди - сразу после его создания
+        target_lead_id, lead_job_id = parse_amo_lead_ref(lead_id)
+        payload = {"referrer": referrer_value}
+        if target_lead_id:
+            payload["lead_id"] = target_lead_id
+        await submit_amo_write("lead_referrer", payload, depends_on=lead_job_id)
 
-        # Обновляем поле "Рекомендация" (ID: 2564027) в AmoCRM
-        data = {
-            "custom_fields_values": [
-                {
-                    "field_id": 2564027,  # Рекомендация
-                    "values": [{"value": referrer_value}]
-                }
-            ]
+        return {
+            "success": True,
+            "message": "Источник сохранен",
+            "referrer": referrer_value
         }
 
-        async with httpx.AsyncClient() as client:
-            response = await client.patch(url, json=data, headers=headers, timeout=30.0)
-
-            if response.status_code == 200:
-                pass  # Повторный поиск
-                return {
-                    "success": True,
-                    "message": f"Источник сохранен",
-                    "referrer": referrer_value
-                }
-            else:
-                # Если не получилось через поле - добавим примечание
-                pass  # Город не совпадает
-
-                # Добавляем примечание вместо поля
-                note_data = [
-                    {
-                        "note_type": "common",
-                        "params": {
-                            "text": f"📊 Источник обращения: {referrer_value}"
-                        }
-                    }
-                ]
-
-                note_url = f"{AMO_BASE_URL}/api/v4/leads/{lead_id}/notes"
-                note_response = await client.post(note_url, json=note_data, headers=headers, timeout=30.0)
-
-                if note_response.status_code in [200, 201]:
-                    pass  # Повторный поиск
-                    return {
-                        "success": True,
-                        "message": f"Источник сохранен (примечание)",
-                        "referrer": referrer_value
-                    }
-                else:
-                    return {
-                        "success": False,
-                        "message": f"Ошибка: {note_response.status_code}"
-                    }
-
     except Exception as e:
         print(f"❌ Ошибка update_lead_referrer: {e}")
         return {
@@ -2284,6 +4608,109 @@ async def add_to_waiting_list(name: str, phone: str, address: str, city: str = "
         traceback.print_exc()
         return {"success": False, "message": "Ошибка добавления в лист ожидания: " + str(e)}
 
+# ==================== FREESCOUT: CUSTOMER И ФОНОВЫЕ ДОРАБОТКИ ====================
+# Тикет создаётся одним POST: customer_id берём из ответа или из кэша email → customer,
+# а обновление имени и поиск customer_id уходят в свою очередь FreeScout (JobQueue) -
+# они не ждут записей в AmoCRM и не подчиняются её лимитам
+
+FREESCOUT_CUSTOMER_CACHE_TTL = int(os.getenv("FREESCOUT_CUSTOMER_CACHE_TTL", str(30 * 86400)))
+FREESCOUT_OUTBOX_PATH = os.getenv("FREESCOUT_OUTBOX_PATH", os.path.join(os.path.dirname(__file__), "freescout_outbox.db"))
+FREESCOUT_OUTBOX_CONCURRENCY = int(os.getenv("FREESCOUT_OUTBOX_CONCURRENCY", "2"))
+FREESCOUT_OUTBOX_MAX_ATTEMPTS = int(os.getenv("FREESCOUT_OUTBOX_MAX_ATTEMPTS", "8"))
+FREESCOUT_OUTBOX_MAX_DELAY = float(os.getenv("FREESCOUT_OUTBOX_MAX_DELAY", "600"))
+
+
+class FreeScoutError(Exception):
+    """Ошибка запроса к FreeScout из фоновой задачи. retryable=True - повторить позже"""
+
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+async def remember_freescout_customer(email: str, customer_id: int):
+    if email and customer_id:
+        await state.set("freescout_customer", email.strip().lower(), int(customer_id), ttl=FREESCOUT_CUSTOMER_CACHE_TTL)
+
+
+async def lookup_freescout_customer(email: str) -> Optional[int]:
+    """
+    customer_id по email. FreeScout сопоставляет customer именно по email
+    (а синтетические email у разных ящиков разные), поэтому ключ - только email
+    """
+    return await state.get("freescout_customer", email.strip().lower()) if email else None
+
+
+async def freescout_request(method: str, path: str, json: Any = None) -> Dict[str, Any]:
+    """Запрос к FreeScout API для фоновых задач: JSON ответа или FreeScoutError"""
+    if not FREESCOUT_API_KEY:
+        raise FreeScoutError("FreeScout API key не настроен", retryable=False)
+    headers = {
+        "X-FreeScout-API-Key": FREESCOUT_API_KEY,
+        "Content-Type": "application/json"
+    }
+    try:
+        async with upstream_client("freescout") as client:
+            resp = await client.request(method, f"{FREESCOUT_URL}{path}", json=json, headers=headers)
+    except httpx.TransportError as e:
+        raise FreeScoutError(f"{type(e).__name__}: {e}")
+
+    if resp.status_code in (200, 201, 204):
+        return resp.json() if resp.content else {}
+    raise FreeScoutError(f"HTTP {resp.status_code}: {resp.text[:500]}",
+                         retryable=resp.status_code == 429 or resp.status_code >= 500)
+
+
+async def resolve_freescout_customer_id(conversation_id: Optional[int], email: str = "") -> Optional[int]:
+    """customer_id из кэша, а если его нет - из самой conversation (результат кэшируется)"""
+    customer_id = await lookup_freescout_customer(email)
+    if customer_id or not conversation_id:
+        return customer_id
+    conv_data = await freescout_request("GET", f"/api/conversations/{conversation_id}")
+    customer_id = (conv_data.get("customer") or {}).get("id")
+    if customer_id:
+        await remember_freescout_customer(email, customer_id)
+        print(f"✅ FreeScout customer ID получен: {customer_id}")
+    return customer_id
+
+
+async def freescout_job_customer_name(job: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Имя клиента в FreeScout: у существующего customer FreeScout не меняет firstName
+    при создании conversation, поэтому обновляем его отдельно
+    """
+    payload = job["payload"]
+    customer_id = payload.get("customer_id") or await resolve_freescout_customer_id(
+        payload.get("conversation_id"), payload.get("customer_email", "")
+    )
+    if not customer_id:
+        raise FreeScoutError("customer_id не найден в conversation", retryable=False)
+    await freescout_request("PUT", f"/api/customers/{customer_id}", {"firstName": payload["first_name"]})
+    print(f"✅ Имя клиента обновлено: {payload['first_name']}")
+    return {"success": True, "customer_id": customer_id}
+
+
+freescout_outbox = JobQueue(FREESCOUT_OUTBOX_PATH, "freescout_outbox", keep_done=AMO_OUTBOX_KEEP_DONE)
+
+FREESCOUT_OUTBOX_HANDLERS = {
+    "customer_name": freescout_job_customer_name,
+}
+# Задачи, поставленные в outbox AmoCRM до появления очереди FreeScout, доигрываются там же
+AMO_OUTBOX_HANDLERS["freescout_customer_name"] = freescout_job_customer_name
+
+
+def submit_freescout_job(kind: str, payload: Dict[str, Any]) -> int:
+    job_id = freescout_outbox.enqueue(kind, payload)
+    print(f"📮 [FREESCOUT] Задача #{job_id} ({kind}) поставлена в очередь")
+    return job_id
+
+
+async def freescout_outbox_worker():
+    await run_job_queue(freescout_outbox, FREESCOUT_OUTBOX_HANDLERS, concurrency=FREESCOUT_OUTBOX_CONCURRENCY,
+                        max_attempts=FREESCOUT_OUTBOX_MAX_ATTEMPTS, max_delay=FREESCOUT_OUTBOX_MAX_DELAY,
+                        tag="FREESCOUT")
+
+
 async def create_freescout_ticket(subject: str, customer_email: str, customer_name: str, message: str, customer_phone: str, mailbox_id: int = None, thread_type: str = "message", referrer: Optional[str] = None, custom_fields: Dict[str, Any] = None) -> Dict[str, Any]:
     """Создаёт тикет в FreeScout"""
     # ДОБАВЛЕНО: Начальное логирование
@@ -2339,7 +4766,7 @@ async def create_freescout_ticket(subject: str, customer_email: str, customer_na
             for field_id, value in custom_fields.items()
         ]
 
-    async with httpx.AsyncClient(timeout=30.0, follow_redirects=True) as client:
+    async with upstream_client("freescout") as client:
         try:
             print(f"🔧 [FreeScout] Отправка POST запроса к {url}")
             resp = await client.post(url, json=payload, headers=headers)
@@ -2357,45 +4784,32 @@ async def create_freescout_ticket(subject: str, customer_email: str, customer_na
                 }
             
             resp.raise_for_status()
-            data = resp.json()
+            data = resp.json() if resp.content else {}
             
             print(f"✅ [FreeScout] Тикет создан успешно")
 
-            # Получаем conversation_id для последующего получения customer_id
-            conversation_id = data.get("id")
+            conversation_id = data.get("id") or resp.headers.get("Resource-ID")
             ticket_number = data.get("number")
             
             print(f"✅ [FreeScout] Conversation ID: {conversation_id}, Ticket #: {ticket_number}")
 
-            # Получаем customer_id через повторный запрос conversation
-            customer_id = None
-            try:
-                resp2 = await client.get(
-                    f"{FREESCOUT_URL}/api/conversations/{conversation_id}",
-                    headers=headers
-                )
-                if resp2.status_code == 200:
-                    conv_data = resp2.json()
-                    if conv_data.get("customer"):
-                        customer_id = conv_data["customer"].get("id")
-                        print(f"✅ FreeScout customer ID получен: {customer_id}")
-                        # Обновляем имя клиента в FreeScout
-                        try:
-                            update_resp = await client.put(
-                                f"{FREESCOUT_URL}/api/customers/{customer_id}",
-                                headers=headers,
-                                json={"firstName": customer_name}
-                            )
-                            if update_resp.status_code == 200:
-                                print(f"✅ Имя клиента обновлено: {customer_name}")
-                        except Exception as update_err:
-                            print(f"⚠️  Не удалось обновить имя клиента: {str(update_err)}")
-            except Exception as e:
-                print(f"⚠️  Не удалось получить customer_id: {str(e)}")
+            # customer_id - из ответа на создание или из кэша, без дополнительных запросов
+            customer_id = (data.get("customer") or {}).get("id") or await lookup_freescout_customer(customer_email)
+            if customer_id:
+                await remember_freescout_customer(customer_email, customer_id)
+
+            # Обновление имени (и поиск customer_id, если его нет) - в фоне
+            submit_freescout_job("customer_name", {
+                "conversation_id": conversation_id,
+                "customer_id": customer_id,
+                "customer_email": customer_email,
+                "first_name": customer_name
+            })
 
             return {
                 "success": True,
                 "ticket_id": conversation_id,
+                "conversation_id": conversation_id,
                 "ticket_number": ticket_number,
                 "customer_id": customer_id,
                 "message": f"Тикет #{ticket_number} создан в FreeScout"
@@ -2704,8 +5118,8 @@ FUNCTIONS = [
             "type": "object",
             "properties": {
                 "lead_id": {
-                    "type": "integer",
-                    "description": "ID лида в AmoCRM (получен после вызова create_lead)"
+                    "type": "string",
+                    "description": "amo_lead_id из ответа create_lead (число или вида 'job:17') - передай как есть"
                 },
                 "referrer": {
                     "type": "string",
@@ -2788,7 +5202,7 @@ SYSTEM_PROMPT = """
 
 После подтверждения данных клиентом:
 1. Вызови функцию **create_lead** с ВСЕМИ собранными параметрами
-2. Дождись результата (lead_id будет в ответе)
+2. Дождись результата (amo_lead_id будет в ответе - передай его в update_lead_referrer как есть)
 3. Переходи к Шагу 9
 
 9️⃣ Шаг 9: Вопрос Как узнали о нас? → update_lead_referrer
@@ -4747,94 +7161,797 @@ n   **ПЕРЕД вызовом schedule_callback ОБЯЗАТЕЛЬНО соб
 
 ### ШАГ 4: Создание заявки
 
-После сбора данных вызови `schedule_callback`:
-- topic: "Переезд/перенос интернета"
-- comment: f"Старый адрес: {old_address}. Новый адрес: {new_address}"
-- address: new_address
-- preferred_time: дата переезда
-- problem_summary: f"Запрос на перенос интернета. Текущий адрес: {old_address}. Новый адрес: {new_address}. Дата переезда: {date}. Тариф сохраняется: {tariff}"
-- house_type: ОБЯЗАТЕЛЬНО уточни
-- apartment: если квартира
+После сбора данных вызови `schedule_callback`:
+- topic: "Переезд/перенос интернета"
+- comment: f"Старый адрес: {old_address}. Новый адрес: {new_address}"
+- address: new_address
+- preferred_time: дата переезда
+- problem_summary: f"Запрос на перенос интернета. Текущий адрес: {old_address}. Новый адрес: {new_address}. Дата переезда: {date}. Тариф сохраняется: {tariff}"
+- house_type: ОБЯЗАТЕЛЬНО уточни
+- apartment: если квартира
+
+---
+
+## 📚 Сценарий 6: Q&A (вопросы и ответы)
+1. При вопросах о тарифах, оплате, настройках — используй `find_answer_in_kb`.
+2. Если ответа нет — предложи создать заявку через schedule_callback.
+
+---
+
+## 💡 Правила общения
+✅ Отвечай лаконично и дружелюбно
+✅ Всегда на русском языке
+✅ **Обращайся к клиентам по имени, если оно известно** (например: "Тарас Викторович, давайте проверю...")
+✅ Не спрашивай номер договора — всё определяется по телефону
+✅ Используй эмодзи умеренно (😊 👍 ✅)
+❌ Не выдумывай данные о тарифах или балансе
+❌ Не спрашивай лишнюю персональную информацию
+❌ Не придумывай причины проблем — проверяй через инструменты
+
+## ⚠️ КРИТИЧЕСКИ ВАЖНО: Контекст сессии
+🔴 **НЕ ЗАПРАШИВАЙ ПОВТОРНО информацию, которую клиент УЖЕ ПРЕДОСТАВИЛ в текущей сессии!**
+- Если номер телефона уже был введён и клиент идентифицирован (получены данные о балансе/договоре) — НЕ СПРАШИВАЙ номер телефона снова
+- Если клиент уже назвал имя или адрес — используй эту информацию из истории сообщений
+- Внимательно читай историю диалога перед тем как что-то запрашивать
+- При технических проблемах у СУЩЕСТВУЮЩЕГО клиента сразу переходи к диагностике, не запрашивай телефон заново"""
+
+# ==================== МОДУЛИ SYSTEM PROMPT ====================
+# Полный SYSTEM_PROMPT слишком большой, чтобы отправлять его целиком на каждой итерации.
+# Он режется по заголовкам сценариев на ядро (всегда) и модули (по ситуации).
+
+# (префикс заголовка, модуль, из какого модуля допустим переход)
+# None в качестве модуля = ядро; None в третьем поле = переход из любого раздела
+PROMPT_SECTION_RULES = [
+    ("## 🆕 Сценарий 2:", "connection", None),
+    ("### ШАГ 3.1:", "addons", "connection"),
+    ("### ШАГ 4:", "connection", "addons"),
+    ("## 💎 Сценарий 2.1:", "connection", None),
+    ("## 💰 Сценарий 3:", "billing", None),
+    ("## 🔒 Сценарий 4:", "billing", None),
+    ("## 🛠 Сценарий 5:", "support", None),
+    ("## 📊 Сценарий 7:", "tariff_change", None),
+    ("## 💳 Сценарий 8:", "billing", None),
+    ("## 📞 Сценарий 9:", "support", None),
+    ("## 🏠 Сценарий 10:", "support", None),
+]
+
+# Порядок модулей в собранном промпте (как в исходном SYSTEM_PROMPT)
+PROMPT_MODULE_ORDER = ["connection", "addons", "billing", "support", "tariff_change"]
+
+
+def split_system_prompt(prompt: str) -> tuple:
+    """
+    Делит промпт на ядро и модули по заголовкам сценариев.
+
+    Returns:
+        (core, modules) - core: str, modules: {module: str}
+    """
+    core_lines: List[str] = []
+    module_lines: Dict[str, List[str]] = {name: [] for name in PROMPT_MODULE_ORDER}
+    current = None
+
+    for line in prompt.split("\n"):
+        for prefix, module, only_from in PROMPT_SECTION_RULES:
+            if line.startswith(prefix) and (only_from is None or current == only_from):
+                current = module
+                break
+        else:
+            # Любой другой заголовок верхнего уровня возвращает в ядро
+            if line.startswith("## "):
+                current = None
+
+        (core_lines if current is None else module_lines[current]).append(line)
+
+    return "\n".join(core_lines), {name: "\n".join(lines) for name, lines in module_lines.items()}
+
+
+PROMPT_CORE, PROMPT_MODULES = split_system_prompt(SYSTEM_PROMPT)
+
+# Какие модули нужны после вызова инструмента
+FUNCTION_PROMPT_MODULES = {
+    "check_address_gas": ["connection"],
+    "get_tariffs_gas": ["connection", "addons"],
+    "create_lead": ["connection"],
+    "update_lead_referrer": ["connection"],
+    "add_to_waiting_list": ["connection"],
+    "promise_payment": ["billing"],
+    "ping_router": ["support"],
+    "schedule_callback": ["support"],
+    "change_tariff_request": ["tariff_change"],
+}
+
+# Ключевые слова в сообщении клиента (в нижнем регистре)
+PROMPT_MODULE_KEYWORDS = {
+    "connection": ["подключ", "провести интернет", "новый клиент", "покрыти"],
+    "addons": ["роутер", "видеонаблюд", "камер", "постоянный ip", "статический ip", "белый ip"],
+    "billing": ["баланс", "оплат", "долг", "задолжен", "обещанн", "заблок", "платеж", "платёж", "счет", "счёт"],
+    "support": ["не работает", "нет интернета", "медленн", "скорост", "wi-fi", "wifi", "вайфай", "вай-фай",
+                "пропадает", "роутер", "отключ", "переезд", "мастер", "техник"],
+    "tariff_change": ["сменить тариф", "смена тарифа", "поменять тариф", "сменить на", "другой тариф", "перейти на тариф"],
+}
+
+try:
+    import tiktoken
+    _prompt_encoding = tiktoken.get_encoding("o200k_base")
+except Exception:
+    _prompt_encoding = None
+
+
+def estimate_tokens(text: str) -> int:
+    """Оценка количества токенов (tiktoken если установлен, иначе ~3 символа на токен)"""
+    if not text:
+        return 0
+    if _prompt_encoding is not None:
+        return len(_prompt_encoding.encode(text))
+    return len(text) // 3 + 1
+
+
+PROMPT_FULL_TOKENS = estimate_tokens(SYSTEM_PROMPT)
+PROMPT_CORE_TOKENS = estimate_tokens(PROMPT_CORE)
+PROMPT_MODULE_TOKENS = {name: estimate_tokens(text) for name, text in PROMPT_MODULES.items()}
+
+print(f"✅ SYSTEM_PROMPT разбит на модули: ядро ~{PROMPT_CORE_TOKENS} токенов, " +
+      ", ".join(f"{name} ~{tokens}" for name, tokens in PROMPT_MODULE_TOKENS.items()) +
+      f" (полный ~{PROMPT_FULL_TOKENS})")
+
+
+def build_system_prompt(modules) -> str:
+    """Собирает промпт из ядра и выбранных модулей"""
+    parts = [PROMPT_CORE]
+    for name in PROMPT_MODULE_ORDER:
+        if name in modules:
+            parts.append(PROMPT_MODULES[name])
+    return "\n".join(parts)
+
+
+# ==================== ИНСТРУМЕНТЫ: ПАМЯТЬ СЕССИИ ====================
+# В одном диалоге модель часто повторяет тот же вызов (тарифы, тот же адрес, тот же телефон).
+# Успешные результаты читающих инструментов запоминаются на сессию по нормализованным
+# аргументам. Инструменты с записью (create_lead и т.п.) не запоминаются и сбрасывают память сессии.
+# Каждый результат - отдельный ключ state (запись через state.add, без чтения-изменения-записи общего
+# словаря), сброс - новое поколение памяти сессии: при общем backend воркеры не затирают записи друг друга.
+
+TOOL_MEMO_TTL = {  # сек; инструментов, которых здесь нет, память не касается
+    "get_tariffs_gas": 600,
+    "check_address_gas": 1800,
+    "fetch_billing_by_phone": min(60, BILLING_CACHE_TTL),  # баланс должен оставаться актуальным
+    "find_answer_in_kb": 1800,
+}
+# Инструменты с записью: не запоминаются, сбрасывают память сессии и не прерываются по дедлайну
+WRITE_TOOLS = {"create_lead", "schedule_callback", "add_to_waiting_list", "update_lead_referrer", "promise_payment"}
+
+tool_memo_stats = {"hits": 0, "misses": 0, "stored": 0, "resets": 0}
+
+
+def normalize_tool_arguments(function_name: str, arguments: Dict[str, Any]) -> str:
+    """Ключ памяти: аргументы без различий в регистре, пробелах и формате телефона"""
+    normalized = {}
+    for name, value in arguments.items():
+        if name == "phone":
+            value = normalize_phone(str(value))
+        elif isinstance(value, str):
+            value = " ".join(re.findall(r"[\wё]+", value.lower())).replace("ё", "е")
+        normalized[name] = value
+    raw = json.dumps([function_name, normalized], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+async def _tool_memo_key(session_id: str, key: str) -> str:
+    """Ключ результата в текущем поколении памяти сессии"""
+    generation = await state.get("tool_memo_generation", session_id, "0")
+    return f"{session_id}:{generation}:{key}"
+
+
+async def get_tool_memo(session_id: str, key: str) -> Optional[Dict[str, Any]]:
+    return await state.get("tool_memo", await _tool_memo_key(session_id, key))
+
+
+async def remember_tool_result(session_id: str, function_name: str, key: str, result: Dict[str, Any]):
+    # TTL записи - срок памяти инструмента; параллельный такой же вызов уже записал - оставляем его
+    if await state.add("tool_memo", await _tool_memo_key(session_id, key), result, ttl=TOOL_MEMO_TTL[function_name]):
+        tool_memo_stats["stored"] += 1
+
+
+async def reset_tool_memo(session_id: str):
+    """Сбрасывает память сессии (после инструмента, который что-то меняет) - записи прежнего поколения не читаются"""
+    await state.set("tool_memo_generation", session_id, uuid.uuid4().hex[:12], ttl=max(TOOL_MEMO_TTL.values()))
+    tool_memo_stats["resets"] += 1
+
+
+async def call_function(function_name: str, arguments: Dict[str, Any], session_id: str = "") -> Dict[str, Any]:
+    """
+    Вызов функции по имени.
+
+    С session_id повторный вызов читающего инструмента с теми же аргументами
+    отвечает из памяти сессии (TOOL_MEMO_TTL)
+    """
+    memo_key = None
+    if session_id and function_name in TOOL_MEMO_TTL:
+        memo_key = normalize_tool_arguments(function_name, arguments)
+        cached = await get_tool_memo(session_id, memo_key)
+        if cached is not None:
+            tool_memo_stats["hits"] += 1
+            print(f"♻️  [TOOLS] {function_name}: повторный вызов, ответ из памяти сессии")
+            return cached
+        tool_memo_stats["misses"] += 1
+
+    result = await _call_function(function_name, arguments)
+
+    if memo_key and isinstance(result, dict) and result.get("success"):
+        await remember_tool_result(session_id, function_name, memo_key, result)
+    elif session_id and function_name in WRITE_TOOLS:
+        await reset_tool_memo(session_id)
+    return result
+
+
+async def _call_function(function_name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
+    """Вызов функции по имени"""
+    functions_map = {
+        "fetch_billing_by_phone": fetch_billing_by_phone,
+        "check_address_gas": check_address_gas,
+        "get_tariffs_gas": get_tariffs_gas,
+        "ping_router": ping_router,
+        "find_answer_in_kb": find_answer_in_kb,
+        # "promise_payment": promise_payment,  # ОТКЛЮЧЕНО: API не существует
+        "create_lead": create_lead,
+        "schedule_callback": schedule_callback,
+        "add_to_waiting_list": add_to_waiting_list,
+        "change_tariff_request": change_tariff_request,
+        "update_lead_referrer": update_lead_referrer,
+        "parse_relative_date": lambda text: {"date": parse_relative_date(text)[0], "time": parse_relative_date(text)[1]}
+    }
+
+    func = functions_map.get(function_name)
+    if not func:
+        return {"success": False, "message": f"Функция {function_name} не найдена"}
+
+    result = func(**arguments)
+    # parse_relative_date - синхронная
+    return await result if asyncio.iscoroutine(result) else result
+
+
+# ==================== ИНСТРУМЕНТЫ: ПАРАЛЛЕЛЬНЫЕ ВЫЗОВЫ (tools API) ====================
+# Модель может вернуть несколько tool_calls за один ответ (например, check_address_gas
+# и get_tariffs_gas) - они выполняются одновременно, результаты уходят одним запросом.
+
+# Сек на читающие инструменты одного шага; больше таймаутов GAS/биллинга (30с), чтобы не обрывать
+# долгие, но успешные проверки адреса. WRITE_TOOLS дедлайн не прерывает: отмена после того, как лид
+# уже поставлен в очередь, привела бы к повтору и дублю.
+CHAT_TOOL_DEADLINE = float(os.getenv("CHAT_TOOL_DEADLINE", "45"))
+
+CHAT_TOOLS = [{"type": "function", "function": function} for function in FUNCTIONS]
+CHAT_TOOLS_BY_NAME = {tool["function"]["name"]: tool for tool in CHAT_TOOLS}
+CHAT_TOOLS_FULL_TOKENS = estimate_tokens(json.dumps(CHAT_TOOLS, ensure_ascii=False))
+
+# Схемы инструментов отправляются не все: ядро + инструменты подключённых модулей промпта
+# + уже вызывавшиеся в диалоге. Модули только добавляются, поэтому набор только растёт.
+# Тарифы и проверка адреса - основной сценарий продажи, ядро промпта ссылается на них всегда.
+CORE_TOOLS = ["fetch_billing_by_phone", "find_answer_in_kb", "schedule_callback", "parse_relative_date",
+              "get_tariffs_gas", "check_address_gas"]
+
+MODULE_TOOLS = {
+    "connection": ["create_lead", "add_to_waiting_list", "update_lead_referrer"],
+    "addons": ["create_lead"],
+    "billing": ["promise_payment"],
+    "support": ["ping_router", "create_lead"],
+}
+
+# (имена инструментов) → (схемы, токены); комбинаций модулей немного, кэш ограничен сам
+_tool_subset_cache: Dict[tuple, tuple] = {}
+tool_stats = {"requests": 0, "full_tokens": 0, "sent_tokens": 0}
+
+
+def get_tool_subset(names) -> tuple:
+    """Схемы выбранных инструментов (в порядке FUNCTIONS) и их размер в токенах"""
+    key = tuple(name for name in CHAT_TOOLS_BY_NAME if name in names)
+    cached = _tool_subset_cache.get(key)
+    if cached is None:
+        tools = [CHAT_TOOLS_BY_NAME[name] for name in key]
+        cached = (tools, estimate_tokens(json.dumps(tools, ensure_ascii=False)))
+        _tool_subset_cache[key] = cached
+    return cached
+
+
+def called_tool_names(messages: List[Dict]) -> set:
+    """Инструменты, которые модель уже вызывала в диалоге"""
+    names = set()
+    for message in messages:
+        for call in message.get("tool_calls") or []:
+            names.add(call["function"]["name"])
+        if message.get("function_call"):
+            names.add(message["function_call"]["name"])
+    return names
+
+
+async def build_chat_tools(session_id: str) -> List[Dict]:
+    """Инструменты для очередного запроса к OpenAI по сценарию диалога"""
+    session = await sessions.get(session_id)
+    names = set(CORE_TOOLS)
+    for module in session.prompt_modules:
+        names.update(MODULE_TOOLS.get(module, []))
+    names.update(called_tool_names(session.messages))
+
+    tools, tokens = get_tool_subset(names)
+    tool_stats["requests"] += 1
+    tool_stats["full_tokens"] += CHAT_TOOLS_FULL_TOKENS
+    tool_stats["sent_tokens"] += tokens
+    print(f"🧰 [TOOLS] Сессия {session_id}: {len(tools)}/{len(CHAT_TOOLS)} инструментов, "
+          f"~{tokens}/{CHAT_TOOLS_FULL_TOKENS} токенов")
+    return tools
+
+
+# Поля тарифа, по которым промпт строит ответ (роутер, акция, ТВ); остальные колонки каталога модели не нужны
+TARIFF_RESULT_FIELDS = ("name", "price_rub", "speed_mbps", "tv_channels", "router_included",
+                        "connection_price_rub", "promo_price_rub")
+
+
+def shape_tariffs_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    # Нулевые ТВ/акцию не передаём ("если есть promo_price_rub"), router_included - всегда, правила ветвятся и по false
+    return {
+        "success": True,
+        "tariffs": [
+            {field: t[field] for field in TARIFF_RESULT_FIELDS
+             if field in t and (field == "router_included" or t[field] not in (None, "", 0))}
+            for t in result.get("tariffs") or []
+        ],
+        "message": result.get("message")
+    }
+
+
+# Какие поля результата видит модель (порядок = порядок в JSON); остальные остаются на сервере.
+# Функция вместо списка полей - результат собирается ею. Неуспешный результат - всегда success + message.
+# Инструменты без записи уходят целиком.
+TOOL_RESULT_FIELDS = {
+    "fetch_billing_by_phone": ("success", "fullname", "contract", "balance", "tariff", "phone"),
+    "check_address_gas": ("success", "available", "address_full", "technology", "message"),
+    "get_tariffs_gas": shape_tariffs_result,
+    "find_answer_in_kb": ("success", "answer", "question_matched", "related_questions"),
+    "ping_router": ("success", "online", "message"),
+    "create_lead": ("success", "amo_lead_id", "ticket_number", "message"),
+    "schedule_callback": ("success", "ticket_number", "message"),
+}
+
+
+def shape_tool_result(function_name: str, result: Any) -> Any:
+    """Часть результата инструмента, которая нужна модели"""
+    if not isinstance(result, dict):
+        return result
+    if not result.get("success", True):
+        return {"success": False, "message": result.get("message") or result.get("error")}
+
+    spec = TOOL_RESULT_FIELDS.get(function_name)
+    if spec is None:
+        return result
+    if callable(spec):
+        return spec(result)
+    return {field: result[field] for field in spec if field in result}
+
+
+def serialize_tool_result(function_name: str, result: Any) -> str:
+    """Компактный и стабильный JSON результата для истории: без пробелов и пустых полей"""
+    shaped = shape_tool_result(function_name, result)
+    if isinstance(shaped, dict):
+        shaped = {key: value for key, value in shaped.items() if value not in (None, "", [], {})}
+        if function_name not in TOOL_RESULT_FIELDS:
+            # У неописанных инструментов порядок ключей не задан - сортируем
+            shaped = dict(sorted(shaped.items()))
+    return json.dumps(shaped, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def merge_tool_call_deltas(tool_calls: Dict[int, Dict], deltas: List[Dict]):
+    """Собирает tool_calls из кусков потока (id, имя и аргументы приходят частями по index)"""
+    for part in deltas:
+        call = tool_calls.setdefault(part.get("index", 0), {
+            "id": "", "type": "function", "function": {"name": "", "arguments": ""}
+        })
+        if part.get("id"):
+            call["id"] = part["id"]
+        function = part.get("function") or {}
+        call["function"]["name"] += function.get("name") or ""
+        call["function"]["arguments"] += function.get("arguments") or ""
+
+
+async def run_tool_calls(session_id: str, tool_calls: List[Dict], content: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Выполняет инструменты одного ответа модели одновременно (общий дедлайн CHAT_TOOL_DEADLINE
+    для читающих инструментов). Сообщение ассистента с tool_calls (content - его текст) и результаты
+    в порядке tool_calls попадают в историю одним сохранением, когда выполнены все инструменты:
+    оборванный запрос (клиент закрыл /chat/stream) не оставляет в сессии вызовов без ответов,
+    на которые OpenAI отвечает 400.
+
+    Ошибка или таймаут инструмента становится его результатом - модель сама сообщит клиенту
+    """
+    started = time.monotonic()
+
+    async def run_one(call: Dict) -> Dict[str, Any]:
+        function_name = call["function"]["name"]
+        try:
+            arguments = json.loads(call["function"].get("arguments") or "{}")
+        except json.JSONDecodeError:
+            return {"success": False, "message": "Некорректные аргументы функции"}
+
+        # Для create_lead добавляем UTM метки из сессии (если есть)
+        await apply_session_utm(session_id, function_name, arguments)
+        try:
+            if function_name in WRITE_TOOLS:
+                return await call_function(function_name, arguments, session_id)
+            return await asyncio.wait_for(call_function(function_name, arguments, session_id), CHAT_TOOL_DEADLINE)
+        except asyncio.TimeoutError:
+            print(f"⏱️  [TOOLS] {function_name} не ответил за {CHAT_TOOL_DEADLINE:.0f}с")
+            return {"success": False, "message": "Сервис не ответил вовремя, попробуйте позже"}
+        except Exception as e:
+            print(f"❌ [TOOLS] Ошибка в {function_name}: {e}")
+            import traceback
+            traceback.print_exc()
+            return {"success": False, "message": "Не удалось выполнить запрос"}
+
+    results = await asyncio.gather(*(run_one(call) for call in tool_calls))
+
+    await sessions.append_messages(session_id, [tool_call_message(content, tool_calls)] + [
+        {
+            "role": "tool",
+            "tool_call_id": call["id"],
+            "content": serialize_tool_result(call["function"]["name"], result)
+        }
+        for call, result in zip(tool_calls, results)
+    ])
+    for call, result in zip(tool_calls, results):
+        await update_prompt_modules(session_id, function_name=call["function"]["name"], function_result=result)
+
+    if len(tool_calls) > 1:
+        names = ", ".join(call["function"]["name"] for call in tool_calls)
+        print(f"⚡ [TOOLS] Параллельно: {names} ({time.monotonic() - started:.1f}с)")
+    return results
+
+
+def tool_call_message(content: Optional[str], tool_calls: List[Dict]) -> Dict[str, Any]:
+    """Сообщение ассистента с вызовами инструментов - только поля, которые принимает API"""
+    return {
+        "role": "assistant",
+        "content": content or None,
+        "tool_calls": [
+            {"id": call["id"], "type": "function",
+             "function": {"name": call["function"]["name"], "arguments": call["function"].get("arguments") or "{}"}}
+            for call in tool_calls
+        ]
+    }
+
+
+def upgrade_legacy_function_messages(messages: List[Dict]) -> List[Dict]:
+    """История, сохранённая до перехода на tools (function_call / role=function), в формате tool_calls"""
+    if not any(message.get("role") == "function" or message.get("function_call") for message in messages):
+        return messages
+
+    upgraded = []
+    call_id = None
+    for index, message in enumerate(messages):
+        if message.get("function_call"):
+            call_id = f"legacy_{index}"
+            message = tool_call_message(message.get("content"), [{"id": call_id, "function": message["function_call"]}])
+        elif message.get("role") == "function":
+            message = {"role": "tool", "tool_call_id": call_id, "content": message.get("content") or ""}
+        upgraded.append(message)
+    return upgraded
+
+# Статистика экономии токенов системного промпта
+prompt_stats = {"requests": 0, "full_tokens": 0, "sent_tokens": 0}
+
+
+async def update_prompt_modules(session_id: str, user_message: str = None,
+                          function_name: str = None, function_result: Dict[str, Any] = None):
+    """
+    Подключает модули промпта по сообщению клиента или по вызванному инструменту.
+
+    Модули только добавляются: начатый сценарий не должен пропасть из промпта посреди диалога.
+    """
+    session = await sessions.get(session_id)
+    modules = session.prompt_modules
+    added = set()
+
+    if user_message:
+        text = user_message.lower()
+        for module, keywords in PROMPT_MODULE_KEYWORDS.items():
+            if any(keyword in text for keyword in keywords):
+                added.add(module)
+
+    if function_name:
+        # Существующему клиенту тарифы показываются в рамках смены тарифа
+        if function_name == "get_tariffs_gas" and "tariff_change" in modules:
+            pass
+        else:
+            added.update(FUNCTION_PROMPT_MODULES.get(function_name, []))
+
+        if function_name == "fetch_billing_by_phone" and function_result is not None:
+            if function_result.get("success"):
+                added.add("billing")
+            elif "не найден" in function_result.get("message", ""):
+                added.add("connection")
+
+    new_modules = added - modules
+    if new_modules:
+        modules.update(new_modules)
+        await sessions.save(session)
+        print(f"🧩 [PROMPT] Сессия {session_id}: подключены модули {', '.join(sorted(new_modules))}")
+
+
+# ==================== ИСТОРИЯ ДИАЛОГА: БЮДЖЕТ ТОКЕНОВ ====================
+# Сессия хранит историю целиком, а в OpenAI уходит окно: результаты инструментов из прошлых
+# ходов сжимаются, старые ходы сворачиваются в сводку, ключевые факты закрепляются в промпте.
+
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "6000"))
+CHAT_HISTORY_MIN_TURNS = int(os.getenv("CHAT_HISTORY_MIN_TURNS", "3"))  # последние ходы всегда целиком
+CHAT_HISTORY_SUMMARY_CHARS = 2000
+STALE_TOOL_TEXT_CHARS = 300
+STALE_TOOL_LIST_ITEMS = 10
+
+history_stats = {"requests": 0, "compacted_tool_results": 0, "folded_turns": 0, "full_tokens": 0, "sent_tokens": 0}
+
+
+def estimate_message_tokens(message: Dict) -> int:
+    """Токены сообщения: текст + аргументы вызовов + служебные ~4 токена"""
+    tokens = 4 + estimate_tokens(message.get("content") or "")
+    for call in message.get("tool_calls") or []:
+        tokens += estimate_tokens(call["function"]["name"]) + estimate_tokens(call["function"].get("arguments") or "")
+    return tokens
+
+
+def split_history_turns(messages: List[Dict]) -> List[List[Dict]]:
+    """Ходы диалога: каждый начинается с сообщения клиента, вызовы инструментов остаются в своём ходе"""
+    turns: List[List[Dict]] = []
+    for message in messages:
+        if message.get("role") == "user" or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def compact_tool_value(value, depth: int = 0):
+    """Короткая версия результата: длинные строки обрезаются, списки - первые элементы, пустые поля убираются"""
+    if isinstance(value, str):
+        return value if len(value) <= STALE_TOOL_TEXT_CHARS else value[:STALE_TOOL_TEXT_CHARS] + "…"
+    if isinstance(value, list):
+        items = [compact_tool_value(item, depth + 1) for item in value[:STALE_TOOL_LIST_ITEMS]]
+        if len(value) > STALE_TOOL_LIST_ITEMS:
+            items.append(f"… ещё {len(value) - STALE_TOOL_LIST_ITEMS}")
+        return items
+    if isinstance(value, dict):
+        return {
+            key: compact_tool_value(item, depth + 1)
+            for key, item in value.items()
+            if item not in (None, "", [], {}) and (depth < 2 or not isinstance(item, (dict, list)))
+        }
+    return value
+
+
+def compact_stale_tool_message(message: Dict) -> Dict:
+    """Результат инструмента из прошлого хода - только короткие поля"""
+    content = message.get("content") or ""
+    try:
+        compact = json.dumps(compact_tool_value(json.loads(content)), ensure_ascii=False)
+    except (TypeError, ValueError):
+        compact = compact_tool_value(content)
+    if len(compact) >= len(content):
+        return message
+    history_stats["compacted_tool_results"] += 1
+    return {**message, "content": compact}
+
+
+def extract_pinned_facts(messages: List[Dict]) -> Dict[str, str]:
+    """Факты, от которых зависит сценарий: телефон, имя, договор, адрес, тариф, заявка"""
+    facts: Dict[str, str] = {}
+    tool_names: Dict[str, str] = {}
+    tariff_names: List[str] = []
+
+    for message in messages:
+        for call in message.get("tool_calls") or []:
+            name = call["function"]["name"]
+            tool_names[call["id"]] = name
+            try:
+                arguments = json.loads(call["function"].get("arguments") or "{}")
+            except ValueError:
+                continue
+            if arguments.get("phone"):
+                facts["Телефон"] = arguments["phone"]
+            if arguments.get("address") and name in ("check_address_gas", "create_lead", "change_tariff_request"):
+                facts["Адрес"] = arguments["address"]
+            if name in ("create_lead", "change_tariff_request", "schedule_callback") and arguments.get("name"):
+                facts["Имя"] = arguments["name"]
+            if arguments.get("tariff") or arguments.get("new_tariff"):
+                facts["Выбранный тариф"] = arguments.get("tariff") or arguments.get("new_tariff")
+
+        role = message.get("role")
+        if role == "tool":
+            name = tool_names.get(message.get("tool_call_id"))
+            try:
+                result = json.loads(message.get("content") or "{}")
+            except ValueError:
+                continue
+            if not isinstance(result, dict):
+                continue
+            if name == "fetch_billing_by_phone" and result.get("success"):
+                for key, label in (("fullname", "Имя"), ("contract", "Договор"), ("tariff", "Текущий тариф")):
+                    if result.get(key):
+                        facts[label] = str(result[key])
+            elif name == "check_address_gas" and result.get("success"):
+                if result.get("address_full"):
+                    facts["Адрес"] = result["address_full"]
+                facts["Подключение по адресу"] = "доступно" if result.get("available") else "недоступно"
+            elif name == "get_tariffs_gas":
+                tariff_names = result.get("tariff_names") or [
+                    t["name"] for t in result.get("tariffs") or [] if isinstance(t, dict) and t.get("name")
+                ]
+            elif name == "create_lead" and result.get("success"):
+                facts["Заявка создана"] = str(result.get("amo_lead_id") or "да")
+        elif role == "user" and tariff_names:
+            # Тариф, который клиент назвал после показа списка
+            text = (message.get("content") or "").casefold()
+            mentioned = [tariff for tariff in tariff_names if tariff.casefold() in text]
+            if mentioned:
+                # "Тариф 1" входит в "Тариф 12" - берём самое длинное совпадение
+                facts["Выбранный тариф"] = max(mentioned, key=len)
+
+    return facts
+
+
+def summarize_turns(turns: List[List[Dict]]) -> str:
+    """Краткая сводка свёрнутых ходов: реплики (обрезанные) и вызванные инструменты"""
+    lines = []
+    for turn in turns:
+        for message in turn:
+            content = " ".join((message.get("content") or "").split())
+            if message.get("role") == "user" and content:
+                lines.append(f"Клиент: {content[:200]}")
+            elif message.get("role") == "assistant":
+                if content:
+                    lines.append(f"AIDA: {content[:200]}")
+                for call in message.get("tool_calls") or []:
+                    lines.append(f"AIDA вызвала {call['function']['name']}")
+    summary = "\n".join(lines)
+    if len(summary) > CHAT_HISTORY_SUMMARY_CHARS:
+        summary = "…" + summary[-CHAT_HISTORY_SUMMARY_CHARS:]
+    return summary
+
+
+def build_history_window(messages: List[Dict]) -> tuple:
+    """
+    История для запроса в пределах CHAT_HISTORY_TOKEN_BUDGET.
+
+    Returns:
+        (messages, context) - context дописывается к системному промпту (сводка и факты), "" если не нужен
+    """
+    turns = split_history_turns(upgrade_legacy_function_messages(messages))
+    full_tokens = sum(estimate_message_tokens(message) for turn in turns for message in turn)
+
+    # Результаты инструментов нужны модели целиком только в текущем ходе
+    turns = [
+        [compact_stale_tool_message(m) if m.get("role") == "tool" else m for m in turn]
+        for turn in turns[:-1]
+    ] + turns[-1:]
+
+    turn_tokens = [sum(estimate_message_tokens(message) for message in turn) for turn in turns]
+    total = sum(turn_tokens)
+    folded = 0
+    while len(turns) - folded > CHAT_HISTORY_MIN_TURNS and total > CHAT_HISTORY_TOKEN_BUDGET:
+        total -= turn_tokens[folded]
+        folded += 1
+
+    history_stats["requests"] += 1
+    history_stats["full_tokens"] += full_tokens
+    history_stats["sent_tokens"] += total
+    history_stats["folded_turns"] += folded
+
+    window = [message for turn in turns[folded:] for message in turn]
+    if not folded:
+        return window, ""
+
+    context = "\n\n## 🗂 Начало диалога (сокращено)\n" + summarize_turns(turns[:folded])
+    facts = extract_pinned_facts(messages)
+    if facts:
+        context += "\n\n## 📌 Уже известно (не запрашивай повторно)\n" + "\n".join(
+            f"- {label}: {value}" for label, value in facts.items()
+        )
+    print(f"✂️  [HISTORY] Свёрнуто ходов: {folded}, история ~{total}/{full_tokens} токенов")
+    return window, context
+
 
----
+async def build_chat_messages(session_id: str) -> List[Dict]:
+    """Собирает messages для OpenAI: системный промпт из нужных модулей + окно истории сессии"""
+    session = await sessions.get(session_id)
+    modules = session.prompt_modules
+    history, history_context = build_history_window(session.messages)
+    system_prompt = build_system_prompt(modules) + session.prompt_context + history_context
 
-## 📚 Сценарий 6: Q&A (вопросы и ответы)
-1. При вопросах о тарифах, оплате, настройках — используй `find_answer_in_kb`.
-2. Если ответа нет — предложи создать заявку через schedule_callback.
+    sent_tokens = PROMPT_CORE_TOKENS + sum(PROMPT_MODULE_TOKENS[name] for name in modules)
+    prompt_stats["requests"] += 1
+    prompt_stats["full_tokens"] += PROMPT_FULL_TOKENS
+    prompt_stats["sent_tokens"] += sent_tokens
 
----
+    saved_percent = 100 - sent_tokens * 100 // max(PROMPT_FULL_TOKENS, 1)
+    print(f"📉 [PROMPT] Сессия {session_id}: модули [{', '.join(sorted(modules)) or 'ядро'}], "
+          f"~{sent_tokens}/{PROMPT_FULL_TOKENS} токенов (-{saved_percent}%)")
 
-## 💡 Правила общения
-✅ Отвечай лаконично и дружелюбно
-✅ Всегда на русском языке
-✅ **Обращайся к клиентам по имени, если оно известно** (например: "Тарас Викторович, давайте проверю...")
-✅ Не спрашивай номер договора — всё определяется по телефону
-✅ Используй эмодзи умеренно (😊 👍 ✅)
-❌ Не выдумывай данные о тарифах или балансе
-❌ Не спрашивай лишнюю персональную информацию
-❌ Не придумывай причины проблем — проверяй через инструменты
+    return [{"role": "system", "content": system_prompt}] + history
 
-## ⚠️ КРИТИЧЕСКИ ВАЖНО: Контекст сессии
-🔴 **НЕ ЗАПРАШИВАЙ ПОВТОРНО информацию, которую клиент УЖЕ ПРЕДОСТАВИЛ в текущей сессии!**
-- Если номер телефона уже был введён и клиент идентифицирован (получены данные о балансе/договоре) — НЕ СПРАШИВАЙ номер телефона снова
-- Если клиент уже назвал имя или адрес — используй эту информацию из истории сообщений
-- Внимательно читай историю диалога перед тем как что-то запрашивать
-- При технических проблемах у СУЩЕСТВУЮЩЕГО клиента сразу переходи к диагностике, не запрашивай телефон заново"""
 
-async def call_function(function_name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
-    """Вызов функции по имени"""
-    functions_map = {
-        "fetch_billing_by_phone": fetch_billing_by_phone,
-        "check_address_gas": check_address_gas,
-        "get_tariffs_gas": get_tariffs_gas,
-        "ping_router": ping_router,
-        "find_answer_in_kb": find_answer_in_kb,
-        # "promise_payment": promise_payment,  # ОТКЛЮЧЕНО: API не существует
-        "create_lead": create_lead,
-        "schedule_callback": schedule_callback,
-        "add_to_waiting_list": add_to_waiting_list,
-        "change_tariff_request": change_tariff_request,
-        "update_lead_referrer": update_lead_referrer,
-        "parse_relative_date": lambda text: {"date": parse_relative_date(text)[0], "time": parse_relative_date(text)[1]}
+def get_prompt_stats() -> Dict[str, Any]:
+    """Статистика экономии токенов промпта для /health"""
+    requests = prompt_stats["requests"]
+    saved = prompt_stats["full_tokens"] - prompt_stats["sent_tokens"]
+    return {
+        "full_prompt_tokens": PROMPT_FULL_TOKENS,
+        "core_tokens": PROMPT_CORE_TOKENS,
+        "module_tokens": PROMPT_MODULE_TOKENS,
+        "requests": requests,
+        "avg_sent_tokens": prompt_stats["sent_tokens"] // requests if requests else 0,
+        "saved_tokens_total": saved,
+        "saved_percent": round(saved * 100 / prompt_stats["full_tokens"], 1) if requests else 0,
+        "tools": {
+            "full_tokens": CHAT_TOOLS_FULL_TOKENS,
+            "requests": tool_stats["requests"],
+            "avg_sent_tokens": tool_stats["sent_tokens"] // tool_stats["requests"] if tool_stats["requests"] else 0,
+            "saved_tokens_total": tool_stats["full_tokens"] - tool_stats["sent_tokens"],
+            "subsets_cached": len(_tool_subset_cache)
+        },
+        "history": {
+            **history_stats,
+            "saved_tokens_total": history_stats["full_tokens"] - history_stats["sent_tokens"],
+            "token_budget": CHAT_HISTORY_TOKEN_BUDGET
+        }
     }
 
-    func = functions_map.get(function_name)
-    if not func:
-        return {"success": False, "message": f"Функция {function_name} не найдена"}
-
-    return await func(**arguments)
 
-@app.post("/chat", response_model=ChatResponse)
-async def chat(msg: ChatMessage):
-    """Основной endpoint для чата"""
+async def start_chat_turn(msg: ChatMessage):
+    """Сохраняет UTM метки, создаёт историю сессии, добавляет сообщение пользователя и подбирает модули промпта"""
     session_id = msg.session_id
-    user_message = msg.message
-    
+
+    # Получаем историю или создаем новую (системный промпт собирается при отправке)
+    session = await sessions.get(session_id)
+
     # Сохраняем UTM метки для этой сессии (если переданы)
     if msg.utm_source or msg.utm_medium or msg.utm_campaign:
-        session_utm[session_id] = {
+        session.utm = {
             "utm_source": msg.utm_source or "",
             "utm_medium": msg.utm_medium or "",
             "utm_campaign": msg.utm_campaign or "",
             "utm_content": msg.utm_content or "",
             "utm_term": msg.utm_term or ""
         }
-        print(f"📊 [UTM] Сохранены метки для сессии {session_id}: {session_utm[session_id]}")
-
-    # Получаем историю или создаем новую
-    if session_id not in conversations:
-        conversations[session_id] = [
-            {"role": "system", "content": SYSTEM_PROMPT}
-        ]
+        await sessions.save(session)
+        print(f"📊 [UTM] Сохранены метки для сессии {session_id}: {session.utm}")
 
     # Добавляем сообщение пользователя
-    conversations[session_id].append({
+    await sessions.append_message(session_id, {
         "role": "user",
-        "content": user_message
+        "content": msg.message
     })
 
+    await update_prompt_modules(session_id, user_message=msg.message)
+
+
+async def apply_session_utm(session_id: str, function_name: str, arguments: Dict[str, Any]):
+    """Для create_lead подставляет UTM метки сессии (если не переданы явно)"""
+    if function_name != "create_lead" or not await sessions.exists(session_id):
+        return
+
+    utm = (await sessions.get(session_id)).utm
+    if not utm:
+        return
+
+    for key in ("utm_source", "utm_medium", "utm_campaign", "utm_content", "utm_term"):
+        if key not in arguments:
+            arguments[key] = utm.get(key, "")
+    print(f"📊 [UTM] Добавлены метки к create_lead: {utm}")
+
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat(msg: ChatMessage):
+    """Основной endpoint для чата"""
+    session_id = msg.session_id
+
+    await start_chat_turn(msg)
+
     # Вызываем OpenAI
-    async with httpx.AsyncClient(timeout=60.0, follow_redirects=True) as client:
+    async with upstream_client("openai") as client:
         max_iterations = 5
         iteration = 0
 
@@ -4850,9 +7967,10 @@ async def chat(msg: ChatMessage):
                     },
                     json={
                         "model": "gpt-4o-mini",
-                        "messages": conversations[session_id],
-                        "functions": FUNCTIONS,
-                        "function_call": "auto",
+                        "messages": await build_chat_messages(session_id),
+                        "tools": await build_chat_tools(session_id),
+                        "tool_choice": "auto",
+                        "parallel_tool_calls": True,
                         "temperature": 0.7
                     }
                 )
@@ -4861,46 +7979,17 @@ async def chat(msg: ChatMessage):
 
                 message = data["choices"][0]["message"]
 
-                # Если есть вызов функции
-                if message.get("function_call"):
-                    function_name = message["function_call"]["name"]
-                    arguments = json.loads(message["function_call"]["arguments"])
-
-                    # Добавляем сообщение ассистента с вызовом функции
-                    conversations[session_id].append(message)
-
-                    # Для create_lead добавляем UTM метки из сессии (если есть)
-                    if function_name == "create_lead" and session_id in session_utm:
-                        utm = session_utm[session_id]
-                        # Добавляем UTM только если они не были переданы явно
-                        if "utm_source" not in arguments:
-                            arguments["utm_source"] = utm.get("utm_source", "")
-                        if "utm_medium" not in arguments:
-                            arguments["utm_medium"] = utm.get("utm_medium", "")
-                        if "utm_campaign" not in arguments:
-                            arguments["utm_campaign"] = utm.get("utm_campaign", "")
-                        if "utm_content" not in arguments:
-                            arguments["utm_content"] = utm.get("utm_content", "")
-                        if "utm_term" not in arguments:
-                            arguments["utm_term"] = utm.get("utm_term", "")
-                        print(f"📊 [UTM] Добавлены метки к create_lead: {utm}")
-
-                    # Вызываем функцию
-                    function_result = await call_function(function_name, arguments)
-
-                    # Добавляем результат функции
-                    conversations[session_id].append({
-                        "role": "function",
-                        "name": function_name,
-                        "content": json.dumps(function_result, ensure_ascii=False)
-                    })
+                # Если модель вызвала инструменты (возможно, несколько сразу)
+                if message.get("tool_calls"):
+                    # Выполняем все вызовы параллельно; сообщение с вызовами сохраняется вместе с результатами
+                    await run_tool_calls(session_id, message["tool_calls"], message.get("content"))
 
                     # Продолжаем цикл для получения финального ответа
                     continue
 
                 # Финальный ответ
                 assistant_message = message.get("content", "Извините, произошла ошибка")
-                conversations[session_id].append({
+                await sessions.append_message(session_id, {
                     "role": "assistant",
                     "content": assistant_message
                 })
@@ -4912,6 +8001,7 @@ async def chat(msg: ChatMessage):
 
             except Exception as e:
                 # Логируем техническую ошибку
+                import traceback
                 print(f"❌ Ошибка в /chat endpoint: {str(e)}")
                 print(traceback.format_exc())
 
@@ -4921,12 +8011,168 @@ async def chat(msg: ChatMessage):
                     detail="Извините, произошла временная ошибка. Попробуйте еще раз или обратитесь в поддержку."
                 )
 
-        logger.warning("⚠️ Превышено максимальное количество итераций в /chat")
+        print("⚠️ Превышено максимальное количество итераций в /chat")
         raise HTTPException(
             status_code=500,
             detail="Извините, запрос занял слишком много времени. Попробуйте переформулировать вопрос."
         )
 
+# ============================================================================
+# CHAT STREAMING - Потоковая выдача токенов (SSE / NDJSON)
+# ============================================================================
+
+# Промежуточные статусы, которые показываются виджету пока работает инструмент
+FUNCTION_STATUS_MESSAGES = {
+    "fetch_billing_by_phone": "Ищу ваш договор…",
+    "check_address_gas": "Проверяю ваш адрес…",
+    "get_tariffs_gas": "Подбираю тарифы…",
+    "ping_router": "Проверяю связь с роутером…",
+    "find_answer_in_kb": "Ищу ответ в базе знаний…",
+    "create_lead": "Оформляю заявку…",
+    "schedule_callback": "Записываю на обратный звонок…",
+    "add_to_waiting_list": "Добавляю в лист ожидания…",
+    "change_tariff_request": "Оформляю смену тарифа…",
+    "update_lead_referrer": "Сохраняю данные…",
+    "parse_relative_date": "Уточняю дату…"
+}
+
+
+def format_stream_event(event: str, payload: Dict[str, Any], stream_format: str = "sse") -> str:
+    """Форматирует событие для SSE (event/data) или NDJSON (одна JSON строка)"""
+    if stream_format == "ndjson":
+        return json.dumps({"type": event, **payload}, ensure_ascii=False) + "\n"
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+async def iter_openai_stream(client: httpx.AsyncClient, payload: Dict[str, Any]):
+    """Читает stream chat/completions и отдаёт delta каждого чанка"""
+    async with client.stream(
+        "POST",
+        "https://api.openai.com/v1/chat/completions",
+        headers={
+            "Authorization": f"Bearer {OPENAI_API_KEY}",
+            "Content-Type": "application/json"
+        },
+        json={**payload, "stream": True}
+    ) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            chunk = line[5:].strip()
+            if chunk == "[DONE]":
+                break
+            data = json.loads(chunk)
+            if not data.get("choices"):
+                continue
+            yield data["choices"][0].get("delta") or {}
+
+
+async def stream_chat_events(msg: ChatMessage, stream_format: str):
+    """
+    Генератор событий для /chat/stream
+
+    События:
+    - token: {"text": ...} - очередной фрагмент ответа
+    - status: {"function": ..., "text": ...} - выполняется инструмент
+    - done: {"response": ..., "session_id": ...} - финальный ответ
+    - error: {"message": ...} - ошибка (поток завершается)
+    """
+    session_id = msg.session_id
+    await start_chat_turn(msg)
+
+    try:
+        async with upstream_client("openai") as client:
+            max_iterations = 5
+            iteration = 0
+
+            while iteration < max_iterations:
+                iteration += 1
+
+                content_parts: List[str] = []
+                tool_calls: Dict[int, Dict] = {}
+
+                async for delta in iter_openai_stream(client, {
+                    "model": "gpt-4o-mini",
+                    "messages": await build_chat_messages(session_id),
+                    "tools": await build_chat_tools(session_id),
+                    "tool_choice": "auto",
+                    "parallel_tool_calls": True,
+                    "temperature": 0.7
+                }):
+                    # Вызовы инструментов приходят кусками - собираем целиком
+                    if delta.get("tool_calls"):
+                        merge_tool_call_deltas(tool_calls, delta["tool_calls"])
+                        continue
+
+                    text = delta.get("content")
+                    if text:
+                        content_parts.append(text)
+                        yield format_stream_event("token", {"text": text}, stream_format)
+
+                # Если модель вызвала инструменты
+                if tool_calls:
+                    calls = [tool_calls[index] for index in sorted(tool_calls)]
+
+                    for call in calls:
+                        function_name = call["function"]["name"]
+                        yield format_stream_event("status", {
+                            "function": function_name,
+                            "text": FUNCTION_STATUS_MESSAGES.get(function_name, "Минутку, уточняю…")
+                        }, stream_format)
+
+                    # Сообщение с вызовами сохраняется вместе с результатами - обрыв потока здесь историю не ломает
+                    await run_tool_calls(session_id, calls, "".join(content_parts))
+                    continue
+
+                # Финальный ответ
+                assistant_message = "".join(content_parts) or "Извините, произошла ошибка"
+                await sessions.append_message(session_id, {
+                    "role": "assistant",
+                    "content": assistant_message
+                })
+
+                yield format_stream_event("done", {
+                    "response": assistant_message,
+                    "session_id": session_id
+                }, stream_format)
+                return
+
+        print("⚠️ Превышено максимальное количество итераций в /chat/stream")
+        yield format_stream_event("error", {
+            "message": "Извините, запрос занял слишком много времени. Попробуйте переформулировать вопрос."
+        }, stream_format)
+
+    except Exception as e:
+        import traceback
+        print(f"❌ Ошибка в /chat/stream endpoint: {str(e)}")
+        traceback.print_exc()
+
+        yield format_stream_event("error", {
+            "message": "Извините, произошла временная ошибка. Попробуйте еще раз или обратитесь в поддержку."
+        }, stream_format)
+
+
+@app.post("/chat/stream")
+async def chat_stream(msg: ChatMessage, format: str = "sse"):
+    """
+    Потоковый вариант /chat: токены ответа отдаются по мере генерации.
+
+    format=sse (по умолчанию) - text/event-stream
+    format=ndjson - application/x-ndjson (одна JSON строка на событие)
+    """
+    stream_format = "ndjson" if format == "ndjson" else "sse"
+    media_type = "application/x-ndjson" if stream_format == "ndjson" else "text/event-stream"
+
+    return StreamingResponse(
+        stream_chat_events(msg, stream_format),
+        media_type=media_type,
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"  # отключаем буферизацию nginx
+        }
+    )
+
 @app.get("/health")
 async def health():
     """Health check"""
@@ -4938,7 +8184,22 @@ async def health():
     return {
         "status": "ok",
         "service": "AIDA GPT",
-        "tariffs_cache": cache_info
+        "tariffs_cache": cache_info,
+        "catalog_refresh": {
+            "tariffs": tariffs_refresher.stats(),
+            "addons": addons_refresher.stats()
+        },
+        "prompt": get_prompt_stats(),
+        "address_check": {**address_stats, "coverage_index": coverage_meta, "variants": address_variant_stats},
+        "sessions": sessions.stats(),
+        "billing": billing_stats,
+        "amocrm": amo_outbox_stats(),
+        "freescout_outbox": freescout_outbox.stats(),
+        "freescout_users": {**freescout_users.stats, "count": freescout_users.count},
+        "webhooks": {**webhook_queue.stats(), **webhook_dedup_stats},
+        "transcription": transcription_stats,
+        "voicemail": voicemail_store.stats,
+        "tool_memo": tool_memo_stats
     }
 # ============================================================================
 # AI SUGGEST ENDPOINT (для FreeScout)
@@ -5003,9 +8264,10 @@ async def ai_suggest(request: AISuggestRequest):
         user_prompt += "\n\nСформулируй профессиональный ответ агента поддержки:"
 
         # Вызываем OpenAI через httpx
-        async with httpx.AsyncClient(timeout=30.0) as client:
+        async with upstream_client("openai") as client:
             response = await client.post(
                 "https://api.openai.com/v1/chat/completions",
+                timeout=30.0,
                 headers={
                     "Authorization": f"Bearer {OPENAI_API_KEY}",
                     "Content-Type": "application/json"
@@ -5066,167 +8328,11 @@ async def get_balance(request: Request):
     }
     """
     try:
-        # SendGrid sends form-data, not JSON
-        form_data = await request.form()
-        
-        # DEBUG: Print all form fields
-        print("🐛 [DEBUG] All form-data fields:")
-        for key in form_data.keys():
-            value = form_data.get(key, "")
-            print(f"   {key}: {value[:200] if len(str(value)) > 200 else value}")
-        
-        # Parse raw email from SendGrid
-        raw_email = form_data.get("email", "")
-        # DEBUG: Save raw email to file
-        if raw_email:
-            with open('/tmp/last_email.txt', 'w', encoding='utf-8') as f:
-                f.write(raw_email)
-            print(f"📧 [DEBUG] Raw email saved to /tmp/last_email.txt ({len(raw_email)} bytes)")
-        email_msg = message_from_string(raw_email) if raw_email else None
-        
-        # Extract plain text from email
-        plain_text = ""
-        html_text = ""
-        
-        if email_msg:
-            if email_msg.is_multipart():
-                for part in email_msg.walk():
-                    content_type = part.get_content_type()
-                    if content_type == "text/plain" and not plain_text:
-                        try:
-                            plain_text = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                        except:
-                            pass
-                    elif content_type == "text/html" and not html_text:
-                        try:
-                            html_text = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                        except:
-                            pass
-            else:
-                try:
-                    payload = email_msg.get_payload(decode=True).decode('utf-8', errors='ignore')
-                    if email_msg.get_content_type() == "text/html":
-                        html_text = payload
-                    else:
-                        plain_text = payload
-                except:
-                    pass
-        
-        # If no plain text, extract from HTML
-        if not plain_text and html_text:
-            # Remove HTML tags and get text
-            plain_text = re.sub(r'<[^>]+>', ' ', html_text)
-            plain_text = unescape(plain_text)
-            # Clean up whitespace
-            plain_text = re.sub(r'\s+', ' ', plain_text).strip()
-        
-        print(f"📧 [DEBUG] Extracted plain text ({len(plain_text)} chars): {plain_text[:300]}")
-        print(f"📧 [DEBUG] Had HTML: {len(html_text) > 0}")
-        
-        # Extract attachment from email (MP3 or TXT)
-        mp3_data = None
-        mp3_filename = None
-        txt_transcription = None
-        
-        if email_msg and email_msg.is_multipart():
-            for part in email_msg.walk():
-                content_disposition = part.get("Content-Disposition", "")
-                content_type = part.get_content_type()
-                
-                # Check if this is an attachment
-                if "attachment" in content_disposition:
-                    filename = part.get_filename()
-                    
-                    # Check for TXT file with transcription
-                    if filename and ".txt" in filename.lower():
-                        txt_data = part.get_payload(decode=True)
-                        try:
-                            # Decode the text
-                            txt_content = txt_data.decode('utf-8', errors='ignore')
-                            print(f"📝 [EMAIL] Найдено TXT вложение: {filename} ({len(txt_data)} bytes)")
-                            print(f"📄 [EMAIL] TXT содержимое: {txt_content[:300]}...")
-                            
-                            # Extract transcription after "следующего содержания:"
-                            if "следующего содержания:" in txt_content:
-                                parts = txt_content.split("следующего содержания:")
-                                if len(parts) > 1:
-                                    txt_transcription = parts[1].strip()
-                                    print(f"✅ [EMAIL] Извлечена транскрипция из TXT: {txt_transcription[:200]}...")
-                            else:
-                                # Use full text if no marker found
-                                txt_transcription = txt_content.strip()
-                                print(f"✅ [EMAIL] Используем полный текст TXT")
-                            break
-                        except Exception as e:
-                            print(f"❌ [EMAIL] Ошибка декодирования TXT: {e}")
-                    
-                    # Check for MP3 file
-                    elif filename and ".mp3" in filename.lower() and ("audio" in content_type or "octet-stream" in content_type):
-                        mp3_data = part.get_payload(decode=True)
-                        mp3_filename = filename
-                        print(f"🎵 [EMAIL] Найдено MP3 вложение: {filename} ({len(mp3_data)} bytes)")
-                        break
-        
-        # Transcribe MP3 using Whisper API if found
-        whisper_transcription = None
-        if mp3_data:
-            try:
-                import tempfile
-                import os
-                
-                # Save MP3 to temporary file
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as tmp_file:
-                    tmp_file.write(mp3_data)
-                    tmp_path = tmp_file.name
-                
-                print(f"💾 [EMAIL] MP3 сохранён во временный файл: {tmp_path}")
-                
-                # Call Whisper API via httpx
-                print(f"🎙️  [EMAIL] Отправляю в Whisper API для транскрибации...")
-                
-                async with httpx.AsyncClient(timeout=60.0) as http_client:
-                    with open(tmp_path, "rb") as audio_file:
-                        files = {"file": (mp3_filename, audio_file, "audio/mpeg")}
-                        data = {
-                            "model": "whisper-1",
-                            "language": "ru"
-                        }
-                        
-                        whisper_response = await http_client.post(
-                            "https://api.openai.com/v1/audio/transcriptions",
-                            headers={
-                                "Authorization": f"Bearer {OPENAI_API_KEY}"
-                            },
-                            files=files,
-                            data=data
-                        )
-                        
-                        if whisper_response.status_code == 200:
-                            result = whisper_response.json()
-                            whisper_transcription = result.get("text", "")
-                            print(f"✅ [EMAIL] Транскрипция получена ({len(whisper_transcription)} символов)")
-                            print(f"📝 [EMAIL] Whisper транскрипция: {whisper_transcription[:200]}...")
-                        else:
-                            print(f"❌ [EMAIL] Whisper API error: {whisper_response.status_code}")
-                            print(f"   Response: {whisper_response.text}")
-                
-                # Clean up temp file
-                os.unlink(tmp_path)
-                
-            except Exception as e:
-                print(f"❌ [EMAIL] Ошибка транскрибации: {e}")
-                import traceback
-                traceback.print_exc()
-        
-        # Convert form to dict for easier access
-        data = {
-            "headers": {},
-            "plain": plain_text,
-            "html": form_data.get("html", ""),
-            "from": form_data.get("from", ""),
-            "to": form_data.get("to", ""),
-            "subject": form_data.get("subject", ""),
-        }
+        try:
+            data = await request.json()
+        except Exception:
+            # Кнопка FreeScout может прислать обычную форму
+            data = form_to_dict(await request.form())
         customer_id = data.get("customer_id")
         phone = data.get("phone")
 
@@ -5252,6 +8358,90 @@ async def get_balance(request: Request):
 
 
 
+# ============================================================================
+# ПРИЁМ ВЕБХУКОВ: быстрый ответ + фоновая обработка
+# ============================================================================
+# Вебхук проверяется, сохраняется в очередь (SQLite) и подтверждается за миллисекунды,
+# а вся работа с AmoCRM/FreeScout/Mango идёт в воркере. Отправители больше не ждут
+# наших downstream-запросов и не шлют повторы из-за таймаутов.
+
+WEBHOOK_QUEUE_PATH = os.getenv("WEBHOOK_QUEUE_PATH", os.path.join(os.path.dirname(__file__), "webhook_events.db"))
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "4"))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "5"))
+WEBHOOK_MAX_DELAY = float(os.getenv("WEBHOOK_MAX_DELAY", "300"))
+WEBHOOK_KEEP_DONE = int(os.getenv("WEBHOOK_KEEP_DONE", str(3 * 86400)))
+# Mango обрабатывает запись не сразу - запрос записей откладываем
+MANGO_RECORDING_DELAY = float(os.getenv("MANGO_RECORDING_DELAY", "3"))
+# Сколько помнить отпечатки принятых событий: повтор в этом окне отбрасывается (сек)
+WEBHOOK_DEDUP_TTL = int(os.getenv("WEBHOOK_DEDUP_TTL", "86400"))
+
+webhook_queue = JobQueue(WEBHOOK_QUEUE_PATH, "webhook_events", keep_done=WEBHOOK_KEEP_DONE)
+
+# kind события → обработчик(job); заполняется рядом с обработчиками
+WEBHOOK_HANDLERS: Dict[str, Any] = {}
+
+
+webhook_dedup_stats = {"accepted": 0, "duplicates": 0}
+
+
+def webhook_fingerprint(kind: str, payload: Any, identity: Optional[tuple] = None) -> str:
+    """
+    Отпечаток события: тип + (id сущности, время события), если отправитель их передаёт,
+    иначе хеш тела. Повторная доставка того же события даёт тот же отпечаток
+    """
+    if identity and all(identity):
+        material = json.dumps([kind, *identity], ensure_ascii=False, default=str)
+    else:
+        material = json.dumps([kind, payload], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(material.encode("utf-8")).hexdigest()
+
+
+async def claim_webhook_event(fingerprint: str) -> bool:
+    """True - событие новое; False - уже принимали его в окне WEBHOOK_DEDUP_TTL"""
+    if await state.add("webhook_seen", fingerprint, int(time.time()), ttl=WEBHOOK_DEDUP_TTL):
+        webhook_dedup_stats["accepted"] += 1
+        return True
+    webhook_dedup_stats["duplicates"] += 1
+    return False
+
+
+def duplicate_webhook_response(kind: str, fingerprint: str) -> JSONResponse:
+    # Отвечаем 200 - иначе отправитель продолжит повторять
+    print(f"♻️  [WEBHOOK] {kind}: повтор события {fingerprint[:12]} - пропускаем")
+    return JSONResponse({"success": True, "duplicate": True})
+
+
+async def ingest_webhook(kind: str, payload: Dict[str, Any], order_key: Optional[str] = None,
+                   delay: float = 0, identity: Optional[tuple] = None, dedup: bool = True) -> JSONResponse:
+    """
+    Сохраняет событие в очередь и сразу отвечает отправителю.
+    Повторы (ретраи FreeScout/AmoCRM/Mango) отбрасываются до постановки в очередь
+    """
+    fingerprint = webhook_fingerprint(kind, payload, identity) if dedup else None
+    if fingerprint and not await claim_webhook_event(fingerprint):
+        return duplicate_webhook_response(kind, fingerprint)
+
+    try:
+        event_id = webhook_queue.enqueue(kind, payload, order_key=order_key, delay=delay)
+    except Exception:
+        # Событие не сохранено - повтор от отправителя должен пройти
+        if fingerprint:
+            await state.delete("webhook_seen", fingerprint)
+        raise
+    print(f"📥 [WEBHOOK] {kind} #{event_id} принят" + (f" (ключ {order_key})" if order_key else ""))
+    return JSONResponse({"success": True, "queued": True, "event_id": event_id})
+
+
+def form_to_dict(form) -> Dict[str, str]:
+    """Текстовые поля формы (файлы пропускаем - в очередь их не кладём)"""
+    return {key: value for key, value in form.multi_items() if isinstance(value, str)}
+
+
+async def webhook_worker():
+    await run_job_queue(webhook_queue, WEBHOOK_HANDLERS, concurrency=WEBHOOK_CONCURRENCY,
+                        max_attempts=WEBHOOK_MAX_ATTEMPTS, max_delay=WEBHOOK_MAX_DELAY, tag="WEBHOOK")
+
+
 @app.post("/freescout/webhook")
 async def freescout_webhook(request: Request):
     """
@@ -5262,494 +8452,155 @@ async def freescout_webhook(request: Request):
     - convo.customer.reply.created - ответ клиента
     - convo.agent.reply.created - ответ агента
     - convo.status - изменение статуса
+
+    Событие проверяется и ставится в очередь; обработка - process_freescout_webhook
     """
     try:
-        # SendGrid sends form-data, not JSON
-        form_data = await request.form()
-        
-        # DEBUG: Print all form fields
-        print("🐛 [DEBUG] All form-data fields:")
-        for key in form_data.keys():
-            value = form_data.get(key, "")
-            print(f"   {key}: {value[:200] if len(str(value)) > 200 else value}")
-        
-        # Parse raw email from SendGrid
-        raw_email = form_data.get("email", "")
-        
-        # DEBUG: Save raw email to file
-        if raw_email:
-            with open('/tmp/last_email.txt', 'w', encoding='utf-8') as f:
-                f.write(raw_email)
-            print(f"📧 [DEBUG] Raw email saved to /tmp/last_email.txt ({len(raw_email)} bytes)")
-        
-        email_msg = message_from_string(raw_email) if raw_email else None
-        
-        # Extract plain text from email
-        plain_text = ""
-        html_text = ""
-        
-        if email_msg:
-            if email_msg.is_multipart():
-                for part in email_msg.walk():
-                    content_type = part.get_content_type()
-                    if content_type == "text/plain" and not plain_text:
-                        try:
-                            plain_text = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                        except:
-                            pass
-                    elif content_type == "text/html" and not html_text:
-                        try:
-                            html_text = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                        except:
-                            pass
-            else:
-                try:
-                    payload = email_msg.get_payload(decode=True).decode('utf-8', errors='ignore')
-                    if email_msg.get_content_type() == "text/html":
-                        html_text = payload
-                    else:
-                        plain_text = payload
-                except:
-                    pass
-        
-        # If no plain text, extract from HTML
-        if not plain_text and html_text:
-            # Remove HTML tags and get text
-            plain_text = re.sub(r'<[^>]+>', ' ', html_text)
-            plain_text = unescape(plain_text)
-            # Clean up whitespace
-            plain_text = re.sub(r'\s+', ' ', plain_text).strip()
-        
-        print(f"📧 [DEBUG] Extracted plain text ({len(plain_text)} chars): {plain_text[:300]}")
-        print(f"📧 [DEBUG] Had HTML: {len(html_text) > 0}")
-        
-        # Extract attachment from email (MP3 or TXT)
-        mp3_data = None
-        mp3_filename = None
-        txt_transcription = None
-        
-        if email_msg and email_msg.is_multipart():
-            for part in email_msg.walk():
-                content_disposition = part.get("Content-Disposition", "")
-                content_type = part.get_content_type()
-                
-                # Check if this is an attachment
-                if "attachment" in content_disposition:
-                    filename = part.get_filename()
-                    
-                    # Check for TXT file with transcription
-                    if filename and ".txt" in filename.lower():
-                        txt_data = part.get_payload(decode=True)
-                        try:
-                            # Decode the text
-                            txt_content = txt_data.decode('utf-8', errors='ignore')
-                            print(f"📝 [EMAIL] Найдено TXT вложение: {filename} ({len(txt_data)} bytes)")
-                            print(f"📄 [EMAIL] TXT содержимое: {txt_content[:300]}...")
-                            
-                            # Extract transcription after "следующего содержания:"
-                            if "следующего содержания:" in txt_content:
-                                parts = txt_content.split("следующего содержания:")
-                                if len(parts) > 1:
-                                    txt_transcription = parts[1].strip()
-                                    print(f"✅ [EMAIL] Извлечена транскрипция из TXT: {txt_transcription[:200]}...")
-                            else:
-                                # Use full text if no marker found
-                                txt_transcription = txt_content.strip()
-                                print(f"✅ [EMAIL] Используем полный текст TXT")
-                            break
-                        except Exception as e:
-                            print(f"❌ [EMAIL] Ошибка декодирования TXT: {e}")
-                    
-                    # Check for MP3 file
-                    elif filename and ".mp3" in filename.lower() and ("audio" in content_type or "octet-stream" in content_type):
-                        mp3_data = part.get_payload(decode=True)
-                        mp3_filename = filename
-                        print(f"🎵 [EMAIL] Найдено MP3 вложение: {filename} ({len(mp3_data)} bytes)")
-                        break
-        
-        # Transcribe MP3 using Whisper API if found
-        whisper_transcription = None
-        if mp3_data:
-            try:
-                import tempfile
-                import os
-                
-                # Save MP3 to temporary file
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as tmp_file:
-                    tmp_file.write(mp3_data)
-                    tmp_path = tmp_file.name
-                
-                print(f"💾 [EMAIL] MP3 сохранён во временный файл: {tmp_path}")
-                
-                # Call Whisper API via httpx
-                print(f"🎙️  [EMAIL] Отправляю в Whisper API для транскрибации...")
-                
-                async with httpx.AsyncClient(timeout=60.0) as http_client:
-                    with open(tmp_path, "rb") as audio_file:
-                        files = {"file": (mp3_filename, audio_file, "audio/mpeg")}
-                        data = {
-                            "model": "whisper-1",
-                            "language": "ru"
-                        }
-                        
-                        whisper_response = await http_client.post(
-                            "https://api.openai.com/v1/audio/transcriptions",
-                            headers={
-                                "Authorization": f"Bearer {OPENAI_API_KEY}"
-                            },
-                            files=files,
-                            data=data
-                        )
-                        
-                        if whisper_response.status_code == 200:
-                            result = whisper_response.json()
-                            whisper_transcription = result.get("text", "")
-                            print(f"✅ [EMAIL] Транскрипция получена ({len(whisper_transcription)} символов)")
-                            print(f"📝 [EMAIL] Whisper транскрипция: {whisper_transcription[:200]}...")
-                        else:
-                            print(f"❌ [EMAIL] Whisper API error: {whisper_response.status_code}")
-                            print(f"   Response: {whisper_response.text}")
-                
-                # Clean up temp file
-                os.unlink(tmp_path)
-                
-            except Exception as e:
-                print(f"❌ [EMAIL] Ошибка транскрибации: {e}")
-                import traceback
-                traceback.print_exc()
-        
-        # Convert form to dict for easier access
-        data = {
-            "headers": {},
-            "plain": plain_text,
-            "html": form_data.get("html", ""),
-            "from": form_data.get("from", ""),
-            "to": form_data.get("to", ""),
-            "subject": form_data.get("subject", ""),
+        data = await request.json()
+    except Exception:
+        return JSONResponse({"success": False, "message": "Invalid JSON"}, status_code=400)
+    if not isinstance(data, dict):
+        return JSONResponse({"success": False, "message": "Invalid payload"}, status_code=400)
+
+    if not data.get("event"):
+        data["event"] = request.headers.get("X-FreeScout-Event", "")
+    conversation = data.get("conversation") or data
+    conversation_id = conversation.get("id")
+    # Событие = тип + тикет + время изменения тикета; у ответов ещё и id сообщения -
+    # два ответа в одну секунду не должны склеиться в один
+    identity = (data["event"], conversation_id, conversation.get("updatedAt") or conversation.get("updated_at"))
+    if data["event"].endswith("reply.created"):
+        identity += ((data.get("thread") or {}).get("id"),)
+    return await ingest_webhook("freescout", data, order_key=f"freescout:{conversation_id}" if conversation_id else None,
+                          identity=identity)
+
+
+async def process_freescout_webhook(job: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Обработка события FreeScout из очереди.
+
+    Поддерживает события ApiWebhooks (convo.*) и старый формат (conversation.*)
+    """
+    data = job["payload"]
+    event_type = data.get("event")
+
+    print(f"📨 FreeScout webhook: {event_type}")
+    print(f"   Data keys: {list(data.keys())}")
+
+    # Маппинг ApiWebhooks событий на наши обработчики
+    if event_type == "convo.created":
+        # Преобразуем формат ApiWebhooks в наш формат
+        conversation = data.get("conversation", {})
+        customer = data.get("customer", {})
+
+        adapted_data = {
+            "event": "conversation.created",
+            "conversation": {
+                "id": conversation.get("id"),
+                "number": conversation.get("number"),
+                "subject": conversation.get("subject", "Без темы"),
+                "status": conversation.get("status")
+            },
+            "customer": {
+                "id": customer.get("id"),
+                "first_name": customer.get("firstName", customer.get("first_name", "")),
+                "last_name": customer.get("lastName", customer.get("last_name", "")),
+                "phones": customer.get("phones", [])
+            }
+        }
+        return await handle_freescout_ticket_created(adapted_data)
+
+    if event_type == "convo.customer.reply.created":
+        conversation = data.get("conversation", {})
+        customer = data.get("customer", {})
+        thread = data.get("thread", {})
+
+        adapted_data = {
+            "event": "conversation.customer_replied",
+            "conversation": {
+                "id": conversation.get("id"),
+                "number": conversation.get("number")
+            },
+            "customer": {
+                "id": customer.get("id"),
+                "first_name": customer.get("firstName", customer.get("first_name", "")),
+                "phones": customer.get("phones", [])
+            },
+            "thread": {
+                "id": thread.get("id"),
+                "body": thread.get("body", ""),
+                "created_by": {
+                    "first_name": customer.get("firstName", "Клиент"),
+                    "last_name": customer.get("lastName", "")
+                }
+            }
+        }
+        return await handle_freescout_reply_created(adapted_data)
+
+    if event_type == "convo.agent.reply.created":
+        conversation = data.get("conversation", {})
+        customer = data.get("customer", {})
+        thread = data.get("thread", {})
+        user = data.get("user", {})
+
+        adapted_data = {
+            "event": "conversation.agent_replied",
+            "conversation": {
+                "id": conversation.get("id"),
+                "number": conversation.get("number")
+            },
+            "customer": {
+                "id": customer.get("id"),
+                "phones": customer.get("phones", [])
+            },
+            "thread": {
+                "id": thread.get("id"),
+                "body": thread.get("body", ""),
+                "created_by": {
+                    "first_name": user.get("firstName", user.get("first_name", "Агент")),
+                    "last_name": user.get("lastName", user.get("last_name", ""))
+                }
+            }
         }
-        event_type = data.get("event")
+        return await handle_freescout_reply_created(adapted_data)
 
-        print(f"📨 FreeScout webhook: {event_type}")
-        print(f"   Data keys: {list(data.keys())}")
+    if event_type == "convo.status":
+        conversation = data.get("conversation", {})
+        customer = data.get("customer", {})
+        status = conversation.get("status")
 
-        # Маппинг ApiWebhooks событий на наши обработчики
-        if event_type == "convo.created":
-            # Преобразуем формат ApiWebhooks в наш формат
-            conversation = data.get("conversation", {})
-            customer = data.get("customer", {})
-            
+        if status == 3:  # 3 = closed
             adapted_data = {
-                "event": "conversation.created",
+                "event": "conversation.status_changed",
                 "conversation": {
                     "id": conversation.get("id"),
                     "number": conversation.get("number"),
                     "subject": conversation.get("subject", "Без темы"),
-                    "status": conversation.get("status")
-                },
-                "customer": {
-                    "id": customer.get("id"),
-                    "first_name": customer.get("firstName", customer.get("first_name", "")),
-                    "last_name": customer.get("lastName", customer.get("last_name", "")),
-                    "phones": customer.get("phones", [])
-                }
-            }
-            result = await handle_freescout_ticket_created(adapted_data)
-            
-        elif event_type == "convo.customer.reply.created":
-            conversation = data.get("conversation", {})
-            customer = data.get("customer", {})
-            thread = data.get("thread", {})
-            
-            adapted_data = {
-                "event": "conversation.customer_replied",
-                "conversation": {
-                    "id": conversation.get("id"),
-                    "number": conversation.get("number")
-                },
-                "customer": {
-                    "id": customer.get("id"),
-                    "first_name": customer.get("firstName", customer.get("first_name", "")),
-                    "phones": customer.get("phones", [])
-                },
-                "thread": {
-                    "id": thread.get("id"),
-                    "body": thread.get("body", ""),
-                    "created_by": {
-                        "first_name": customer.get("firstName", "Клиент"),
-                        "last_name": customer.get("lastName", "")
-                    }
-                }
-            }
-            result = await handle_freescout_reply_created(adapted_data)
-            
-        elif event_type == "convo.agent.reply.created":
-            conversation = data.get("conversation", {})
-            customer = data.get("customer", {})
-            thread = data.get("thread", {})
-            user = data.get("user", {})
-            
-            adapted_data = {
-                "event": "conversation.agent_replied",
-                "conversation": {
-                    "id": conversation.get("id"),
-                    "number": conversation.get("number")
+                    "status": status
                 },
                 "customer": {
                     "id": customer.get("id"),
                     "phones": customer.get("phones", [])
-                },
-                "thread": {
-                    "id": thread.get("id"),
-                    "body": thread.get("body", ""),
-                    "created_by": {
-                        "first_name": user.get("firstName", user.get("first_name", "Агент")),
-                        "last_name": user.get("lastName", user.get("last_name", ""))
-                    }
                 }
             }
-            result = await handle_freescout_reply_created(adapted_data)
-            
-        elif event_type == "convo.status":
-            conversation = data.get("conversation", {})
-            customer = data.get("customer", {})
-            status = conversation.get("status")
-            
-            if status == 3:  # 3 = closed
-                adapted_data = {
-                    "event": "conversation.status_changed",
-                    "conversation": {
-                        "id": conversation.get("id"),
-                        "number": conversation.get("number"),
-                        "subject": conversation.get("subject", "Без темы"),
-                        "status": status
-                    },
-                    "customer": {
-                        "id": customer.get("id"),
-                        "phones": customer.get("phones", [])
-                    }
-                }
-                result = await handle_freescout_ticket_closed(adapted_data)
-            else:
-                result = {"success": True, "message": f"Status change to {status} ignored (not closed)"}
-        else:
-            result = {"success": True, "message": f"Event {event_type} ignored"}
-
-        return JSONResponse(result)
-
-    except Exception as e:
-        print(f"❌ Ошибка в webhook: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return JSONResponse({
-            "success": False,
-            "message": str(e)
-        }, status_code=500)
-
+            return await handle_freescout_ticket_closed(adapted_data)
+        return {"success": True, "message": f"Status change to {status} ignored (not closed)"}
 
+    # Старый формат событий
+    if event_type == "conversation.created":
+        return await handle_freescout_ticket_created(data)
+    if event_type in ["conversation.customer_replied", "conversation.agent_replied"]:
+        return await handle_freescout_reply_created(data)
+    if event_type == "conversation.status_changed":
+        # Проверяем, закрыт ли тикет
+        if data.get("conversation", {}).get("status") == 3:  # 3 = closed
+            return await handle_freescout_ticket_closed(data)
+        return {"success": True, "message": "Status change ignored (not closed)"}
 
-async def freescout_webhook(request: Request):
-    """
-    Webhook endpoint для событий FreeScout
-
-    События:
-    - conversation.created - создание тикета
-    - conversation.customer_replied - ответ клиента
-    - conversation.agent_replied - ответ агента
-    - conversation.status_changed - изменение статуса
-    """
-    try:
-        # SendGrid sends form-data, not JSON
-        form_data = await request.form()
-        
-        # DEBUG: Print all form fields
-        print("🐛 [DEBUG] All form-data fields:")
-        for key in form_data.keys():
-            value = form_data.get(key, "")
-            print(f"   {key}: {value[:200] if len(str(value)) > 200 else value}")
-        
-        # Parse raw email from SendGrid
-        raw_email = form_data.get("email", "")
-        
-        # DEBUG: Save raw email to file
-        if raw_email:
-            with open('/tmp/last_email.txt', 'w', encoding='utf-8') as f:
-                f.write(raw_email)
-            print(f"📧 [DEBUG] Raw email saved to /tmp/last_email.txt ({len(raw_email)} bytes)")
-        
-        email_msg = message_from_string(raw_email) if raw_email else None
-        
-        # Extract plain text from email
-        plain_text = ""
-        html_text = ""
-        
-        if email_msg:
-            if email_msg.is_multipart():
-                for part in email_msg.walk():
-                    content_type = part.get_content_type()
-                    if content_type == "text/plain" and not plain_text:
-                        try:
-                            plain_text = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                        except:
-                            pass
-                    elif content_type == "text/html" and not html_text:
-                        try:
-                            html_text = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                        except:
-                            pass
-            else:
-                try:
-                    payload = email_msg.get_payload(decode=True).decode('utf-8', errors='ignore')
-                    if email_msg.get_content_type() == "text/html":
-                        html_text = payload
-                    else:
-                        plain_text = payload
-                except:
-                    pass
-        
-        # If no plain text, extract from HTML
-        if not plain_text and html_text:
-            # Remove HTML tags and get text
-            plain_text = re.sub(r'<[^>]+>', ' ', html_text)
-            plain_text = unescape(plain_text)
-            # Clean up whitespace
-            plain_text = re.sub(r'\s+', ' ', plain_text).strip()
-        
-        print(f"📧 [DEBUG] Extracted plain text ({len(plain_text)} chars): {plain_text[:300]}")
-        print(f"📧 [DEBUG] Had HTML: {len(html_text) > 0}")
-        
-        # Extract attachment from email (MP3 or TXT)
-        mp3_data = None
-        mp3_filename = None
-        txt_transcription = None
-        
-        if email_msg and email_msg.is_multipart():
-            for part in email_msg.walk():
-                content_disposition = part.get("Content-Disposition", "")
-                content_type = part.get_content_type()
-                
-                # Check if this is an attachment
-                if "attachment" in content_disposition:
-                    filename = part.get_filename()
-                    
-                    # Check for TXT file with transcription
-                    if filename and ".txt" in filename.lower():
-                        txt_data = part.get_payload(decode=True)
-                        try:
-                            # Decode the text
-                            txt_content = txt_data.decode('utf-8', errors='ignore')
-                            print(f"📝 [EMAIL] Найдено TXT вложение: {filename} ({len(txt_data)} bytes)")
-                            print(f"📄 [EMAIL] TXT содержимое: {txt_content[:300]}...")
-                            
-                            # Extract transcription after "следующего содержания:"
-                            if "следующего содержания:" in txt_content:
-                                parts = txt_content.split("следующего содержания:")
-                                if len(parts) > 1:
-                                    txt_transcription = parts[1].strip()
-                                    print(f"✅ [EMAIL] Извлечена транскрипция из TXT: {txt_transcription[:200]}...")
-                            else:
-                                # Use full text if no marker found
-                                txt_transcription = txt_content.strip()
-                                print(f"✅ [EMAIL] Используем полный текст TXT")
-                            break
-                        except Exception as e:
-                            print(f"❌ [EMAIL] Ошибка декодирования TXT: {e}")
-                    
-                    # Check for MP3 file
-                    elif filename and ".mp3" in filename.lower() and ("audio" in content_type or "octet-stream" in content_type):
-                        mp3_data = part.get_payload(decode=True)
-                        mp3_filename = filename
-                        print(f"🎵 [EMAIL] Найдено MP3 вложение: {filename} ({len(mp3_data)} bytes)")
-                        break
-        
-        # Transcribe MP3 using Whisper API if found
-        whisper_transcription = None
-        if mp3_data:
-            try:
-                import tempfile
-                import os
-                
-                # Save MP3 to temporary file
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as tmp_file:
-                    tmp_file.write(mp3_data)
-                    tmp_path = tmp_file.name
-                
-                print(f"💾 [EMAIL] MP3 сохранён во временный файл: {tmp_path}")
-                
-                # Call Whisper API via httpx
-                print(f"🎙️  [EMAIL] Отправляю в Whisper API для транскрибации...")
-                
-                async with httpx.AsyncClient(timeout=60.0) as http_client:
-                    with open(tmp_path, "rb") as audio_file:
-                        files = {"file": (mp3_filename, audio_file, "audio/mpeg")}
-                        data = {
-                            "model": "whisper-1",
-                            "language": "ru"
-                        }
-                        
-                        whisper_response = await http_client.post(
-                            "https://api.openai.com/v1/audio/transcriptions",
-                            headers={
-                                "Authorization": f"Bearer {OPENAI_API_KEY}"
-                            },
-                            files=files,
-                            data=data
-                        )
-                        
-                        if whisper_response.status_code == 200:
-                            result = whisper_response.json()
-                            whisper_transcription = result.get("text", "")
-                            print(f"✅ [EMAIL] Транскрипция получена ({len(whisper_transcription)} символов)")
-                            print(f"📝 [EMAIL] Whisper транскрипция: {whisper_transcription[:200]}...")
-                        else:
-                            print(f"❌ [EMAIL] Whisper API error: {whisper_response.status_code}")
-                            print(f"   Response: {whisper_response.text}")
-                
-                # Clean up temp file
-                os.unlink(tmp_path)
-                
-            except Exception as e:
-                print(f"❌ [EMAIL] Ошибка транскрибации: {e}")
-                import traceback
-                traceback.print_exc()
-        
-        # Convert form to dict for easier access
-        data = {
-            "headers": {},
-            "plain": plain_text,
-            "html": form_data.get("html", ""),
-            "from": form_data.get("from", ""),
-            "to": form_data.get("to", ""),
-            "subject": form_data.get("subject", ""),
-        }
-        event_type = data.get("event")
-
-        print(f"📨 FreeScout webhook: {event_type}")
-
-        if event_type == "conversation.created":
-            result = await handle_freescout_ticket_created(data)
-        elif event_type in ["conversation.customer_replied", "conversation.agent_replied"]:
-            result = await handle_freescout_reply_created(data)
-        elif event_type == "conversation.status_changed":
-            # Проверяем, закрыт ли тикет
-            conversation = data.get("conversation", {})
-            status = conversation.get("status")
-            if status == 3:  # 3 = closed
-                result = await handle_freescout_ticket_closed(data)
-            else:
-                result = {"success": True, "message": "Status change ignored (not closed)"}
-        else:
-            result = {"success": True, "message": f"Event {event_type} ignored"}
+    return {"success": True, "message": f"Event {event_type} ignored"}
 
-        return JSONResponse(result)
 
-    except Exception as e:
-        print(f"❌ Ошибка в webhook: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return JSONResponse({
-            "success": False,
-            "message": str(e)
-        }, status_code=500)
+WEBHOOK_HANDLERS["freescout"] = process_freescout_webhook
 
 
 # ============================================================================
@@ -5761,85 +8612,154 @@ async def get_amocrm_lead_details(lead_id: int) -> Dict[str, Any]:
     if not AMO_ACCESS_TOKEN:
         return {"success": False, "error": "AMO_ACCESS_TOKEN не настроен"}
 
-    headers = {
-        "Authorization": f"Bearer {AMO_ACCESS_TOKEN}",
-        "Content-Type": "application/json"
-    }
-
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(
-                f"{AMO_BASE_URL}/api/v4/leads/{lead_id}?with=contacts",
-                headers=headers
-            )
+        response = await amo_request("GET", f"/api/v4/leads/{lead_id}", params={"with": "contacts"})
 
-            if response.status_code == 200:
-                data = response.json()
+        if response.status_code == 200:
+            data = response.json()
 
-                # Извлекаем custom fields
-                custom_fields = {}
-                if data.get("custom_fields_values"):
-                    for field in data["custom_fields_values"]:
-                        field_id = field.get("field_id")
-                        values = field.get("values", [])
-                        if values:
-                            custom_fields[field_id] = values[0].get("value")
+            # Извлекаем custom fields
+            custom_fields = {}
+            if data.get("custom_fields_values"):
+                for field in data["custom_fields_values"]:
+                    field_id = field.get("field_id")
+                    values = field.get("values", [])
+                    if values:
+                        custom_fields[field_id] = values[0].get("value")
 
-                return {
-                    "success": True,
-                    "lead_id": lead_id,
-                    "status_id": data.get("status_id"),
-                    "pipeline_id": data.get("pipeline_id"),
-                    "custom_fields": custom_fields
-                }
-            else:
-                print(f"❌ Ошибка получения лида {lead_id}: {response.status_code}")
-                return {"success": False, "error": f"HTTP {response.status_code}"}
+            return {
+                "success": True,
+                "lead_id": lead_id,
+                "status_id": data.get("status_id"),
+                "pipeline_id": data.get("pipeline_id"),
+                "custom_fields": custom_fields
+            }
+        else:
+            print(f"❌ Ошибка получения лида {lead_id}: {response.status_code}")
+            return {"success": False, "error": f"HTTP {response.status_code}"}
 
     except Exception as e:
         print(f"❌ Исключение при получении лида: {str(e)}")
         return {"success": False, "error": str(e)}
 
 
-async def get_freescout_user_by_name(full_name: str) -> Optional[int]:
-    """Находит ID пользователя FreeScout по полному имени"""
-    if not FREESCOUT_API_KEY:
-        return None
+FREESCOUT_USERS_REFRESH_INTERVAL = int(os.getenv("FREESCOUT_USERS_REFRESH_INTERVAL", "3600"))
+FREESCOUT_USERS_MISS_COOLDOWN = 60  # сек - не чаще перезагружаем справочник из-за неизвестного имени
 
-    headers = {
-        "X-FreeScout-API-Key": FREESCOUT_API_KEY,
-        "Content-Type": "application/json"
-    }
 
-    try:
-        # Получаем список всех пользователей
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(
-                f"{FREESCOUT_URL}/api/users",
-                headers=headers
-            )
+def normalize_person_name(name: str) -> str:
+    """'Иванов  Пётр' → 'иванов петр': регистр, ё/е и пробелы не важны"""
+    return " ".join((name or "").casefold().replace("ё", "е").split())
 
-            if response.status_code == 200:
+
+class FreeScoutUserDirectory:
+    """
+    Справочник пользователей FreeScout в памяти процесса.
+
+    Загружается один раз, обновляется раз в FREESCOUT_USERS_REFRESH_INTERVAL
+    (в фоне, пока отвечаем по старым данным) и при промахе. Любая загрузка, в том числе
+    после ошибки или при пустом справочнике, - не чаще FREESCOUT_USERS_MISS_COOLDOWN.
+    Имя ищется по словарю - без HTTP запроса на каждое назначение инженера.
+    """
+
+    def __init__(self):
+        self.by_name: Dict[str, int] = {}
+        self.count = 0
+        self.loaded_at = 0.0
+        self.attempted_at = 0.0  # последняя попытка загрузки (успешная или нет)
+        self.refreshing: Optional[asyncio.Task] = None
+        self.stats = {"hits": 0, "misses": 0, "refreshes": 0, "errors": 0}
+
+    async def _fetch_users(self) -> List[Dict[str, Any]]:
+        headers = {
+            "X-FreeScout-API-Key": FREESCOUT_API_KEY,
+            "Content-Type": "application/json"
+        }
+        users = []
+        page = 1
+        async with upstream_client("freescout") as client:
+            while True:
+                response = await client.get(f"{FREESCOUT_URL}/api/users", params={"page": page}, headers=headers)
+                response.raise_for_status()
                 data = response.json()
-                users = data.get("_embedded", {}).get("users", [])
+                users.extend(data.get("_embedded", {}).get("users", []))
+                total_pages = (data.get("page") or {}).get("totalPages") or 1
+                if page >= total_pages:
+                    return users
+                page += 1
 
-                # Ищем пользователя по имени
-                for user in users:
-                    user_full_name = f"{user.get('firstName', '')} {user.get('lastName', '')}".strip()
-                    if user_full_name.lower() == full_name.lower():
-                        print(f"✅ Найден пользователь FreeScout: {user_full_name} (ID: {user.get('id')})")
-                        return user.get("id")
+    async def _refresh(self):
+        try:
+            users = await self._fetch_users()
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"❌ Ошибка получения пользователей FreeScout: {str(e)}")
+            return
+        by_name = {}
+        for user in users:
+            first_name = user.get("firstName", "")
+            last_name = user.get("lastName", "")
+            # И "Имя Фамилия", и "Фамилия Имя"
+            for full_name in (f"{first_name} {last_name}", f"{last_name} {first_name}"):
+                key = normalize_person_name(full_name)
+                if key:
+                    by_name.setdefault(key, user.get("id"))
+        self.by_name = by_name
+        self.count = len(users)
+        self.loaded_at = time.time()
+        self.stats["refreshes"] += 1
+        print(f"👥 Справочник пользователей FreeScout загружен: {len(users)}")
+
+    def _start_refresh(self) -> Optional[asyncio.Task]:
+        """Текущая загрузка или новая, если с прошлой попытки прошло FREESCOUT_USERS_MISS_COOLDOWN"""
+        if self.refreshing is not None and not self.refreshing.done():
+            return self.refreshing
+        if time.time() - self.attempted_at < FREESCOUT_USERS_MISS_COOLDOWN:
+            return None
+        self.attempted_at = time.time()
+        self.refreshing = asyncio.create_task(self._refresh())
+        return self.refreshing
 
-                print(f"⚠️  Пользователь '{full_name}' не найден в FreeScout")
-                return None
-            else:
-                print(f"❌ Ошибка получения пользователей FreeScout: {response.status_code}")
-                return None
+    async def refresh(self):
+        """Single-flight: параллельные вызовы ждут одну загрузку"""
+        task = self._start_refresh()
+        if task is not None:
+            await asyncio.shield(task)
 
-    except Exception as e:
-        print(f"❌ Ошибка поиска пользователя: {str(e)}")
+    async def find(self, full_name: str) -> Optional[int]:
+        key = normalize_person_name(full_name)
+        age = time.time() - self.loaded_at
+
+        if not self.by_name:
+            await self.refresh()
+        elif age > FREESCOUT_USERS_REFRESH_INTERVAL:
+            self._start_refresh()
+
+        user_id = self.by_name.get(key)
+        if user_id is None and self.by_name:
+            # Возможно, пользователя добавили после загрузки
+            await self.refresh()
+            user_id = self.by_name.get(key)
+
+        self.stats["hits" if user_id is not None else "misses"] += 1
+        return user_id
+
+
+freescout_users = FreeScoutUserDirectory()
+
+
+async def get_freescout_user_by_name(full_name: str) -> Optional[int]:
+    """Находит ID пользователя FreeScout по полному имени (через справочник в памяти)"""
+    if not FREESCOUT_API_KEY or not full_name:
         return None
 
+    user_id = await freescout_users.find(full_name)
+    if user_id is not None:
+        print(f"✅ Найден пользователь FreeScout: {full_name} (ID: {user_id})")
+    else:
+        print(f"⚠️  Пользователь '{full_name}' не найден в FreeScout")
+    return user_id
+
 
 async def update_freescout_conversation(
     conversation_id: int,
@@ -5859,7 +8779,7 @@ async def update_freescout_conversation(
     }
 
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
+        async with upstream_client("freescout") as client:
             # 1. Обновляем custom fields
             custom_fields_updates = []
 
@@ -5942,251 +8862,116 @@ async def update_freescout_conversation(
         return {"success": False, "error": str(e)}
 
 
-@app.post("/webhooks/amocrm")
-async def amocrm_webhook(request: Request):
-    """Обработчик webhook от AmoCRM"""
-    try:
-        # SendGrid sends form-data, not JSON
-        form_data = await request.form()
-        
-        # DEBUG: Print all form fields
-        print("🐛 [DEBUG] All form-data fields:")
-        for key in form_data.keys():
-            value = form_data.get(key, "")
-            print(f"   {key}: {value[:200] if len(str(value)) > 200 else value}")
-        
-        # Parse raw email from SendGrid
-        raw_email = form_data.get("email", "")
-        
-        # DEBUG: Save raw email to file
-        if raw_email:
-            with open('/tmp/last_email.txt', 'w', encoding='utf-8') as f:
-                f.write(raw_email)
-            print(f"📧 [DEBUG] Raw email saved to /tmp/last_email.txt ({len(raw_email)} bytes)")
-        
-        email_msg = message_from_string(raw_email) if raw_email else None
-        
-        # Extract plain text from email
-        plain_text = ""
-        html_text = ""
-        
-        if email_msg:
-            if email_msg.is_multipart():
-                for part in email_msg.walk():
-                    content_type = part.get_content_type()
-                    if content_type == "text/plain" and not plain_text:
-                        try:
-                            plain_text = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                        except:
-                            pass
-                    elif content_type == "text/html" and not html_text:
-                        try:
-                            html_text = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                        except:
-                            pass
-            else:
-                try:
-                    payload = email_msg.get_payload(decode=True).decode('utf-8', errors='ignore')
-                    if email_msg.get_content_type() == "text/html":
-                        html_text = payload
-                    else:
-                        plain_text = payload
-                except:
-                    pass
-        
-        # If no plain text, extract from HTML
-        if not plain_text and html_text:
-            # Remove HTML tags and get text
-            plain_text = re.sub(r'<[^>]+>', ' ', html_text)
-            plain_text = unescape(plain_text)
-            # Clean up whitespace
-            plain_text = re.sub(r'\s+', ' ', plain_text).strip()
-        
-        print(f"📧 [DEBUG] Extracted plain text ({len(plain_text)} chars): {plain_text[:300]}")
-        print(f"📧 [DEBUG] Had HTML: {len(html_text) > 0}")
-        
-        # Extract attachment from email (MP3 or TXT)
-        mp3_data = None
-        mp3_filename = None
-        txt_transcription = None
-        
-        if email_msg and email_msg.is_multipart():
-            for part in email_msg.walk():
-                content_disposition = part.get("Content-Disposition", "")
-                content_type = part.get_content_type()
-                
-                # Check if this is an attachment
-                if "attachment" in content_disposition:
-                    filename = part.get_filename()
-                    
-                    # Check for TXT file with transcription
-                    if filename and ".txt" in filename.lower():
-                        txt_data = part.get_payload(decode=True)
-                        try:
-                            # Decode the text
-                            txt_content = txt_data.decode('utf-8', errors='ignore')
-                            print(f"📝 [EMAIL] Найдено TXT вложение: {filename} ({len(txt_data)} bytes)")
-                            print(f"📄 [EMAIL] TXT содержимое: {txt_content[:300]}...")
-                            
-                            # Extract transcription after "следующего содержания:"
-                            if "следующего содержания:" in txt_content:
-                                parts = txt_content.split("следующего содержания:")
-                                if len(parts) > 1:
-                                    txt_transcription = parts[1].strip()
-                                    print(f"✅ [EMAIL] Извлечена транскрипция из TXT: {txt_transcription[:200]}...")
-                            else:
-                                # Use full text if no marker found
-                                txt_transcription = txt_content.strip()
-                                print(f"✅ [EMAIL] Используем полный текст TXT")
-                            break
-                        except Exception as e:
-                            print(f"❌ [EMAIL] Ошибка декодирования TXT: {e}")
-                    
-                    # Check for MP3 file
-                    elif filename and ".mp3" in filename.lower() and ("audio" in content_type or "octet-stream" in content_type):
-                        mp3_data = part.get_payload(decode=True)
-                        mp3_filename = filename
-                        print(f"🎵 [EMAIL] Найдено MP3 вложение: {filename} ({len(mp3_data)} bytes)")
-                        break
-        
-        # Transcribe MP3 using Whisper API if found
-        whisper_transcription = None
-        if mp3_data:
-            try:
-                import tempfile
-                import os
-                
-                # Save MP3 to temporary file
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as tmp_file:
-                    tmp_file.write(mp3_data)
-                    tmp_path = tmp_file.name
-                
-                print(f"💾 [EMAIL] MP3 сохранён во временный файл: {tmp_path}")
-                
-                # Call Whisper API via httpx
-                print(f"🎙️  [EMAIL] Отправляю в Whisper API для транскрибации...")
-                
-                async with httpx.AsyncClient(timeout=60.0) as http_client:
-                    with open(tmp_path, "rb") as audio_file:
-                        files = {"file": (mp3_filename, audio_file, "audio/mpeg")}
-                        data = {
-                            "model": "whisper-1",
-                            "language": "ru"
-                        }
-                        
-                        whisper_response = await http_client.post(
-                            "https://api.openai.com/v1/audio/transcriptions",
-                            headers={
-                                "Authorization": f"Bearer {OPENAI_API_KEY}"
-                            },
-                            files=files,
-                            data=data
-                        )
-                        
-                        if whisper_response.status_code == 200:
-                            result = whisper_response.json()
-                            whisper_transcription = result.get("text", "")
-                            print(f"✅ [EMAIL] Транскрипция получена ({len(whisper_transcription)} символов)")
-                            print(f"📝 [EMAIL] Whisper транскрипция: {whisper_transcription[:200]}...")
-                        else:
-                            print(f"❌ [EMAIL] Whisper API error: {whisper_response.status_code}")
-                            print(f"   Response: {whisper_response.text}")
-                
-                # Clean up temp file
-                os.unlink(tmp_path)
-                
-            except Exception as e:
-                print(f"❌ [EMAIL] Ошибка транскрибации: {e}")
-                import traceback
-                traceback.print_exc()
-        
-        # Convert form to dict for easier access
-        data = {
-            "headers": {},
-            "plain": plain_text,
-            "html": form_data.get("html", ""),
-            "from": form_data.get("from", ""),
-            "to": form_data.get("to", ""),
-            "subject": form_data.get("subject", ""),
-        }
-
-        print(f"📨 AmoCRM webhook получен")
-        print(f"Data: {json.dumps(data, ensure_ascii=False, indent=2)}")
-
-        # AmoCRM отправляет данные в формате:
-        # {"leads": {"status": [{"id": 123, "status_id": 456, ...}]}}
-
-        leads_data = data.get("leads", {})
-        status_changes = leads_data.get("status", [])
+AMO_WEBHOOK_LEAD_KEY = re.compile(r"^leads\[(status|add|update)\]\[(\d+)\]\[([a-z_]+)\]$")
 
-        if not status_changes:
-            return {"status": "ok", "message": "No status changes"}
 
-        for lead_change in status_changes:
-            lead_id = lead_change.get("id")
-            new_status_id = lead_change.get("status_id")
-            pipeline_id = lead_change.get("pipeline_id")
+def parse_amocrm_webhook_leads(form: Dict[str, str], action: str = "status") -> List[Dict[str, Any]]:
+    """leads[status][0][id]=...&leads[status][0][status_id]=... → [{"id": ..., "status_id": ...}]"""
+    leads = {}
+    for key, value in form.items():
+        match = AMO_WEBHOOK_LEAD_KEY.match(key)
+        if not match or match.group(1) != action:
+            continue
+        _, index, field = match.groups()
+        leads.setdefault(int(index), {})[field] = int(value) if str(value).isdigit() else value
+    return [leads[index] for index in sorted(leads)]
 
-            print(f"📊 Лид {lead_id}: статус {new_status_id}, pipeline {pipeline_id}")
 
-            # Проверяем, что это статус "Назначен монтаж" (79103558)
-            if new_status_id == 79103558:
-                print(f"🔧 Обработка статуса 'Назначен монтаж' для лида {lead_id}")
+@app.post("/webhooks/amocrm")
+async def amocrm_webhook(request: Request):
+    """Обработчик webhook от AmoCRM (x-www-form-urlencoded): сохраняем и сразу отвечаем"""
+    try:
+        form = form_to_dict(await request.form())
+    except Exception:
+        return JSONResponse({"status": "error", "message": "Invalid form"}, status_code=400)
+
+    # События одного лида обрабатываются по порядку
+    lead_id = form.get("leads[status][0][id]") or form.get("leads[update][0][id]")
+    contact_id = form.get("contacts[update][0][id]") or form.get("contacts[add][0][id]")
+    order_key = f"amocrm:lead:{lead_id}" if lead_id else (f"amocrm:contact:{contact_id}" if contact_id else None)
+    return await ingest_webhook("amocrm", form, order_key=order_key)
+
+
+async def process_amocrm_webhook(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Обработка вебхука AmoCRM из очереди: индекс контактов и статус 'Назначен монтаж'"""
+    form = job["payload"]
+
+    # Вебхуки контактов держат индекс телефон → contact_id тёплым
+    indexed = await index_amocrm_webhook_contacts(form)
+    if indexed:
+        print(f"📇 [AMO] Индекс контактов обновлён из вебхука: {indexed}")
+
+    print(f"📨 AmoCRM webhook получен")
+
+    status_changes = parse_amocrm_webhook_leads(form, "status")
+
+    if not status_changes:
+        return {"status": "ok", "message": "No status changes"}
+
+    for lead_change in status_changes:
+        lead_id = lead_change.get("id")
+        new_status_id = lead_change.get("status_id")
+        pipeline_id = lead_change.get("pipeline_id")
+
+        print(f"📊 Лид {lead_id}: статус {new_status_id}, pipeline {pipeline_id}")
+
+        # Проверяем, что это статус "Назначен монтаж" (79103558)
+        if new_status_id == 79103558:
+            print(f"🔧 Обработка статуса 'Назначен монтаж' для лида {lead_id}")
+
+            # Получаем детальную информацию о лиде
+            lead_details = await get_amocrm_lead_details(lead_id)
+
+            if not lead_details.get("success"):
+                print(f"❌ Не удалось получить данные лида {lead_id}")
+                continue
+
+            custom_fields = lead_details.get("custom_fields", {})
+
+            # Извлекаем нужные поля
+            address = custom_fields.get(2444397)  # Адрес (полный)
+            notes = custom_fields.get(2578417)    # Примечания
+            engineer = custom_fields.get(2578415) # Инженер
+            connection_date = custom_fields.get(2578411)  # Дата подключения
+            connection_time = custom_fields.get(2578413)  # Время подключения
+            ticket_number = custom_fields.get(2578419)    # Номер тикета
+
+            print(f"📋 Данные лида:")
+            print(f"   Адрес: {address}")
+            print(f"   Инженер: {engineer}")
+            print(f"   Дата: {connection_date}")
+            print(f"   Время: {connection_time}")
+            print(f"   Тикет: {ticket_number}")
+            print(f"   Примечания: {notes[:50] if notes else 'Нет'}...")
+
+            # Обновляем тикет в FreeScout
+            if ticket_number:
+                result = await update_freescout_conversation(
+                    conversation_id=int(ticket_number),
+                    engineer_name=engineer,
+                    connection_date=connection_date,
+                    connection_time=connection_time,
+                    address=address,
+                    notes=notes
+                )
 
-                # Получаем детальную информацию о лиде
-                lead_details = await get_amocrm_lead_details(lead_id)
+                if result.get("success"):
+                    print(f"✅ Тикет {ticket_number} успешно обновлен")
+                else:
+                    print(f"❌ Ошибка обновления тикета {ticket_number}")
+            else:
+                print(f"⚠️  Номер тикета не найден в лиде {lead_id}")
 
-                if not lead_details.get("success"):
-                    print(f"❌ Не удалось получить данные лида {lead_id}")
-                    continue
+    return {"status": "ok", "processed": len(status_changes)}
 
-                custom_fields = lead_details.get("custom_fields", {})
-
-                # Извлекаем нужные поля
-                address = custom_fields.get(2444397)  # Адрес (полный)
-                notes = custom_fields.get(2578417)    # Примечания
-                engineer = custom_fields.get(2578415) # Инженер
-                connection_date = custom_fields.get(2578411)  # Дата подключения
-                connection_time = custom_fields.get(2578413)  # Время подключения
-                ticket_number = custom_fields.get(2578419)    # Номер тикета
-
-                print(f"📋 Данные лида:")
-                print(f"   Адрес: {address}")
-                print(f"   Инженер: {engineer}")
-                print(f"   Дата: {connection_date}")
-                print(f"   Время: {connection_time}")
-                print(f"   Тикет: {ticket_number}")
-                print(f"   Примечания: {notes[:50] if notes else 'Нет'}...")
-
-                # Обновляем тикет в FreeScout
-                if ticket_number:
-                    result = await update_freescout_conversation(
-                        conversation_id=int(ticket_number),
-                        engineer_name=engineer,
-                        connection_date=connection_date,
-                        connection_time=connection_time,
-                        address=address,
-                        notes=notes
-                    )
 
-                    if result.get("success"):
-                        print(f"✅ Тикет {ticket_number} успешно обновлен")
-                    else:
-                        print(f"❌ Ошибка обновления тикета {ticket_number}")
-                else:
-                    print(f"⚠️  Номер тикета не найден в лиде {lead_id}")
+WEBHOOK_HANDLERS["amocrm"] = process_amocrm_webhook
 
-        return {"status": "ok", "processed": len(status_changes)}
 
-    except Exception as e:
-        print(f"❌ Ошибка в AmoCRM webhook: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return {"status": "error", "message": str(e)}
 @app.post("/aida/update-tariffs")
 async def update_tariffs_endpoint():
     """Принудительное обновление тарифов из API"""
-    result = await update_tariffs_from_api()
+    result = await tariffs_refresher.refresh_now()
 
     if result["success"]:
         return {
@@ -6200,36 +8985,29 @@ async def update_tariffs_endpoint():
 
 @app.on_event("startup")
 async def startup_event():
-    """Автообновление тарифов при старте если кэш устарел"""
+    """Инициализация при старте: HTTP клиенты, векторный индекс базы знаний и фоновые задачи"""
     print("🚀 AIDA GPT запускается...")
 
-    # Если кэш невалидный или пустой - обновляем
-    if not tariffs_cache.get("is_valid") or not tariffs_cache.get("tariffs"):
-        print("🔄 Обновление тарифов из API...")
-        result = await update_tariffs_from_api()
+    init_http_clients()
+    kb_vectors.load(kb_index.items, kb_index.fingerprint)
+    asyncio.create_task(session_cleanup_loop())
+    asyncio.create_task(amo_outbox_worker())
+    asyncio.create_task(freescout_outbox_worker())
+    asyncio.create_task(webhook_worker())
+    if ADDRESS_COVERAGE_ACTION:
+        asyncio.create_task(coverage_sync_loop())
 
-        if result["success"]:
-            print(f"✅ Тарифы обновлены: {len(result['tariffs'])} шт.")
-        else:
-            print(f"⚠️  Не удалось обновить тарифы: {result.get('message')}")
-            if tariffs_cache.get("tariffs"):
-                print(f"ℹ️  Будет использоваться старый кэш ({len(tariffs_cache['tariffs'])} тарифов)")
+    # Каталоги обновляются в фоне - старт сервера не ждёт GAS
+    asyncio.create_task(tariffs_refresher.run())
+    asyncio.create_task(addons_refresher.run())
+    print(f"ℹ️  Тарифов в кэше: {len(tariffs_cache.get('tariffs', []))}, доп. услуг: {len(addons_cache.get('addons', []))}")
 
 
-    # Загрузка кэша дополнительных услуг
-    # Проверка валидности кэша дополнительных услуг
-    if not is_addons_cache_valid():
-        print("🔄 Обновление дополнительных услуг из API...")
-        result = await update_addons_from_api()
-
-        if result["success"]:
-            print(f"✅ Дополнительные услуги обновлены: {result['count']} шт.")
-        else:
-            print(f"⚠️  Не удалось обновить доп. услуги: {result.get('message')}")
-            if addons_cache.get("addons"):
-                print(f"ℹ️  Будет использоваться старый кэш ({len(addons_cache['addons'])} услуг)")
-    else:
-        print(f"✅ Кэш дополнительных услуг актуальный ({len(addons_cache['addons'])} шт.)")
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Закрытие пулов HTTP соединений при остановке"""
+    await close_http_clients()
+    print("👋 AIDA GPT остановлен")
 
 
 @app.post("/webhooks/mango/voice")
@@ -6240,6 +9018,8 @@ async def mango_voice_webhook(request: Request, event_type: str = ""):
     События:
     - events/call - начало/конец звонка
     - events/recording - готова запись звонка
+
+    Подпись проверяется сразу, обработка - в очереди (process_mango_voice_webhook)
     """
     try:
         # Получаем данные
@@ -6249,7 +9029,6 @@ async def mango_voice_webhook(request: Request, event_type: str = ""):
 
         print(f"📞 Mango webhook получен")
         print(f"   JSON: {json_data[:200]}...")
-        print(f"   Sign: {received_sign}")
 
         # Проверяем подпись
         if mango_client and not mango_client.verify_webhook_signature(json_data, received_sign):
@@ -6260,40 +9039,44 @@ async def mango_voice_webhook(request: Request, event_type: str = ""):
 
         # Парсим данные
         data = json.loads(json_data)
-        
-        # Если event_type не передан, пытаемся определить из данных
-        if not event_type:
-            event_type = data.get('event_type', '')
-            # Для старого API определяем по наличию полей
-            if 'call_state' in data:
-                event_type = 'call'
-            elif 'talk_time' in data and 'end_cause' in data:
-                event_type = 'summary'
-            elif 'dtmf' in data:
-                event_type = 'dtmf'
-
-        print(f"📞 Mango событие: {event_type}")
-
-        # Обработка событий
-        if event_type == 'call':
-            result = await handle_mango_call_event(data)
-        elif event_type == "recording":
-            result = await handle_mango_recording_event(data)
-        elif event_type == "dtmf":
-            result = await handle_mango_dtmf_event(data)
-        else:
-            result = {"success": True, "message": f"Event {event_type} ignored"}
-
-        return JSONResponse(result)
-
     except Exception as e:
         print(f"❌ Ошибка в Mango webhook: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return JSONResponse({
-            "success": False,
-            "message": str(e)
-        }, status_code=500)
+        return JSONResponse({"success": False, "message": "Invalid payload"}, status_code=400)
+
+    # Если event_type не передан, пытаемся определить из данных
+    if not event_type:
+        event_type = data.get('event_type', '')
+        # Для старого API определяем по наличию полей
+        if 'call_state' in data:
+            event_type = 'call'
+        elif 'talk_time' in data and 'end_cause' in data:
+            event_type = 'summary'
+        elif 'dtmf' in data:
+            event_type = 'dtmf'
+
+    print(f"📞 Mango событие: {event_type}")
+
+    # События одного звонка - строго по порядку
+    call_id = data.get('call_id') or data.get('entry_id')
+    return await ingest_webhook("mango_voice", {"event_type": event_type, "data": data},
+                          order_key=f"mango:call:{call_id}" if call_id else None)
+
+
+async def process_mango_voice_webhook(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Обработка события Mango Office из очереди"""
+    event_type = job["payload"]["event_type"]
+    data = job["payload"]["data"]
+
+    if event_type == 'call':
+        return await handle_mango_call_event(data)
+    if event_type == "recording":
+        return await handle_mango_recording_event(data)
+    if event_type == "dtmf":
+        return await handle_mango_dtmf_event(data)
+    return {"success": True, "message": f"Event {event_type} ignored"}
+
+
+WEBHOOK_HANDLERS["mango_voice"] = process_mango_voice_webhook
 
 
 async def handle_mango_call_event(data: Dict) -> Dict:
@@ -6312,13 +9095,13 @@ async def handle_mango_call_event(data: Dict) -> Dict:
 
         # Начало звонка
         if call_state == 'Appeared':
-            active_calls[call_id] = {
+            await save_active_call({
                 'id': call_id,
                 'from': from_number,
                 'to': to_number,
                 'start_time': timestamp,
                 'messages': []
-            }
+            })
 
             print(f"✅ Зарегистрирован звонок {call_id}")
 
@@ -6330,8 +9113,8 @@ async def handle_mango_call_event(data: Dict) -> Dict:
 
         # Завершение звонка
         elif call_state in ['Disconnected', 'OnHold']:
-            if call_id in active_calls:
-                call_data = active_calls.pop(call_id)
+            call_data = await pop_active_call(call_id)
+            if call_data:
                 duration = timestamp - call_data.get('start_time', timestamp)
 
                 print(f"✅ Звонок {call_id} завершен (длительность: {duration}с)")
@@ -6401,12 +9184,11 @@ async def handle_mango_recording_event(data: Dict) -> Dict:
         print(f"🎙️  Запись готова: {recording_id} для звонка {call_id}")
 
         # Проверяем, есть ли информация о звонке
-        if call_id not in active_calls:
+        call_info = await get_active_call(call_id)
+        if not call_info:
             print(f"⚠️  Звонок {call_id} не найден в активных")
             return {"success": False, "error": "Call not found"}
 
-        call_info = active_calls[call_id]
-
         # Скачиваем запись
         if not mango_client:
             print("❌ MangoClient не инициализирован")
@@ -6454,41 +9236,42 @@ async def handle_mango_recording_event(data: Dict) -> Dict:
         print(f"🗣️  Распознано: \"{recognized_text}\"")
 
         # Добавляем сообщение в историю звонка
-        call_info['messages'].append({
+        call_info = await update_active_call(call_id, message={
             'role': 'user',
             'content': recognized_text,
             'timestamp': int(time.time())
-        })
+        }) or call_info
 
         # Обрабатываем сообщение через GPT
         # Используем call_id как session_id для сохранения контекста разговора
         session_id = f"call_{call_id}"
 
         # Получаем или создаем историю разговора
-        if session_id not in conversations:
-            # Формируем системный промпт с учетом данных биллинга
-            system_prompt = SYSTEM_PROMPT
+        if not await sessions.exists(session_id):
+            session = await sessions.get(session_id)
 
+            # Дополняем системный промпт данными биллинга
             if call_info.get('is_known_client') and call_info.get('billing_data'):
                 billing = call_info['billing_data']
-                system_prompt += f"\n\nИнформация о звонящем клиенте:\n"
-                system_prompt += f"- ФИО: {billing.get('fullname', 'Не указано')}\n"
-                system_prompt += f"- Баланс: {billing.get('balance', '0')} руб.\n"
-                system_prompt += f"- Тариф: {billing.get('tariff', 'Не указан')}\n"
-                system_prompt += f"- Адрес: {billing.get('address', 'Не указан')}\n"
-
-            conversations[session_id] = [
-                {"role": "system", "content": system_prompt}
-            ]
+                caller_info = f"\n\nИнформация о звонящем клиенте:\n"
+                caller_info += f"- ФИО: {billing.get('fullname', 'Не указано')}\n"
+                caller_info += f"- Баланс: {billing.get('balance', '0')} руб.\n"
+                caller_info += f"- Тариф: {billing.get('tariff', 'Не указан')}\n"
+                caller_info += f"- Адрес: {billing.get('address', 'Не указан')}\n"
+                session.prompt_context = caller_info
+                session.prompt_modules.add("billing")
+                await sessions.save(session)
 
         # Добавляем сообщение пользователя
-        conversations[session_id].append({
+        await sessions.append_message(session_id, {
             "role": "user",
             "content": recognized_text
         })
 
+        await update_prompt_modules(session_id, user_message=recognized_text)
+
         # Вызываем OpenAI для получения ответа
-        async with httpx.AsyncClient(timeout=60.0, follow_redirects=True) as client:
+        async with upstream_client("openai") as client:
             max_iterations = 3  # Ограничиваем для голосовых звонков
             iteration = 0
 
@@ -6504,9 +9287,10 @@ async def handle_mango_recording_event(data: Dict) -> Dict:
                         },
                         json={
                             "model": "gpt-4o-mini",
-                            "messages": conversations[session_id],
-                            "functions": FUNCTIONS,
-                            "function_call": "auto",
+                            "messages": await build_chat_messages(session_id),
+                            "tools": await build_chat_tools(session_id),
+                            "tool_choice": "auto",
+                            "parallel_tool_calls": True,
                             "temperature": 0.7
                         }
                     )
@@ -6515,23 +9299,9 @@ async def handle_mango_recording_event(data: Dict) -> Dict:
 
                     message = resp_data["choices"][0]["message"]
 
-                    # Если есть вызов функции
-                    if message.get("function_call"):
-                        function_name = message["function_call"]["name"]
-                        arguments = json.loads(message["function_call"]["arguments"])
-
-                        # Добавляем сообщение ассистента с вызовом функции
-                        conversations[session_id].append(message)
-
-                        # Вызываем функцию
-                        function_result = await call_function(function_name, arguments)
-
-                        # Добавляем результат функции
-                        conversations[session_id].append({
-                            "role": "function",
-                            "name": function_name,
-                            "content": json.dumps(function_result, ensure_ascii=False)
-                        })
+                    # Если модель вызвала инструменты (возможно, несколько сразу)
+                    if message.get("tool_calls"):
+                        await run_tool_calls(session_id, message["tool_calls"], message.get("content"))
 
                         # Продолжаем цикл для получения финального ответа
                         continue
@@ -6540,13 +9310,13 @@ async def handle_mango_recording_event(data: Dict) -> Dict:
                     assistant_message = message.get("content", "Извините, произошла ошибка")
 
                     # Добавляем ответ в историю
-                    conversations[session_id].append({
+                    await sessions.append_message(session_id, {
                         "role": "assistant",
                         "content": assistant_message
                     })
 
                     # Добавляем в историю звонка
-                    call_info['messages'].append({
+                    await update_active_call(call_id, message={
                         'role': 'assistant',
                         'content': assistant_message,
                         'timestamp': int(time.time())
@@ -6606,18 +9376,14 @@ async def send_greeting_to_call(call_id: str, caller_number: str):
             greeting_text = f"Здравствуйте, {first_name}! Вы позвонили в компанию СМИТ. Меня зовут Аида, я голосовой помощник. Чем могу помочь?"
             
             # Сохраняем данные биллинга в активный звонок
-            if call_id in active_calls:
-                active_calls[call_id]['billing_data'] = billing_data
-                active_calls[call_id]['is_known_client'] = True
+            if await update_active_call(call_id, billing_data=billing_data, is_known_client=True):
                 print(f"   👤 Существующий клиент: {fullname}")
                 print(f"   💰 Баланс: {balance} руб., Тариф: {tariff}")
         else:
             # Новый клиент
             greeting_text = "Здравствуйте! Вы позвонили в компанию СМИТ. Меня зовут Аида, я голосовой помощник. Чем могу помочь?"
             
-            if call_id in active_calls:
-                active_calls[call_id]['billing_data'] = None
-                active_calls[call_id]['is_known_client'] = False
+            if await update_active_call(call_id, billing_data=None, is_known_client=False):
                 print(f"   ℹ️  Новый клиент (не найден в биллинге)")
 
         # Синтезируем голос
@@ -6685,7 +9451,7 @@ async def handle_mango_dtmf_event(data: Dict) -> Dict:
         print(f"⌨️  DTMF событие: звонок {call_id}, нажата клавиша {digit}")
         
         # Получаем информацию о звонке
-        call_info = active_calls.get(call_id)
+        call_info = await get_active_call(call_id)
         if not call_info:
             print(f"⚠️  Звонок {call_id} не найден в активных")
             return {"success": False, "error": "Call not found"}
@@ -6853,9 +9619,10 @@ async def create_support_ticket(from_number: str, recording_url: str = "", call_
         if transcription and len(transcription) > 10:
             try:
                 print(f"🤖 [SUPPORT] Генерация заголовка на основе транскрипции")
-                async with httpx.AsyncClient(timeout=15.0) as client:
+                async with upstream_client("openai") as client:
                     response = await client.post(
                         "https://api.openai.com/v1/chat/completions",
+                        timeout=15.0,
                         headers={
                             "Authorization": f"Bearer {OPENAI_API_KEY}",
                             "Content-Type": "application/json"
@@ -6935,9 +9702,11 @@ async def create_support_ticket(from_number: str, recording_url: str = "", call_
 
 async def create_voicemail_lead(from_number: str, recording_url: str = "", call_duration: int = 0) -> Dict:
     """
-    Создает лид в AmoCRM из голосовой заявки
+    Создает лид в AmoCRM из голосовой заявки (через outbox)
     
     Вызывается когда клиент оставил голосовое сообщение на номере голосовой почты.
+    Если AmoCRM не ответил за AMO_OUTBOX_SYNC_WAIT, возвращает {"queued": True, "job_id": ...} -
+    лид будет создан воркером outbox.
     """
     try:
         print(f"📞 [VOICEMAIL] Создание лида для {from_number}")
@@ -6951,14 +9720,16 @@ async def create_voicemail_lead(from_number: str, recording_url: str = "", call_
             print("❌ [VOICEMAIL] AmoCRM token не настроен")
             return {"success": False, "error": "AmoCRM not configured"}
         
-        headers = {
-            "Authorization": f"Bearer {AMO_ACCESS_TOKEN}",
-            "Content-Type": "application/json"
-        }
-        
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            # Создаем контакт
-            contact_data = [{
+        # Примечание только с полезной информацией
+        note_text = "🎙️ Голосовая заявка на подключение\n\n"
+        if from_number and from_number != "Не указан" and not from_number.startswith("+Не"):
+            note_text += f"📞 Телефон: {from_number}\n"
+        if call_duration > 0:
+            note_text += f"⏱️ Длительность: {call_duration // 60}м {call_duration % 60}с\n"
+
+        result = await submit_amo_write("create_lead", {
+            "phone": from_number,
+            "contact": {
                 "name": f"Клиент {from_number}",
                 "custom_fields_values": [
                     {
@@ -6966,85 +9737,20 @@ async def create_voicemail_lead(from_number: str, recording_url: str = "", call_
                         "values": [{"value": from_number, "enum_code": "WORK"}]
                     }
                 ]
-            }]
-            
-            contact_response = await client.post(
-                f"{AMO_BASE_URL}/api/v4/contacts",
-                json=contact_data,
-                headers=headers
-            )
-            
-            contact_id = None
-            if contact_response.status_code in [200, 201]:
-                data = contact_response.json()
-                if data.get("_embedded") and data["_embedded"].get("contacts"):
-                    contact_id = data["_embedded"]["contacts"][0]["id"]
-                    print(f"✅ [VOICEMAIL] Контакт создан: {contact_id}")
-            
-            # Создаем лид
-            lead_data = {
+            },
+            "lead": {
                 "name": f"Голосовая заявка: {from_number}",
                 "price": 0,
                 "pipeline_id": AMO_PIPELINE_B2C_ID,
                 "status_id": 79103550,  # Новый
                 "responsible_user_id": AMO_DEFAULT_RESPONSIBLE_USER_ID
-            }
-            
-            if contact_id:
-                lead_data["_embedded"] = {"contacts": [{"id": contact_id}]}
-            
-            lead_response = await client.post(
-                f"{AMO_BASE_URL}/api/v4/leads",
-                json=[lead_data],
-                headers=headers
-            )
-            
-            if lead_response.status_code in [200, 201]:
-                data = lead_response.json()
-                if data.get("_embedded") and data["_embedded"].get("leads"):
-                    lead_id = data["_embedded"]["leads"][0]["id"]
-                    print(f"✅ [VOICEMAIL] Лид создан: {lead_id}")
-                    
-                    # Добавляем примечание с записью
-                    duration_text = f"{call_duration // 60}м {call_duration % 60}с" if call_duration > 0 else "неизвестно"
-                    
-                    note_text = "🎙️ Голосовая заявка на подключение\n\n"
-                    
-                    # Добавляем только полезную информацию
-                    if from_number and from_number != "Не указан" and not from_number.startswith("+Не"):
-                        note_text += f"📞 Телефон: {from_number}\n"
-                    
-                    if call_duration > 0:
-                        note_text += f"⏱️ Длительность: {duration_text}\n"
-                    
-
-                    
-                    note_data = [{
-                        "entity_id": lead_id,
-                        "note_type": "common",
-                        "params": {"text": note_text}
-                    }]
-                    
-                    note_response = await client.post(
-                        f"{AMO_BASE_URL}/api/v4/leads/notes",
-                        json=note_data,
-                        headers=headers
-                    )
-                    
-                    if note_response.status_code in [200, 201]:
-                        print(f"✅ [VOICEMAIL] Примечание добавлено к лиду {lead_id}")
-                    else:
-                        print(f"⚠️  [VOICEMAIL] Ошибка добавления примечания: {note_response.status_code} - {note_response.text}")
-                    
-                    return {
-                        "success": True,
-                        "lead_id": lead_id,
-                        "contact_id": contact_id,
-                        "phone": from_number
-                    }
-            
-            print(f"❌ [VOICEMAIL] Ошибка создания лида: {lead_response.text}")
-            return {"success": False, "error": lead_response.text}
+            },
+            "note_text": note_text,
+            "log_tag": "VOICEMAIL",
+            "extra_result": {"phone": from_number}
+        }, wait=AMO_OUTBOX_SYNC_WAIT)
+
+        return {**result, "phone": from_number}
     
     except Exception as e:
         print(f"❌ [VOICEMAIL] Ошибка: {str(e)}")
@@ -7079,6 +9785,7 @@ async def mango_voicemail_events_call(request: Request):
 @app.post("/webhooks/mango/voicemail/events/summary")
 async def mango_voicemail_events_summary(request: Request):
     """Handle summary events - creates lead or ticket based on DTMF"""
+    fingerprint = None
     try:
         form_data = await request.form()
         json_data = form_data.get('json', '{}')
@@ -7093,6 +9800,11 @@ async def mango_voicemail_events_summary(request: Request):
 
         data = json.loads(json_data)
 
+        # Повтор summary второй раз запросил бы запись и разбудил письма
+        fingerprint = webhook_fingerprint("mango_summary", json_data)
+        if not await claim_webhook_event(fingerprint):
+            return duplicate_webhook_response("mango_summary", fingerprint)
+
         # Extract data
         from_number = data.get('from', {}).get('number', '')
         if not from_number:
@@ -7107,63 +9819,20 @@ async def mango_voicemail_events_summary(request: Request):
         print(f"   Entry ID: {entry_id}")
         print(f"   Duration: {call_duration}s")
 
-        # Check which key was pressed (default to '1' if not found)
-        pressed_key = dtmf_cache.get(entry_id, '1')
-        print(f"🔑 [VOICEMAIL] Нажата клавиша: {pressed_key}")
-
-        # Clean up cache
-        if entry_id in dtmf_cache:
-            del dtmf_cache[entry_id]
-
         # ВАЖНО: Сохраняем данные звонка для email endpoint СРАЗУ
         # Email может прийти раньше чем получим запись звонка
-        global last_voicemail_data
-        last_voicemail_data = {
-            'from_number': from_number,
-            'recording_url': '',  # Пока пустая, обновим позже
-            'call_duration': call_duration,
-            'pressed_key': pressed_key,
-            'entry_id': entry_id
-        }
-        print(f"💾 [VOICEMAIL] Данные сохранены для email endpoint")
-        print(f"   Номер: {from_number}")
-        print(f"   Клавиша: {pressed_key}")
-        print(f"   Entry ID: {entry_id}")
-
-        # Get recording URL if entry_id available (в фоне, не блокируя)
-        recording_url = ""
+        record, waiting = await voicemail_store.add_summary(entry_id, from_number, call_duration)
+        print(f"🔑 [VOICEMAIL] Нажата клавиша: {record['pressed_key']}")
+        print(f"💾 [VOICEMAIL] Данные звонка {entry_id} сохранены для email endpoint")
+        if waiting:
+            # Письмо пришло раньше summary - будим его обработку
+            print(f"🔗 [VOICEMAIL] Письма ждут этот звонок: {waiting}")
+            webhook_queue.wake(waiting)
+
+        # Запись запрашиваем в очереди, с задержкой - Mango ещё обрабатывает её
         if mango_client and entry_id:
-            print(f"🔍 [VOICEMAIL] Запрашиваем запись для entry_id: {entry_id}")
-            # Wait for recording processing
-            import asyncio
-            await asyncio.sleep(3)
-
-            print(f"⏳ [VOICEMAIL] Вызываем get_recordings_by_entry...")
-            recordings_result = await mango_client.get_recordings_by_entry(entry_id)
-            print(f"📊 [VOICEMAIL] Результат API: {recordings_result}")
-
-            if recordings_result.get('success'):
-                recordings = recordings_result.get('recordings', [])
-                print(f"📝 [VOICEMAIL] Найдено записей: {len(recordings)}")
-
-                if recordings:
-                    recording = recordings[-1] if len(recordings) > 1 else recordings[0]
-                    recording_id = recording.get('recording_id', '')
-                    print(f"🎙️  [VOICEMAIL] Recording ID: {recording_id}")
-
-                    if recording_id:
-                        recording_url = f"https://app.mango-office.ru/media/call_records/{recording_id}"
-                        print(f"✅ [VOICEMAIL] Recording URL: {recording_url}")
-
-                        # Обновляем recording_url в кеше
-                        if last_voicemail_data and last_voicemail_data.get('entry_id') == entry_id:
-                            last_voicemail_data['recording_url'] = recording_url
-                            print(f"✅ [VOICEMAIL] Recording URL добавлен в кеш")
-                else:
-                    print(f"⚠️  [VOICEMAIL] Массив recordings пустой")
-            else:
-                error = recordings_result.get('error', 'Unknown')
-                print(f"❌ [VOICEMAIL] Ошибка получения записей: {error}")
+            await ingest_webhook("mango_voicemail_recording", {"entry_id": entry_id},
+                           order_key=f"mango:entry:{entry_id}", delay=MANGO_RECORDING_DELAY, dedup=False)
         elif not entry_id:
             print(f"⚠️  [VOICEMAIL] entry_id отсутствует в webhook")
         elif not mango_client:
@@ -7175,9 +9844,56 @@ async def mango_voicemail_events_summary(request: Request):
         print(f"❌ [VOICEMAIL] Summary event error: {str(e)}")
         import traceback
         traceback.print_exc()
+        # Summary не обработан - повтор от Mango должен пройти, а не считаться дублем
+        if fingerprint:
+            await state.delete("webhook_seen", fingerprint)
         return JSONResponse({"success": False, "error": str(e)}, status_code=500)
 
 
+async def get_voicemail_recording_url(entry_id: str) -> str:
+    """URL записи голосового сообщения по entry_id ("" если записи ещё нет)"""
+    print(f"⏳ [VOICEMAIL] Вызываем get_recordings_by_entry...")
+    recordings_result = await mango_client.get_recordings_by_entry(entry_id)
+    print(f"📊 [VOICEMAIL] Результат API: {recordings_result}")
+
+    if not recordings_result.get('success'):
+        error = recordings_result.get('error', 'Unknown')
+        print(f"❌ [VOICEMAIL] Ошибка получения записей: {error}")
+        return ""
+
+    recordings = recordings_result.get('recordings', [])
+    print(f"📝 [VOICEMAIL] Найдено записей: {len(recordings)}")
+    if not recordings:
+        print(f"⚠️  [VOICEMAIL] Массив recordings пустой")
+        return ""
+
+    recording = recordings[-1] if len(recordings) > 1 else recordings[0]
+    recording_id = recording.get('recording_id', '')
+    print(f"🎙️  [VOICEMAIL] Recording ID: {recording_id}")
+    if not recording_id:
+        return ""
+    # Формируем URL записи (публичный URL от Манго)
+    return f"https://app.mango-office.ru/media/call_records/{recording_id}"
+
+
+async def process_voicemail_recording(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Добавляет URL записи в данные последнего голосового сообщения"""
+    entry_id = job["payload"]["entry_id"]
+    print(f"🔍 [VOICEMAIL] Запрашиваем запись для entry_id: {entry_id}")
+
+    recording_url = await get_voicemail_recording_url(entry_id)
+    if recording_url:
+        print(f"✅ [VOICEMAIL] Recording URL: {recording_url}")
+
+        await voicemail_store.set_recording(entry_id, recording_url)
+        print(f"✅ [VOICEMAIL] Recording URL добавлен к звонку {entry_id}")
+
+    return {"success": True, "recording_url": recording_url}
+
+
+WEBHOOK_HANDLERS["mango_voicemail_recording"] = process_voicemail_recording
+
+
 @app.post("/webhooks/mango/voicemail/events/dtmf")
 async def mango_voicemail_dtmf(request: Request):
     """Handle DTMF (key press) events from Mango voicemail"""
@@ -7208,7 +9924,7 @@ async def mango_voicemail_dtmf(request: Request):
 
         # Store DTMF key in cache for routing
         if entry_id and digit:
-            dtmf_cache[entry_id] = digit
+            await voicemail_store.add_dtmf(entry_id, digit)
             print(f"💾 [DTMF] Сохранено в кеш: entry_id={entry_id}, digit={digit}")
 
         return JSONResponse({"success": True, "status": "received", "digit": digit})
@@ -7254,42 +9970,41 @@ async def mango_voicemail_webhook(request: Request):
         print(f"   Call ID: {call_id}")
         print(f"   Entry ID: {entry_id}")
         
-        # Если есть entry_id, получаем запись
-        recording_url = ""
-        call_duration = int(data.get('talk_time', 0))
-        
-        if mango_client and entry_id:
-            # Даем время на обработку записи в Манго
-            import asyncio
-            await asyncio.sleep(3)
-            
-            # Получаем список записей
-            recordings_result = await mango_client.get_recordings_by_entry(entry_id)
-            if recordings_result.get('success'):
-                recordings = recordings_result.get('recordings', [])
-                if recordings:
-                    recording = recordings[-1] if len(recordings) > 1 else recordings[0]
-                    recording_id = recording.get('recording_id', '')
-                    if recording_id:
-                        # Формируем URL записи (публичный URL от Манго)
-                        recording_url = f"https://app.mango-office.ru/media/call_records/{recording_id}"
-                        print(f"🎙️  [VOICEMAIL] Запись: {recording_url}")
-        
-        # Создаем лид
-        result = await create_voicemail_lead(
-            from_number=from_number,
-            recording_url=recording_url,
-            call_duration=call_duration
-        )
-        
-        return JSONResponse(result)
-    
+        # Запись и лид - в очереди; запись запрашиваем с задержкой, пока Mango её обрабатывает
+        return await ingest_webhook("mango_voicemail", {
+            "from_number": from_number,
+            "entry_id": entry_id,
+            "call_duration": int(data.get('talk_time', 0))
+        }, order_key=f"mango:entry:{entry_id}" if entry_id else None,
+            delay=MANGO_RECORDING_DELAY if mango_client and entry_id else 0, identity=(entry_id,))
+
     except Exception as e:
         print(f"❌ [VOICEMAIL] Исключение: {str(e)}")
         import traceback
         traceback.print_exc()
         return JSONResponse({"success": False, "error": str(e)}, status_code=500)
 
+
+async def process_mango_voicemail(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Лид из голосовой почты: запись (если есть) + create_voicemail_lead"""
+    payload = job["payload"]
+
+    recording_url = ""
+    if mango_client and payload["entry_id"]:
+        recording_url = await get_voicemail_recording_url(payload["entry_id"])
+        if recording_url:
+            print(f"🎙️  [VOICEMAIL] Запись: {recording_url}")
+
+    # Создаем лид
+    return await create_voicemail_lead(
+        from_number=payload["from_number"],
+        recording_url=recording_url,
+        call_duration=payload["call_duration"]
+    )
+
+
+WEBHOOK_HANDLERS["mango_voicemail"] = process_mango_voicemail
+
 # ==================== КОНЕЦ ГОЛОСОВОЙ ПОЧТЫ ====================
 
 # ==================== AI ПРЕДМОДЕРАЦИЯ ГОЛОСОВОЙ ПОЧТЫ ====================
@@ -7335,9 +10050,10 @@ async def ai_analyze_voicemail(transcription: str, phone: str) -> Dict:
 
 Верни ТОЛЬКО JSON, без дополнительного текста."""
 
-        async with httpx.AsyncClient(timeout=30.0) as client:
+        async with upstream_client("openai") as client:
             response = await client.post(
                 "https://api.openai.com/v1/chat/completions",
+                timeout=30.0,
                 headers={
                     "Authorization": f"Bearer {OPENAI_API_KEY}",
                     "Content-Type": "application/json"
@@ -7385,6 +10101,290 @@ async def ai_analyze_voicemail(transcription: str, phone: str) -> Dict:
 
 
 
+# ==================== ТРАНСКРИПЦИЯ ГОЛОСОВЫХ СООБЩЕНИЙ ====================
+# Текст от Mango (TXT вложение) приоритетнее; MP3 распознаёт Whisper - не больше
+# WHISPER_CONCURRENCY запросов одновременно, результат кэшируется по SHA-256 аудио.
+
+WHISPER_CONCURRENCY = int(os.getenv("WHISPER_CONCURRENCY", "2"))
+TRANSCRIPTION_CACHE_TTL = int(os.getenv("TRANSCRIPTION_CACHE_TTL", str(30 * 86400)))
+
+whisper_semaphore: Optional[asyncio.Semaphore] = None  # создаётся в цикле событий при первом вызове
+transcription_stats = {"mango_txt": 0, "cache_hits": 0, "whisper_calls": 0, "whisper_errors": 0}
+
+
+async def transcribe_voicemail(audio: Optional[bytes], filename: Optional[str] = None,
+                               mango_text: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Транскрипция голосового сообщения → {"text": ..., "source": "mango" | "cache" | "whisper" | None}
+
+    429/5xx и сетевые ошибки Whisper пробрасываются - задача очереди повторится позже
+    """
+    if mango_text:
+        transcription_stats["mango_txt"] += 1
+        return {"text": mango_text, "source": "mango"}
+    if not audio:
+        return {"text": None, "source": None}
+
+    audio_hash = hashlib.sha256(audio).hexdigest()
+    cached = await state.get("transcription", audio_hash)
+    if cached is not None:
+        transcription_stats["cache_hits"] += 1
+        print(f"💾 [WHISPER] Транскрипция из кэша ({audio_hash[:12]})")
+        return {"text": cached, "source": "cache"}
+
+    global whisper_semaphore
+    if whisper_semaphore is None:
+        whisper_semaphore = asyncio.Semaphore(WHISPER_CONCURRENCY)
+    async with whisper_semaphore:
+        # Пока ждали слот, это же аудио могли распознать в соседней задаче
+        cached = await state.get("transcription", audio_hash)
+        if cached is not None:
+            transcription_stats["cache_hits"] += 1
+            return {"text": cached, "source": "cache"}
+
+        print(f"🎙️  [WHISPER] Отправляю {filename or 'аудио'} ({len(audio)} bytes) на распознавание...")
+        transcription_stats["whisper_calls"] += 1
+        async with upstream_client("openai") as http_client:
+            try:
+                response = await http_client.post(
+                    "https://api.openai.com/v1/audio/transcriptions",
+                    headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
+                    files={"file": (filename or "voicemail.mp3", audio, "audio/mpeg")},
+                    data={"model": "whisper-1", "language": "ru"}
+                )
+            except httpx.HTTPError:
+                transcription_stats["whisper_errors"] += 1
+                raise
+
+    if response.status_code == 429 or response.status_code >= 500:
+        transcription_stats["whisper_errors"] += 1
+        raise RuntimeError(f"Whisper API {response.status_code}: {response.text[:200]}")
+    if response.status_code != 200:
+        # Повтор не поможет (битый файл и т.п.) - продолжаем без транскрипции
+        transcription_stats["whisper_errors"] += 1
+        print(f"❌ [WHISPER] Whisper API error: {response.status_code}")
+        print(f"   Response: {response.text}")
+        return {"text": None, "source": None}
+
+    text = response.json().get("text", "")
+    await state.set("transcription", audio_hash, text, ttl=TRANSCRIPTION_CACHE_TTL)
+    print(f"✅ [WHISPER] Транскрипция получена ({len(text)} символов): {text[:200]}")
+    return {"text": text, "source": "whisper"}
+
+
+# ==================== ВХОДЯЩАЯ ПОЧТА (SendGrid Inbound Parse) ====================
+# Тело запроса разбирается потоково: сырое письмо (поле "email") пишется на диск по мере
+# прихода, в очередь попадает только путь. Воркер разбирает файл (BytesParser) за один проход.
+
+try:
+    import python_multipart as multipart
+    from python_multipart.multipart import parse_options_header
+except ImportError:
+    # python-multipart < 0.0.13
+    import multipart
+    from multipart.multipart import parse_options_header
+
+INBOUND_EMAIL_SPOOL_DIR = os.getenv("INBOUND_EMAIL_SPOOL_DIR", os.path.join(os.path.dirname(__file__), "inbound_email"))
+INBOUND_EMAIL_MAX_ATTACHMENT = int(float(os.getenv("INBOUND_EMAIL_MAX_ATTACHMENT_MB", "25")) * 1024 * 1024)
+# Остальные поля формы (headers, subject, envelope...) держатся в памяти - их размер ограничен
+INBOUND_EMAIL_MAX_FIELD = 1024 * 1024
+# Копия последнего письма для отладки (пусто - не сохраняем)
+INBOUND_EMAIL_DEBUG_DUMP = os.getenv("INBOUND_EMAIL_DEBUG_DUMP", "")
+
+
+class InboundEmail:
+    """Нужные нам части письма: текст, TXT и MP3 вложения"""
+
+    def __init__(self):
+        self.subject = ""
+        self.from_addr = ""
+        self.plain = ""
+        self.html = ""
+        self.txt_attachment: Optional[str] = None
+        self.txt_filename: Optional[str] = None
+        self.audio: Optional[bytes] = None
+        self.audio_filename: Optional[str] = None
+        self.skipped: List[str] = []  # вложения, пропущенные из-за размера
+
+    @property
+    def text(self) -> str:
+        """text/plain, а если его нет - текст из HTML"""
+        if self.plain or not self.html:
+            return self.plain
+        text = unescape(re.sub(r'<[^>]+>', ' ', self.html))
+        return re.sub(r'\s+', ' ', text).strip()
+
+
+class InboundEmailForm:
+    """
+    Колбэки multipart-парсера для формы SendGrid: данные части "email" копятся в pending
+    до записи в файл, текстовые поля - в fields, прочие файлы пропускаются
+    """
+
+    def __init__(self):
+        self.fields: Dict[str, str] = {}
+        self.pending = bytearray()
+        self.name = ""
+        self.skip = False
+        self.value = bytearray()
+        self.header_field = bytearray()
+        self.header_value = bytearray()
+
+    def callbacks(self) -> Dict[str, Any]:
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+        }
+
+    def on_part_begin(self):
+        self.name = ""
+        self.skip = False
+        self.value = bytearray()
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self.header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self.header_value += data[start:end]
+
+    def on_header_end(self):
+        if bytes(self.header_field).lower() == b"content-disposition":
+            _, options = parse_options_header(bytes(self.header_value))
+            self.name = options.get(b"name", b"").decode("utf-8", errors="replace")
+            # Файлы кроме самого письма (вложения без raw-режима) нам не нужны
+            self.skip = self.name != "email" and b"filename" in options
+        self.header_field.clear()
+        self.header_value.clear()
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if self.name == "email":
+            self.pending += data[start:end]
+        elif not self.skip:
+            if len(self.value) + end - start > INBOUND_EMAIL_MAX_FIELD:
+                raise HTTPException(status_code=400, detail=f"Поле {self.name} больше {INBOUND_EMAIL_MAX_FIELD} байт")
+            self.value += data[start:end]
+
+    def on_part_end(self):
+        if self.name != "email" and not self.skip:
+            self.fields[self.name] = self.value.decode("utf-8", errors="replace")
+
+
+async def spool_inbound_email(request: Request) -> Dict[str, Any]:
+    """
+    Сохраняет сырое письмо из формы SendGrid в INBOUND_EMAIL_SPOOL_DIR, читая тело
+    запроса потоком (request.stream()) - письмо целиком в памяти не держится.
+    Возвращает остальные текстовые поля формы, путь к файлу и SHA-256 письма
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="Ожидается multipart/form-data")
+
+    form = InboundEmailForm()
+    parser = multipart.MultipartParser(boundary, form.callbacks())
+
+    os.makedirs(INBOUND_EMAIL_SPOOL_DIR, exist_ok=True)
+    path = os.path.join(INBOUND_EMAIL_SPOOL_DIR, f"{uuid.uuid4().hex}.eml")
+    digest = hashlib.sha256()
+    f = await asyncio.to_thread(open, path, "wb")
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if form.pending:
+                data = bytes(form.pending)
+                form.pending.clear()
+                digest.update(data)
+                await asyncio.to_thread(f.write, data)
+        parser.finalize()
+    except BaseException:
+        f.close()
+        discard_inbound_email(path)
+        raise
+    f.close()
+    return {"fields": form.fields, "spool_path": path, "sha256": digest.hexdigest()}
+
+
+def discard_inbound_email(path: str):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def discard_failed_webhook_files(job: Dict[str, Any]):
+    """Задача вебхука окончательно не выполнена - её файл письма больше не понадобится"""
+    spool_path = job["payload"].get("spool_path")
+    if spool_path:
+        discard_inbound_email(spool_path)
+        print(f"🧹 [EMAIL] Письмо задачи #{job['id']} удалено: {spool_path}")
+
+
+webhook_queue.on_failed = discard_failed_webhook_files
+
+
+def parse_inbound_email(path: str) -> InboundEmail:
+    """
+    Разбирает сохранённое письмо за один проход: первые text/plain и text/html,
+    первое TXT и первое MP3 вложение. Вложения больше INBOUND_EMAIL_MAX_ATTACHMENT не декодируются
+    """
+    if INBOUND_EMAIL_DEBUG_DUMP:
+        import shutil
+        shutil.copyfile(path, INBOUND_EMAIL_DEBUG_DUMP)
+        print(f"📧 [DEBUG] Письмо сохранено в {INBOUND_EMAIL_DEBUG_DUMP}")
+
+    with open(path, "rb") as fp:
+        message = BytesParser(policy=email_policy.default).parse(fp)
+
+    email = InboundEmail()
+    email.subject = str(message.get("Subject", ""))
+    email.from_addr = str(message.get("From", ""))
+
+    for part in message.walk():
+        if part.is_multipart():
+            continue
+        content_type = part.get_content_type()
+        filename = part.get_filename() or ""
+        lower_name = filename.lower()
+
+        if part.is_attachment() or filename:
+            wanted_txt = lower_name.endswith(".txt") and email.txt_attachment is None
+            wanted_mp3 = (lower_name.endswith(".mp3") and email.audio is None
+                          and ("audio" in content_type or "octet-stream" in content_type))
+            if not (wanted_txt or wanted_mp3):
+                continue
+            # Размер оцениваем по закодированному телу (base64 ≈ 4/3), до декодирования
+            encoded_size = len(part.get_payload(decode=False) or "")
+            if encoded_size * 3 // 4 > INBOUND_EMAIL_MAX_ATTACHMENT:
+                email.skipped.append(filename)
+                print(f"⚠️  [EMAIL] Вложение {filename} больше лимита ({encoded_size * 3 // 4} байт) - пропускаем")
+                continue
+            data = part.get_payload(decode=True) or b""
+            if wanted_txt:
+                email.txt_attachment = data.decode("utf-8", errors="ignore")
+                email.txt_filename = filename
+            else:
+                email.audio = data
+                email.audio_filename = filename
+        elif content_type == "text/plain" and not email.plain:
+            email.plain = _part_text(part)
+        elif content_type == "text/html" and not email.html:
+            email.html = _part_text(part)
+
+    return email
+
+
+def _part_text(part) -> str:
+    try:
+        return part.get_content()
+    except Exception:
+        # Неизвестная кодировка - как раньше, utf-8 с пропуском ошибок
+        return (part.get_payload(decode=True) or b"").decode("utf-8", errors="ignore")
+
+
 @app.get("/webhooks/mango/email")
 async def mango_voicemail_email_verify():
     """Verification endpoint for CloudMailin (responds to GET)"""
@@ -7397,178 +10397,87 @@ async def mango_voicemail_email(request: Request):
     """
     Webhook от SendGrid Inbound Parse с транскрипцией голосового сообщения
 
-    CloudMailin парсит email от Mango и отправляет JSON:
-    {
-      "headers": {...},
-      "envelope": {...},
-      "plain": "текст письма",
-      "html": "HTML версия",
-      ...
-    }
+    Письмо сохраняется на диск и ставится в очередь; разбор, транскрипция
+    и лид - process_mango_voicemail_email
+    """
+    # SendGrid sends form-data, not JSON
+    spooled = await spool_inbound_email(request)
+    fingerprint = webhook_fingerprint("mango_email", None, (spooled["sha256"],))
+    if not await claim_webhook_event(fingerprint):
+        discard_inbound_email(spooled["spool_path"])
+        return duplicate_webhook_response("mango_email", fingerprint)
+    # Письмо само находит свой звонок (voicemail_store) - письма обрабатываются параллельно
+    return await ingest_webhook("mango_email", {"spool_path": spooled["spool_path"], "fields": spooled["fields"]},
+                          dedup=False)
+
+
+async def process_mango_voicemail_email(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Разбирает сохранённое письмо Mango и создаёт лид/тикет"""
+    payload = job["payload"]
+    email = await asyncio.to_thread(parse_inbound_email, payload["spool_path"])
+
+    # Звонок этого письма; найденный entry_id сохраняется в checkpoint - повтор задачи его не теряет
+    entry_id = job["checkpoint"].get("voicemail_entry")
+    record = await voicemail_store.get(entry_id) if entry_id else None
+    if record is None:
+        text = f"{email.subject} {email.text}"
+        phones = list(dict.fromkeys(re.findall(r'\+?[78]\d{10}', text)))
+        record = await voicemail_store.claim(text, phones)
+        if record is not None:
+            job["checkpoint"]["voicemail_entry"] = record["entry_id"]
+            webhook_queue.save_checkpoint(job)
+        elif time.time() - job["created_at"] < VOICEMAIL_EMAIL_WAIT:
+            await voicemail_store.wait_for_summary(job["id"], phones)
+            raise JobNotReady("письмо ждёт summary звонка", VOICEMAIL_EMAIL_WAIT)
+        else:
+            print(f"⚠️  [EMAIL] Звонок для письма не найден за {VOICEMAIL_EMAIL_WAIT}с")
+
+    result = await handle_mango_voicemail_email(email, payload.get("fields", {}), record)
+    # Письмо обработано - файл больше не нужен (при ошибке остаётся для повтора)
+    discard_inbound_email(payload["spool_path"])
+    return result
+
+
+async def handle_mango_voicemail_email(email: InboundEmail, fields: Dict[str, str],
+                                       voicemail: Optional[Dict]) -> Dict[str, Any]:
+    """
+    Письмо Mango с транскрипцией голосового сообщения: транскрипция берётся
+    из TXT вложения, из MP3 через Whisper или из текста письма.
+    voicemail - данные звонка из voicemail_store (None - звонок не найден)
     """
     try:
-        # SendGrid sends form-data, not JSON
-        form_data = await request.form()
-        
-        # DEBUG: Print all form fields
-        print("🐛 [DEBUG] All form-data fields:")
-        for key in form_data.keys():
-            value = form_data.get(key, "")
-            print(f"   {key}: {value[:200] if len(str(value)) > 200 else value}")
-        
-        # Parse raw email from SendGrid
-        raw_email = form_data.get("email", "")
-        
-        # DEBUG: Save raw email to file
-        if raw_email:
-            with open('/tmp/last_email.txt', 'w', encoding='utf-8') as f:
-                f.write(raw_email)
-            print(f"📧 [DEBUG] Raw email saved to /tmp/last_email.txt ({len(raw_email)} bytes)")
-        
-        email_msg = message_from_string(raw_email) if raw_email else None
-        
-        # Extract plain text from email
-        plain_text = ""
-        html_text = ""
-        
-        if email_msg:
-            if email_msg.is_multipart():
-                for part in email_msg.walk():
-                    content_type = part.get_content_type()
-                    if content_type == "text/plain" and not plain_text:
-                        try:
-                            plain_text = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                        except:
-                            pass
-                    elif content_type == "text/html" and not html_text:
-                        try:
-                            html_text = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                        except:
-                            pass
-            else:
-                try:
-                    payload = email_msg.get_payload(decode=True).decode('utf-8', errors='ignore')
-                    if email_msg.get_content_type() == "text/html":
-                        html_text = payload
-                    else:
-                        plain_text = payload
-                except:
-                    pass
-        
-        # If no plain text, extract from HTML
-        if not plain_text and html_text:
-            # Remove HTML tags and get text
-            plain_text = re.sub(r'<[^>]+>', ' ', html_text)
-            plain_text = unescape(plain_text)
-            # Clean up whitespace
-            plain_text = re.sub(r'\s+', ' ', plain_text).strip()
-        
-        print(f"📧 [DEBUG] Extracted plain text ({len(plain_text)} chars): {plain_text[:300]}")
-        print(f"📧 [DEBUG] Had HTML: {len(html_text) > 0}")
-        
-        # Extract attachment from email (MP3 or TXT)
-        mp3_data = None
-        mp3_filename = None
+        plain_text = email.text
+        print(f"📧 [EMAIL] Текст письма ({len(plain_text)} символов): {plain_text[:300]}")
+        print(f"📧 [EMAIL] HTML: {len(email.html) > 0}, TXT: {email.txt_filename or 'нет'}, MP3: {email.audio_filename or 'нет'}")
+
+        # Транскрипция Mango из TXT вложения
         txt_transcription = None
-        
-        if email_msg and email_msg.is_multipart():
-            for part in email_msg.walk():
-                content_disposition = part.get("Content-Disposition", "")
-                content_type = part.get_content_type()
-                
-                # Check if this is an attachment
-                if "attachment" in content_disposition:
-                    filename = part.get_filename()
-                    
-                    # Check for TXT file with transcription
-                    if filename and ".txt" in filename.lower():
-                        txt_data = part.get_payload(decode=True)
-                        try:
-                            # Decode the text
-                            txt_content = txt_data.decode('utf-8', errors='ignore')
-                            print(f"📝 [EMAIL] Найдено TXT вложение: {filename} ({len(txt_data)} bytes)")
-                            print(f"📄 [EMAIL] TXT содержимое: {txt_content[:300]}...")
-                            
-                            # Extract transcription after "следующего содержания:"
-                            if "следующего содержания:" in txt_content:
-                                parts = txt_content.split("следующего содержания:")
-                                if len(parts) > 1:
-                                    txt_transcription = parts[1].strip()
-                                    print(f"✅ [EMAIL] Извлечена транскрипция из TXT: {txt_transcription[:200]}...")
-                            else:
-                                # Use full text if no marker found
-                                txt_transcription = txt_content.strip()
-                                print(f"✅ [EMAIL] Используем полный текст TXT")
-                            break
-                        except Exception as e:
-                            print(f"❌ [EMAIL] Ошибка декодирования TXT: {e}")
-                    
-                    # Check for MP3 file
-                    elif filename and ".mp3" in filename.lower() and ("audio" in content_type or "octet-stream" in content_type):
-                        mp3_data = part.get_payload(decode=True)
-                        mp3_filename = filename
-                        print(f"🎵 [EMAIL] Найдено MP3 вложение: {filename} ({len(mp3_data)} bytes)")
-                        break
-        
-        # Transcribe MP3 using Whisper API if found
-        whisper_transcription = None
-        if mp3_data:
-            try:
-                import tempfile
-                import os
-                
-                # Save MP3 to temporary file
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as tmp_file:
-                    tmp_file.write(mp3_data)
-                    tmp_path = tmp_file.name
-                
-                print(f"💾 [EMAIL] MP3 сохранён во временный файл: {tmp_path}")
-                
-                # Call Whisper API via httpx
-                print(f"🎙️  [EMAIL] Отправляю в Whisper API для транскрибации...")
-                
-                async with httpx.AsyncClient(timeout=60.0) as http_client:
-                    with open(tmp_path, "rb") as audio_file:
-                        files = {"file": (mp3_filename, audio_file, "audio/mpeg")}
-                        data = {
-                            "model": "whisper-1",
-                            "language": "ru"
-                        }
-                        
-                        whisper_response = await http_client.post(
-                            "https://api.openai.com/v1/audio/transcriptions",
-                            headers={
-                                "Authorization": f"Bearer {OPENAI_API_KEY}"
-                            },
-                            files=files,
-                            data=data
-                        )
-                        
-                        if whisper_response.status_code == 200:
-                            result = whisper_response.json()
-                            whisper_transcription = result.get("text", "")
-                            print(f"✅ [EMAIL] Транскрипция получена ({len(whisper_transcription)} символов)")
-                            print(f"📝 [EMAIL] Whisper транскрипция: {whisper_transcription[:200]}...")
-                        else:
-                            print(f"❌ [EMAIL] Whisper API error: {whisper_response.status_code}")
-                            print(f"   Response: {whisper_response.text}")
-                
-                # Clean up temp file
-                os.unlink(tmp_path)
-                
-            except Exception as e:
-                print(f"❌ [EMAIL] Ошибка транскрибации: {e}")
-                import traceback
-                traceback.print_exc()
-        
-        # Convert form to dict for easier access
+        if email.txt_attachment is not None:
+            txt_content = email.txt_attachment
+            print(f"📄 [EMAIL] TXT содержимое: {txt_content[:300]}...")
+
+            # Extract transcription after "следующего содержания:"
+            if "следующего содержания:" in txt_content:
+                txt_transcription = txt_content.split("следующего содержания:", 1)[1].strip()
+                print(f"✅ [EMAIL] Извлечена транскрипция из TXT: {txt_transcription[:200]}...")
+            else:
+                # Use full text if no marker found
+                txt_transcription = txt_content.strip()
+                print(f"✅ [EMAIL] Используем полный текст TXT")
+
+        # TXT от Mango приоритетнее; MP3 - через Whisper (с кэшем по хешу аудио)
+        if email.audio and not txt_transcription:
+            print(f"🎵 [EMAIL] MP3 вложение: {email.audio_filename} ({len(email.audio)} bytes)")
+        transcribed = await transcribe_voicemail(email.audio, email.audio_filename, mango_text=txt_transcription)
+        whisper_transcription = transcribed["text"] if transcribed["source"] in ("whisper", "cache") else None
+
         data = {
-            "headers": {},
+            "headers": {"Subject": email.subject, "From": email.from_addr},
             "plain": plain_text,
-            "html": form_data.get("html", ""),
-            "from": form_data.get("from", ""),
-            "to": form_data.get("to", ""),
-            "subject": form_data.get("subject", ""),
+            "html": email.html,
+            "from": fields.get("from", ""),
+            "to": fields.get("to", ""),
+            "subject": fields.get("subject", ""),
         }
 
         print("="*60)
@@ -7599,27 +10508,26 @@ async def mango_voicemail_email(request: Request):
         # Проверяем транскрипцию только если не было MP3
         if not whisper_transcription and (not transcription or len(transcription) < 10):
             print("⚠️  [EMAIL] Транскрипция пустая или слишком короткая, и MP3 не найден")
-            return JSONResponse({
+            return {
                 "success": False,
                 "message": "Empty transcription and no MP3 found"
-            })
+            }
 
         print(f"📝 [EMAIL] Транскрипция:")
         print(f"   {transcription[:200]}..." if len(transcription) > 200 else f"   {transcription}")
 
-        # Извлекаем номер телефона из last_voicemail_data (данные последнего звонка)
-        global last_voicemail_data
-        if last_voicemail_data and last_voicemail_data.get('from_number'):
-            phone = last_voicemail_data['from_number']
-            recording_url = last_voicemail_data.get('recording_url', '')
-            call_duration = last_voicemail_data.get('call_duration', 0)
-            pressed_key = last_voicemail_data.get('pressed_key', '1')
-            print(f"📞 [EMAIL] Данные из последнего звонка:")
+        # Номер телефона и клавиша - из данных звонка, к которому относится письмо
+        if voicemail and voicemail.get('from_number'):
+            phone = voicemail['from_number']
+            recording_url = voicemail.get('recording_url', '')
+            call_duration = voicemail.get('call_duration', 0)
+            pressed_key = voicemail.get('pressed_key', '1')
+            print(f"📞 [EMAIL] Данные звонка {voicemail['entry_id']}:")
             print(f"   Телефон: {phone}")
             print(f"   Клавиша: {pressed_key}")
         else:
             # Fallback: пытаемся извлечь из транскрипции
-            print(f"⚠️  [EMAIL] last_voicemail_data пуст, извлекаем номер из текста")
+            print(f"⚠️  [EMAIL] Данных звонка нет, извлекаем номер из текста")
             phone_match = re.search(r'\+?[78]\d{10}', subject + " " + transcription)
             phone = phone_match.group(0) if phone_match else "Не указан"
             if not phone.startswith('+') and phone != "Не указан":
@@ -7640,7 +10548,7 @@ async def mango_voicemail_email(request: Request):
                 recording_url="",
                 call_duration=0
             )
-            return JSONResponse(result)
+            return result
 
         analysis = ai_result.get("analysis", {})
         address = analysis.get("address")
@@ -7766,9 +10674,9 @@ async def mango_voicemail_email(request: Request):
                 call_duration=0
             )
 
-            # Добавляем AI анализ + адрес в примечание
-            if result.get("success") and result.get("lead_id"):
-                lead_id = result["lead_id"]
+            # Добавляем AI анализ + адрес в примечание (лид может быть ещё в очереди outbox)
+            if result.get("success") and amo_lead_ref(result):
+                lead_id = amo_lead_ref(result)
                 await add_ai_analysis_note(
                     lead_id,
                     analysis,
@@ -7790,22 +10698,21 @@ async def mango_voicemail_email(request: Request):
             )
 
         print("="*60)
-        return JSONResponse(result)
+        return result
 
     except Exception as e:
         print(f"❌ [EMAIL] Ошибка: {str(e)}")
         import traceback
         traceback.print_exc()
-        return JSONResponse({
-            "success": False,
-            "error": str(e)
-        }, status_code=500)
+        # Письмо остаётся в очереди и будет обработано повторно
+        raise
 
 
+WEBHOOK_HANDLERS["mango_email"] = process_mango_voicemail_email
 
 
-async def create_task_for_lead(lead_id: int, text: str = "Продать интернет от СМИТ"):
-    """Создаёт задачу в AmoCRM для лида"""
+async def create_task_for_lead(lead_id, text: str = "Продать интернет от СМИТ"):
+    """Ставит в outbox задачу AmoCRM для лида (lead_id - ID лида или ссылка "job:N", см. amo_lead_ref)"""
     try:
         import time
         from datetime import datetime, timedelta
@@ -7842,37 +10749,18 @@ async def create_task_for_lead(lead_id: int, text: str = "Продать инт
             print(f"📅 [TASK] Срок установлен через 1 час: {target_time.strftime('%H:%M')}")
         
         complete_till = int(target_time.timestamp())
-        
-        headers = {
-            "Authorization": f"Bearer {AMO_ACCESS_TOKEN}",
-            "Content-Type": "application/json"
-        }
-        
-        task_data = [{
-            "task_type_id": 1,  # Тип "Звонок"
-            "text": text,
-            "complete_till": complete_till,
-            "entity_id": lead_id,
-            "entity_type": "leads",
-            "responsible_user_id": AMO_DEFAULT_RESPONSIBLE_USER_ID
-        }]
-        
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                f"{AMO_BASE_URL}/api/v4/tasks",
-                headers=headers,
-                json=task_data
-            )
-            
-            if response.status_code in [200, 201]:
-                result = response.json()
-                task_id = result.get("_embedded", {}).get("tasks", [{}])[0].get("id")
-                print(f"✅ [EMAIL] Задача создана: ID {task_id}")
-                return {"success": True, "task_id": task_id}
-            else:
-                print(f"❌ [EMAIL] Ошибка создания задачи: {response.status_code}")
-                print(f"   Response: {response.text}")
-                return {"success": False, "error": response.text}
+
+        # Срок считается сейчас, даже если AmoCRM выполнит задачу позже
+        target_lead_id, lead_job_id = parse_amo_lead_ref(lead_id)
+        return await submit_amo_write("lead_task", {
+            "lead_id": target_lead_id,
+            "task": {
+                "task_type_id": 1,  # Тип "Звонок"
+                "text": text,
+                "complete_till": complete_till,
+                "responsible_user_id": AMO_DEFAULT_RESPONSIBLE_USER_ID
+            }
+        }, depends_on=lead_job_id)
     except Exception as e:
         print(f"❌ [EMAIL] Исключение при создании задачи: {e}")
         import traceback
@@ -7880,8 +10768,8 @@ async def create_task_for_lead(lead_id: int, text: str = "Продать инт
         return {"success": False, "error": str(e)}
 
 
-async def add_ai_analysis_note(lead_id: int, analysis: Dict, transcription: str, address_full: str = None):
-    """Добавляет примечание с AI анализом к лиду"""
+async def add_ai_analysis_note(lead_id, analysis: Dict, transcription: str, address_full: str = None):
+    """Ставит в outbox примечание с AI анализом к лиду (lead_id - ID лида или ссылка "job:N")"""
     try:
         note_text = f"""🤖 AI Анализ голосового сообщения:
 
@@ -7899,28 +10787,9 @@ async def add_ai_analysis_note(lead_id: int, analysis: Dict, transcription: str,
 🎯 Уверенность AI: {analysis.get('confidence', 'low').upper()}
 """
 
-        headers = {
-            "Authorization": f"Bearer {AMO_ACCESS_TOKEN}",
-            "Content-Type": "application/json"
-        }
-
-        note_data = [{
-            "entity_id": lead_id,
-            "note_type": "common",
-            "params": {"text": note_text}
-        }]
-
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                f"{AMO_BASE_URL}/api/v4/leads/notes",
-                json=note_data,
-                headers=headers
-            )
-
-            if response.status_code in [200, 201]:
-                print(f"✅ [EMAIL] AI анализ добавлен к лиду {lead_id}")
-            else:
-                print(f"⚠️  [EMAIL] Ошибка добавления примечания: {response.status_code}")
+        target_lead_id, lead_job_id = parse_amo_lead_ref(lead_id)
+        await submit_amo_write("lead_note", {"lead_id": target_lead_id, "text": note_text},
+                               depends_on=lead_job_id)
 
     except Exception as e:
         print(f"❌ [EMAIL] Ошибка add_ai_analysis_note: {e}")
@@ -7930,7 +10799,7 @@ async def add_to_waitlist(phone: str, address: str, issue: str, transcription: s
     """
     Добавляет клиента в список ожидания (адрес недоступен)
 
-    Создает лид в AmoCRM с особой меткой
+    Создает лид в AmoCRM с особой меткой (через outbox)
     """
     try:
         print(f"⏳ [WAITLIST] Добавляем в список ожидания: {phone}")
@@ -7938,61 +10807,7 @@ async def add_to_waitlist(phone: str, address: str, issue: str, transcription: s
         if not phone.startswith('+'):
             phone = f'+{phone}'
 
-        headers = {
-            "Authorization": f"Bearer {AMO_ACCESS_TOKEN}",
-            "Content-Type": "application/json"
-        }
-
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            # Создаем контакт
-            contact_data = [{
-                "name": f"Клиент {phone}",
-                "custom_fields_values": [
-                    {
-                        "field_code": "PHONE",
-                        "values": [{"value": phone, "enum_code": "WORK"}]
-                    }
-                ]
-            }]
-
-            contact_response = await client.post(
-                f"{AMO_BASE_URL}/api/v4/contacts",
-                json=contact_data,
-                headers=headers
-            )
-
-            contact_id = None
-            if contact_response.status_code in [200, 201]:
-                data = contact_response.json()
-                if data.get("_embedded") and data["_embedded"].get("contacts"):
-                    contact_id = data["_embedded"]["contacts"][0]["id"]
-
-            # Создаем лид в список ожидания
-            lead_data = {
-                "name": f"СПИСОК ОЖИДАНИЯ: {address}",
-                "price": 0,
-                "pipeline_id": AMO_PIPELINE_B2C_ID,
-                "status_id": 79103550,  # Новый
-                "responsible_user_id": AMO_DEFAULT_RESPONSIBLE_USER_ID
-            }
-
-            if contact_id:
-                lead_data["_embedded"] = {"contacts": [{"id": contact_id}]}
-
-            lead_response = await client.post(
-                f"{AMO_BASE_URL}/api/v4/leads",
-                json=[lead_data],
-                headers=headers
-            )
-
-            if lead_response.status_code in [200, 201]:
-                data = lead_response.json()
-                if data.get("_embedded") and data["_embedded"].get("leads"):
-                    lead_id = data["_embedded"]["leads"][0]["id"]
-                    print(f"✅ [WAITLIST] Лид создан: {lead_id}")
-
-                    # Добавляем примечание
-                    note_text = f"""⏳ СПИСОК ОЖИДАНИЯ
+        note_text = f"""⏳ СПИСОК ОЖИДАНИЯ
 
 📍 Запрошенный адрес: {address}
 ❌ Адрес пока недоступен для подключения
@@ -8006,27 +10821,36 @@ async def add_to_waitlist(phone: str, address: str, issue: str, transcription: s
 ⚠️ Свяжитесь с клиентом когда адрес станет доступен!
 """
 
-                    note_data = [{
-                        "entity_id": lead_id,
-                        "note_type": "common",
-                        "params": {"text": note_text}
-                    }]
-
-                    await client.post(
-                        f"{AMO_BASE_URL}/api/v4/leads/notes",
-                        json=note_data,
-                        headers=headers
-                    )
-
-                    return {
-                        "success": True,
-                        "lead_id": lead_id,
-                        "contact_id": contact_id,
-                        "status": "waitlist",
-                        "message": "Добавлен в список ожидания"
+        result = await submit_amo_write("create_lead", {
+            "phone": phone,
+            "contact": {
+                "name": f"Клиент {phone}",
+                "custom_fields_values": [
+                    {
+                        "field_code": "PHONE",
+                        "values": [{"value": phone, "enum_code": "WORK"}]
                     }
+                ]
+            },
+            # Лид в список ожидания
+            "lead": {
+                "name": f"СПИСОК ОЖИДАНИЯ: {address}",
+                "price": 0,
+                "pipeline_id": AMO_PIPELINE_B2C_ID,
+                "status_id": 79103550,  # Новый
+                "responsible_user_id": AMO_DEFAULT_RESPONSIBLE_USER_ID
+            },
+            "note_text": note_text,
+            "log_tag": "WAITLIST"
+        }, wait=AMO_OUTBOX_SYNC_WAIT)
 
-            return {"success": False, "error": "Failed to create lead"}
+        if not result.get("success"):
+            return result
+        return {
+            **result,
+            "status": "waitlist",
+            "message": "Добавлен в список ожидания"
+        }
 
     except Exception as e:
         print(f"❌ [WAITLIST] Ошибка: {str(e)}")
@@ -8038,8 +10862,26 @@ async def add_to_waitlist(phone: str, address: str, issue: str, transcription: s
 
 
 if __name__ == "__main__":
+    # python server.py build-kb-index - пересобрать векторный индекс базы знаний и выйти
+    if len(sys.argv) > 1 and sys.argv[1] == "build-kb-index":
+        if np is None:
+            print("❌ Для векторного индекса нужен numpy (pip install numpy)")
+            sys.exit(1)
+        kb_index.load()
+        kb_vectors.build(kb_index.items, kb_index.fingerprint, save=True)
+        sys.exit(0)
+
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8900)
+
+    workers = int(os.getenv("UVICORN_WORKERS", "1"))
+    if workers > 1 and not state.shared:
+        print("⚠️  UVICORN_WORKERS > 1 требует STATE_BACKEND=sqlite или redis - запускаю один воркер")
+        workers = 1
+
+    if workers > 1:
+        uvicorn.run("server:app", host="0.0.0.0", port=8900, workers=workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8900)
 
 
 
@@ -0,0 +1,61 @@
+"""Потоковое сохранение письма SendGrid Inbound Parse (spool_inbound_email)"""
+
+import hashlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+server = pytest.importorskip("server")
+
+from fastapi import FastAPI, Request  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+BOUNDARY = "xYzZY"
+
+
+def sendgrid_body(email: bytes, **fields: str) -> bytes:
+    """Форма как у SendGrid в raw-режиме: письмо - обычное текстовое поле email"""
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    parts.append(f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="email"\r\n\r\n'.encode() + email + b"\r\n")
+    parts.append(f"--{BOUNDARY}--\r\n".encode())
+    return b"".join(parts)
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "INBOUND_EMAIL_SPOOL_DIR", str(tmp_path))
+    app = FastAPI()
+
+    @app.post("/spool")
+    async def spool(request: Request):
+        return await server.spool_inbound_email(request)
+
+    return TestClient(app)
+
+
+def test_email_over_1mb_is_spooled(client):
+    # ~2 МБ: MP3 больше 750 КБ в base64 - раньше request.form() отвечал 400
+    email = b"Subject: voicemail\r\n\r\n" + b"QUJD" * (512 * 1024)
+    response = client.post("/spool", content=sendgrid_body(email, subject="voicemail", to="aida@smit34.ru"),
+                           headers={"Content-Type": f"multipart/form-data; boundary={BOUNDARY}"})
+
+    assert response.status_code == 200
+    spooled = response.json()
+    assert spooled["fields"] == {"subject": "voicemail", "to": "aida@smit34.ru"}
+    assert spooled["sha256"] == hashlib.sha256(email).hexdigest()
+    with open(spooled["spool_path"], "rb") as f:
+        assert f.read() == email
+
+
+def test_oversized_field_is_rejected(client, tmp_path):
+    body = sendgrid_body(b"Subject: x\r\n\r\n", headers="h" * (server.INBOUND_EMAIL_MAX_FIELD + 1))
+    response = client.post("/spool", content=body,
+                           headers={"Content-Type": f"multipart/form-data; boundary={BOUNDARY}"})
+
+    assert response.status_code == 400
+    assert os.listdir(tmp_path) == []